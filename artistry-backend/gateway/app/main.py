@@ -3,14 +3,17 @@ import uuid
 import base64
 import asyncio
 import hashlib
+import io
 import secrets
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Dict, Optional
 from fastapi import FastAPI, BackgroundTasks, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from motor.motor_asyncio import AsyncIOMotorClient
 import httpx
+from PIL import Image, ImageChops
 from dotenv import load_dotenv
 from functools import lru_cache
 
@@ -21,8 +24,12 @@ MONGO_DB = os.getenv("MONGO_DB", "artistry")
 # Development: Use localhost URLs with correct ports
 DETECT_URL = os.getenv("DETECT_URL", "http://localhost:8001/detect/")
 SEGMENT_URL = os.getenv("SEGMENT_URL", "http://localhost:8002/segment/")
+SEGMENT_PREPARE_URL = os.getenv("SEGMENT_PREPARE_URL", "http://localhost:8002/segment/prepare")
 ADVISE_URL = os.getenv("ADVISE_URL", "http://localhost:8003/advise/")
 GENERATE_URL = os.getenv("GENERATE_URL", "http://localhost:8004/generate/")
+GENERATE_JOBS_URL = os.getenv("GENERATE_JOBS_URL", "http://localhost:8004/generate/jobs")
+# Overall budget for one generation job (polled, so no single request holds this long)
+GENERATION_JOB_TIMEOUT = float(os.getenv("GENERATION_JOB_TIMEOUT", "1800"))
 COMMERCE_URL = os.getenv("COMMERCE_URL", "http://localhost:8005")
 
 app = FastAPI(title="Artistry Gateway (Optimized)")
@@ -149,6 +156,7 @@ class EnhancedWorkflowRequest(BaseModel):
     image_b64: str
     session_id: str  # Link to user preferences
     base_prompt: str | None = "Modern interior design"
+    seed: int | None = None  # Replay a saved result (served from the generate result cache)
 
 @app.post("/workflow/enhanced")
 async def enhanced_workflow(req: EnhancedWorkflowRequest):
@@ -172,10 +180,10 @@ async def enhanced_workflow(req: EnhancedWorkflowRequest):
             design_tips = req.base_prompt
             user_item_selection = []
         
-        # Step 1: Detect objects
-        detect_resp = await call_service(
-            f"{DETECT_URL}detect/",
-            {"image_b64": req.image_b64}
+        # Step 1: Detect objects (SAM encoder warms up in parallel)
+        detect_resp, _ = await asyncio.gather(
+            call_service(f"{DETECT_URL}detect/", {"image_b64": req.image_b64}),
+            prepare_segment(req.image_b64)
         )
         objects_detected = detect_resp.get("objects", [])
         bboxes = detect_resp.get("bboxes", [])
@@ -185,7 +193,8 @@ async def enhanced_workflow(req: EnhancedWorkflowRequest):
             f"{SEGMENT_URL}segment/",
             {"image_b64": req.image_b64, "bboxes": bboxes}
         )
-        masks = segment_resp.get("masks", {})
+        # Per-item PNG masks, keyed by detected label (what generate's masks fields take)
+        masks = item_masks(segment_resp.get("masks", []), req.image_b64)
         
         # Step 3: Analyze item conditions (NEW)
         condition_resp = await call_service(
@@ -245,16 +254,18 @@ async def enhanced_workflow(req: EnhancedWorkflowRequest):
         # Step 7: Generate image with budget-aware materials (NEW)
         combined_prompt = f"{req.base_prompt}. {design_tips}"
         
-        gen_resp = await call_service(
-            f"{GENERATE_URL}/generate/budget-aware",
+        gen_resp = await run_generation_job(
+            "budget_aware",
             {
                 "image_b64": req.image_b64,
                 "base_prompt": combined_prompt,
                 "material_specs": material_specs_dict,
                 "replace_items": replace_items,
                 "budget": budget,
-                "masks": masks,
-                "mode": "balanced"
+                "masks": {item: masks[item] for item in replace_items if item in masks} or None,
+                "mode": "balanced",
+                "seed": req.seed,
+                "restore_aspect": True  # Same aspect ratio as the uploaded photo, not a square
             }
         )
         generated_image = gen_resp.get("image_b64", "")
@@ -264,7 +275,9 @@ async def enhanced_workflow(req: EnhancedWorkflowRequest):
             f"{GENERATE_URL}/generate/analyze-output",
             {
                 "generated_image_b64": generated_image,
-                "replaced_items": replace_items
+                "replaced_items": replace_items,
+                # Per-item regions for colors/style/material (items without one use the full image)
+                "masks": {item: masks[item] for item in replace_items if item in masks}
             }
         )
         shopping_items = analysis_resp.get("items", [])
@@ -272,6 +285,7 @@ async def enhanced_workflow(req: EnhancedWorkflowRequest):
         # Store complete result
         result = {
             "generated_image": generated_image,
+            "seed": gen_resp.get("seed"),  # Send back with the same inputs to reproduce this image
             "objects_detected": objects_detected,
             "condition_analysis": condition_estimates,
             "items_replaced": replace_items,
@@ -309,6 +323,7 @@ class SaveDesignRequest(BaseModel):
     advice: list[str] | None = None
     generatedImage: str | None = None
     prompt: str | None = None
+    seed: int | None = None  # Generation seed, so the design can be re-rendered identically
     timestamp: str | None = None
 
 @app.post("/api/designs")
@@ -332,6 +347,7 @@ async def save_design(design: SaveDesignRequest):
             "advice": design.advice,
             "generated_image": design.generatedImage,
             "prompt": design.prompt,
+            "seed": design.seed,
             "timestamp": design.timestamp,
             "created_at": asyncio.get_event_loop().time()
         })
@@ -363,11 +379,85 @@ async def call_service(url: str, json: dict, timeout: float = 60.0):
         r.raise_for_status()
         return r.json()
 
+async def run_generation_job(kind: str, payload: dict, poll_interval: float = 2.0):
+    """
+    Run a generation through the generate service's job API: submit, poll
+    until finished, fetch the result. CPU diffusion regularly outlives a
+    single request timeout; polling does not. The job is cancelled if we
+    give up (timeout, error, or this request being cancelled).
+    """
+    job = await call_service(GENERATE_JOBS_URL, {"kind": kind, "payload": payload})
+    job_id = job["job_id"]
+    deadline = asyncio.get_event_loop().time() + GENERATION_JOB_TIMEOUT
+    finished = False
+    try:
+        async with httpx.AsyncClient(timeout=client_timeout) as c:
+            while True:
+                r = await c.get(f"{GENERATE_JOBS_URL}/{job_id}")
+                r.raise_for_status()
+                status = r.json()
+                if status["status"] == "completed":
+                    finished = True
+                    r = await c.get(f"{GENERATE_JOBS_URL}/{job_id}/result")
+                    r.raise_for_status()
+                    return r.json()
+                if status["status"] in ("failed", "cancelled"):
+                    finished = True
+                    raise RuntimeError(f"Generation job {status['status']}: {status.get('error')}")
+                if asyncio.get_event_loop().time() > deadline:
+                    raise TimeoutError(f"Generation job {job_id} exceeded {GENERATION_JOB_TIMEOUT:.0f}s")
+                await asyncio.sleep(poll_interval)
+    finally:
+        if not finished:
+            try:
+                async with httpx.AsyncClient(timeout=10.0) as c:
+                    await c.delete(f"{GENERATE_JOBS_URL}/{job_id}")
+            except Exception as e:
+                print(f"⚠ Failed to cancel generation job {job_id}: {e}")
+
+def item_masks(segment_masks: list, image_b64: str) -> Dict[str, str]:
+    """
+    {item label: PNG base64} from /segment's [{"bbox": {..., "label"}, "mask_b64"}].
+    Segment sends raw 8-bit mask bytes at the image size; generate expects
+    encoded images. Masks of the same label (two chairs) are merged.
+    """
+    if not segment_masks:
+        return {}
+    size = Image.open(io.BytesIO(base64.b64decode(image_b64))).size
+    merged = {}
+    for entry in segment_masks:
+        label = (entry.get("bbox") or {}).get("label")
+        raw = base64.b64decode(entry.get("mask_b64", ""))
+        if not label or len(raw) != size[0] * size[1]:
+            continue
+        mask = Image.frombytes("L", size, raw)
+        merged[label] = ImageChops.lighter(merged[label], mask) if label in merged else mask
+    encoded = {}
+    for label, mask in merged.items():
+        buf = io.BytesIO()
+        mask.save(buf, format="PNG")
+        encoded[label] = base64.b64encode(buf.getvalue()).decode()
+    return encoded
+
+async def prepare_segment(image_b64: str):
+    """
+    Ask segment to start encoding the image while detect runs.
+    Best effort: /segment still works (and encodes itself) if this fails.
+    """
+    try:
+        return await call_service(SEGMENT_PREPARE_URL, {"image_b64": image_b64})
+    except Exception as e:
+        print(f"⚠ Segment prepare failed (continuing without prefetch): {e}")
+        return None
+
 async def process_job(job_id: str, payload: CreateRoomReq):
     try:
         await mongo.jobs.update_one({"_id": job_id}, {"$set": {"status": "running"}})
-        # 1) Detect
-        detect_resp = await call_service(DETECT_URL, {"image_b64": payload.image_b64})
+        # 1) Detect (segment encodes the image concurrently)
+        detect_resp, _ = await asyncio.gather(
+            call_service(DETECT_URL, {"image_b64": payload.image_b64}),
+            prepare_segment(payload.image_b64)
+        )
         bboxes = detect_resp.get("bboxes", [])
         # 2) Segment
         segment_resp = await call_service(SEGMENT_URL, {"image_b64": payload.image_b64, "bboxes": bboxes})
@@ -375,10 +465,11 @@ async def process_job(job_id: str, payload: CreateRoomReq):
         # 3) Advise (RAG + LLaVA)
         advise_resp = await call_service(ADVISE_URL, {"masks": masks, "prompt": payload.prompt})
         # 4) Generate (Stable Diffusion + ControlNet)
-        gen_resp = await call_service(GENERATE_URL, {"image_b64": payload.image_b64, "masks": masks, "prompt": payload.prompt, "options": payload.options},)
-        output_url = gen_resp.get("image_url")
+        gen_resp = await run_generation_job("render", {"image_b64": payload.image_b64, "masks": masks, "prompt": payload.prompt, "options": payload.options})
+        # render returns the PNG inline (image_b64); there is no hosted URL to store
+        result = {"output_image_b64": gen_resp["image_b64"], "seed": gen_resp.get("seed"), "advise": advise_resp}
         # Finalize
-        await mongo.jobs.update_one({"_id": job_id}, {"$set": {"status": "done", "result": {"output_url": output_url, "advise": advise_resp}}})
+        await mongo.jobs.update_one({"_id": job_id}, {"$set": {"status": "done", "result": result}})
     except Exception as e:
         await mongo.jobs.update_one({"_id": job_id}, {"$set": {"status": "failed", "error": str(e)}})
 
@@ -465,6 +556,94 @@ async def proxy_affiliate_links(request_data: dict):
         raise HTTPException(status_code=500, detail=f"Commerce service error: {str(e)}")
 
 
+# ============================================
+# GENERATION JOB PROXY ROUTES
+# ============================================
+
+@app.post("/generate/jobs")
+async def proxy_submit_generation_job(request_data: dict):
+    """Proxy to generate service: submit a generation job ({kind, payload})"""
+    try:
+        return await call_service(GENERATE_JOBS_URL, request_data)
+    except httpx.HTTPStatusError as e:
+        raise HTTPException(status_code=e.response.status_code, detail=e.response.text)
+    except Exception as e:
+        raise HTTPException(status_code=502, detail=f"Generate service error: {str(e)}")
+
+@app.get("/generate/jobs/{job_id}")
+async def proxy_generation_job_status(job_id: str):
+    """Proxy to generate service: job status, progress and ETA"""
+    try:
+        async with httpx.AsyncClient(timeout=30.0) as client:
+            response = await client.get(f"{GENERATE_JOBS_URL}/{job_id}")
+            response.raise_for_status()
+            return response.json()
+    except httpx.HTTPStatusError as e:
+        raise HTTPException(status_code=e.response.status_code, detail=e.response.text)
+    except Exception as e:
+        raise HTTPException(status_code=502, detail=f"Generate service error: {str(e)}")
+
+@app.get("/generate/jobs/{job_id}/result")
+async def proxy_generation_job_result(job_id: str):
+    """Proxy to generate service: finished job result"""
+    try:
+        async with httpx.AsyncClient(timeout=client_timeout) as client:
+            response = await client.get(f"{GENERATE_JOBS_URL}/{job_id}/result")
+            response.raise_for_status()
+            return response.json()
+    except httpx.HTTPStatusError as e:
+        raise HTTPException(status_code=e.response.status_code, detail=e.response.text)
+    except Exception as e:
+        raise HTTPException(status_code=502, detail=f"Generate service error: {str(e)}")
+
+@app.delete("/generate/jobs/{job_id}")
+async def proxy_cancel_generation_job(job_id: str):
+    """Proxy to generate service: cancel a job"""
+    try:
+        async with httpx.AsyncClient(timeout=30.0) as client:
+            response = await client.delete(f"{GENERATE_JOBS_URL}/{job_id}")
+            response.raise_for_status()
+            return response.json()
+    except httpx.HTTPStatusError as e:
+        raise HTTPException(status_code=e.response.status_code, detail=e.response.text)
+    except Exception as e:
+        raise HTTPException(status_code=502, detail=f"Generate service error: {str(e)}")
+
+@app.get("/generate/jobs/{job_id}/stream")
+async def proxy_generation_job_stream(job_id: str, preview_every: int = 5):
+    """
+    Proxy the generate service's Server-Sent Events (progress, ETA, latent
+    previews) to the browser, relaying chunks as they arrive
+    """
+    client = httpx.AsyncClient(timeout=httpx.Timeout(None, connect=10.0))
+    upstream = client.build_request("GET", f"{GENERATE_JOBS_URL}/{job_id}/stream", params={"preview_every": preview_every})
+    try:
+        response = await client.send(upstream, stream=True)
+    except Exception as e:
+        await client.aclose()
+        raise HTTPException(status_code=502, detail=f"Generate service error: {str(e)}")
+    if response.status_code != 200:
+        detail = (await response.aread()).decode(errors="replace")
+        await response.aclose()
+        await client.aclose()
+        raise HTTPException(status_code=response.status_code, detail=detail)
+    
+    async def relay():
+        try:
+            async for chunk in response.aiter_raw():
+                yield chunk
+        finally:
+            # Browser went away (or stream ended): close the upstream stream too
+            await response.aclose()
+            await client.aclose()
+    
+    return StreamingResponse(
+        relay(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
 # ============================================
 # USER AUTHENTICATION (MVP - High Priority)
 # ============================================
@@ -0,0 +1,216 @@
+"""
+Output Attributes
+Shopping metadata for the items replaced in a generated image, computed
+locally in milliseconds instead of a round-trip to the advise service's
+LLM. For each item the analyzer:
+
+1. crops the item's mask region (outside the mask greyed out),
+2. finds its dominant colors with a vectorized k-means in Lab space on a
+   pixel sample, and names them from a small interior-color table,
+3. scores style and material labels with CLIP zero-shot classification;
+   all crops (plus the full image, for the overall style) go through the
+   image encoder in one batch, and label prompt embeddings are cached.
+
+Items without a mask fall back to the full image (and say so).
+
+Environment:
+    GENERATE_ANALYZE_MODEL  CLIP checkpoint for zero-shot scoring (default openai/clip-vit-base-patch32)
+"""
+
+import os
+import threading
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import cv2
+import numpy as np
+import torch
+from PIL import Image
+
+ANALYZE_MODEL = os.getenv("GENERATE_ANALYZE_MODEL", "openai/clip-vit-base-patch32")
+
+STYLES = [
+    "modern", "minimalist", "contemporary", "traditional", "scandinavian",
+    "industrial", "mid-century modern", "bohemian", "rustic", "luxury",
+]
+MATERIALS = [
+    "solid wood", "engineered wood", "upholstered fabric", "linen", "velvet", "leather",
+    "metal", "glass", "marble", "rattan", "ceramic", "plastic",
+]
+# Interior color names -> RGB; dominant colors get the nearest name in Lab
+NAMED_COLORS = {
+    "white": (245, 245, 245), "off-white": (240, 234, 214), "cream": (250, 243, 210),
+    "beige": (222, 205, 175), "tan": (210, 180, 140), "brown": (120, 80, 50),
+    "dark brown": (70, 48, 32), "black": (20, 20, 20), "charcoal": (54, 60, 66),
+    "grey": (128, 128, 128), "light grey": (200, 200, 200), "navy": (30, 40, 80),
+    "blue": (60, 100, 180), "teal": (0, 120, 120), "green": (70, 120, 70),
+    "sage": (156, 175, 136), "olive": (110, 110, 50), "yellow": (230, 200, 60),
+    "mustard": (200, 160, 40), "orange": (220, 120, 50), "terracotta": (190, 90, 60),
+    "red": (170, 40, 40), "burgundy": (110, 30, 45), "pink": (230, 170, 180),
+    "purple": (110, 70, 130),
+}
+
+
+def to_lab(rgb: np.ndarray) -> np.ndarray:
+    """(N, 3) uint8 RGB -> (N, 3) float32 Lab (OpenCV 8-bit scaling)"""
+    return cv2.cvtColor(rgb.reshape(-1, 1, 3).astype(np.uint8), cv2.COLOR_RGB2LAB).reshape(-1, 3).astype(np.float32)
+
+
+_COLOR_NAMES = list(NAMED_COLORS)
+_COLOR_LAB = to_lab(np.array(list(NAMED_COLORS.values())))
+
+
+def color_name(rgb: Sequence[int]) -> str:
+    distances = ((_COLOR_LAB - to_lab(np.array([rgb]))) ** 2).sum(axis=1)
+    return _COLOR_NAMES[int(distances.argmin())]
+
+
+def dominant_colors(pixels: np.ndarray, k: int = 4, iterations: int = 10,
+                    max_samples: int = 4096) -> List[Tuple[Tuple[int, int, int], float]]:
+    """
+    [(rgb, share)] for (N, 3) uint8 pixels, largest share first. K-means in
+    Lab on an evenly strided sample, centers seeded along the lightness axis
+    (deterministic, no random restarts).
+    """
+    if len(pixels) == 0:
+        return []
+    pixels = pixels[:: max(1, len(pixels) // max_samples)]
+    lab = to_lab(pixels)
+    k = min(k, len(lab))
+    centers = lab[np.argsort(lab[:, 0])[np.linspace(0, len(lab) - 1, k).astype(int)]]
+    for _ in range(iterations):
+        labels = ((lab[:, None, :] - centers[None]) ** 2).sum(axis=2).argmin(axis=1)
+        counts = np.bincount(labels, minlength=k)
+        sums = np.zeros_like(centers)
+        np.add.at(sums, labels, lab)
+        updated = np.where(counts[:, None] > 0, sums / np.maximum(counts, 1)[:, None], centers)
+        if np.abs(updated - centers).max() < 0.5:
+            break
+        centers = updated
+    labels = ((lab[:, None, :] - centers[None]) ** 2).sum(axis=2).argmin(axis=1)
+    counts = np.bincount(labels, minlength=k)
+    rgb_sums = np.zeros((k, 3), dtype=np.float64)
+    np.add.at(rgb_sums, labels, pixels.astype(np.float64))
+    order = np.argsort(-counts)
+    return [
+        (tuple(int(v) for v in rgb_sums[j] / counts[j]), float(counts[j] / len(lab)))
+        for j in order if counts[j] > 0
+    ]
+
+
+def item_region(image: np.ndarray, mask: Optional[np.ndarray], padding: float = 0.05,
+                fill: int = 128) -> Tuple[Image.Image, np.ndarray]:
+    """(crop for CLIP with the outside of the mask greyed, masked pixels (N, 3)) of an HxWx3 image"""
+    if mask is None or not mask.any():
+        return Image.fromarray(image), image.reshape(-1, 3)
+    ys, xs = np.nonzero(mask)
+    height, width = mask.shape
+    pad = int(max(ys.max() - ys.min(), xs.max() - xs.min()) * padding)
+    y1, y2 = max(0, ys.min() - pad), min(height, ys.max() + pad + 1)
+    x1, x2 = max(0, xs.min() - pad), min(width, xs.max() + pad + 1)
+    crop, crop_mask = image[y1:y2, x1:x2], mask[y1:y2, x1:x2]
+    focused = np.where(crop_mask[..., None], crop, np.uint8(fill))
+    return Image.fromarray(focused), image[mask]
+
+
+class ZeroShotScorer:
+    """CLIP image/text embeddings for zero-shot labels; loads on first use, prompt embeddings cached"""
+
+    def __init__(self, model_id: str = ANALYZE_MODEL, device: str = "cpu"):
+        self.model_id = model_id
+        self.device = device
+        self._model = None
+        self._processor = None
+        self._text: Dict[str, torch.Tensor] = {}
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._model is None:
+                from transformers import CLIPModel, CLIPProcessor
+                self._processor = CLIPProcessor.from_pretrained(self.model_id)
+                self._model = CLIPModel.from_pretrained(self.model_id).to(self.device).eval()
+                print(f"✓ Zero-shot analyzer loaded ({self.model_id})")
+        return self._model, self._processor
+
+    def image_features(self, images: List[Image.Image]) -> torch.Tensor:
+        """(len(images), D) normalized embeddings, one encoder pass for the whole batch"""
+        model, processor = self._load()
+        inputs = processor(images=images, return_tensors="pt").to(self.device)
+        with torch.no_grad():
+            features = model.get_image_features(**inputs)
+        return features / features.norm(dim=-1, keepdim=True)
+
+    def text_features(self, prompts: List[str]) -> torch.Tensor:
+        """(len(prompts), D) normalized embeddings; only uncached prompts hit the text encoder"""
+        model, processor = self._load()
+        missing = [p for p in dict.fromkeys(prompts) if p not in self._text]
+        if missing:
+            inputs = processor(text=missing, return_tensors="pt", padding=True).to(self.device)
+            with torch.no_grad():
+                features = model.get_text_features(**inputs)
+            features = features / features.norm(dim=-1, keepdim=True)
+            with self._lock:
+                self._text.update(zip(missing, features))
+        return torch.stack([self._text[p] for p in prompts])
+
+    def rank(self, image_features: torch.Tensor, prompt_sets: List[List[str]]) -> List[Tuple[int, float]]:
+        """(best index, probability) per image, each image scored against its own prompt list"""
+        model, _ = self._load()
+        scale = model.logit_scale.exp()
+        results = []
+        for features, prompts in zip(image_features, prompt_sets):
+            probs = (scale * self.text_features(prompts) @ features).softmax(dim=0)
+            best = int(probs.argmax())
+            results.append((best, float(probs[best])))
+        return results
+
+
+class OutputAnalyzer:
+    """Per-item style/material/color metadata for a generated image"""
+
+    def __init__(self, scorer: ZeroShotScorer):
+        self.scorer = scorer
+
+    def analyze(self, image: Image.Image, items: List[str], masks: Dict[str, Image.Image]) -> dict:
+        """`masks` are L-mode images at the image size; items without one use the full image"""
+        pixels = np.array(image.convert("RGB"))
+        crops, colors, masked = [], [], []
+        for item in items:
+            mask = masks.get(item)
+            crop, region = item_region(pixels, np.array(mask) > 127 if mask is not None else None)
+            crops.append(crop)
+            colors.append(dominant_colors(region))
+            masked.append(mask is not None)
+
+        # Item crops + the full image through the image encoder together
+        features = self.scorer.image_features(crops + [Image.fromarray(pixels)])
+        item_features, image_features = features[:-1], features[-1:]
+        styles = self.scorer.rank(
+            item_features, [[f"a photo of a {s} style {item}" for s in STYLES] for item in items]
+        )
+        materials = self.scorer.rank(
+            item_features, [[f"a photo of a {item} made of {m}" for m in MATERIALS] for item in items]
+        )
+        overall = self.scorer.rank(image_features, [[f"a photo of a {s} style interior" for s in STYLES]])[0]
+
+        results, palette = [], []
+        for item, item_colors, (style, style_p), (material, material_p), has_mask in zip(
+                items, colors, styles, materials, masked):
+            names = list(dict.fromkeys(color_name(rgb) for rgb, _ in item_colors))
+            primary = names[0] if names else "neutral"
+            palette.extend(n for n in names[:2] if n not in palette)
+            results.append({
+                "item_type": item,
+                "style": STYLES[style],
+                "material": MATERIALS[material],
+                "color": primary,
+                "confidence": round((style_p + material_p) / 2, 3),
+                "style_confidence": round(style_p, 3),
+                "material_confidence": round(material_p, 3),
+                "dominant_colors": [
+                    {"name": color_name(rgb), "hex": "#%02x%02x%02x" % rgb, "share": round(share, 3)}
+                    for rgb, share in item_colors
+                ],
+                "masked": has_mask,
+            })
+        return {"items": results, "overall_style": STYLES[overall[0]].title(), "color_palette": palette}
@@ -0,0 +1,68 @@
+"""
+Resolution Buckets
+Instead of squashing every photo to 512x512, each input runs at the
+multiple-of-64 size closest to its aspect ratio within a fixed pixel budget
+(512x512 worth by default), so a wide room stays wide at about the same
+diffusion cost. The image, its masks and control maps are all resized to
+the same bucket. Outputs can be mapped back to the exact original aspect
+ratio, undoing the small aspect error the 64 px grid introduces.
+
+Environment:
+    GENERATE_BUCKET_MAX_PIXELS  pixel budget per run (default 262144 = 512x512)
+    GENERATE_BUCKET_MIN_SIDE    shortest allowed side (default 256)
+    GENERATE_BUCKET_MAX_SIDE    longest allowed side (default 1024)
+"""
+
+import math
+import os
+from functools import lru_cache
+from typing import Tuple
+
+from PIL import Image
+
+Size = Tuple[int, int]  # width, height
+
+BUCKET_MAX_PIXELS = int(os.getenv("GENERATE_BUCKET_MAX_PIXELS", str(512 * 512)))
+BUCKET_MIN_SIDE = int(os.getenv("GENERATE_BUCKET_MIN_SIDE", "256"))
+BUCKET_MAX_SIDE = int(os.getenv("GENERATE_BUCKET_MAX_SIDE", "1024"))
+
+
+@lru_cache(maxsize=64)
+def bucket_sizes(max_pixels: int, min_side: int, max_side: int, multiple: int = 64) -> Tuple[Size, ...]:
+    """All (width, height) multiples of `multiple` within the side limits and the pixel budget"""
+    sides = range(min_side, max_side + 1, multiple)
+    return tuple((w, h) for w in sides for h in sides if w * h <= max_pixels)
+
+
+def bucket_size(size: Size, max_pixels: int = BUCKET_MAX_PIXELS, min_side: int = BUCKET_MIN_SIDE,
+                max_side: int = BUCKET_MAX_SIDE, max_aspect_error: float = 0.05) -> Size:
+    """
+    Bucket for an image size: the largest bucket whose aspect ratio is within
+    max_aspect_error (log ratio, ~5%) of the image's, else the closest aspect.
+    """
+    width, height = size
+    target = math.log(width / height)
+    buckets = bucket_sizes(max_pixels, min_side, max_side)
+    errors = {b: abs(math.log(b[0] / b[1]) - target) for b in buckets}
+    close = [b for b in buckets if errors[b] <= max_aspect_error]
+    if close:
+        return max(close, key=lambda b: (b[0] * b[1], -errors[b]))
+    return min(buckets, key=lambda b: (errors[b], -b[0] * b[1]))
+
+
+def to_bucket(image: Image.Image, size: Size = None, mask: bool = False) -> Image.Image:
+    """Resize to `size` (default: the image's own bucket); masks use nearest-neighbour"""
+    size = size or bucket_size(image.size)
+    if image.size == size:
+        return image
+    return image.resize(size, Image.NEAREST if mask else Image.LANCZOS)
+
+
+def to_original_aspect(image: Image.Image, original_size: Size) -> Image.Image:
+    """Resize an output to the original aspect ratio at (about) the same pixel count"""
+    aspect = original_size[0] / original_size[1]
+    pixels = image.width * image.height
+    size = (max(1, round(math.sqrt(pixels * aspect))), max(1, round(math.sqrt(pixels / aspect))))
+    if size == image.size:
+        return image
+    return image.resize(size, Image.LANCZOS)
@@ -0,0 +1,275 @@
+"""
+ControlNet Pool
+Several SD 1.5 ControlNets condition the img2img pipeline: canny (edges),
+depth (MiDaS) and seg (ADE20K segmentation). Each one is ~1.4 GB in fp32,
+so they load the first time a request asks for them into a pool bounded by
+memory, and the least recently used ones are dropped once it is full. Right
+before each call the worker points pipeline.controlnet at the requested
+net, or at a MultiControlNet over several nets with one conditioning scale
+per net. The pipeline's DeepCache/guidance forward wrappers are installed
+on every pooled ControlNet the first time it is attached.
+
+Control maps come from ControlAnnotators: Canny is plain OpenCV; depth and
+segmentation run small estimator models, loaded on first use. Maps are
+meant to be built once per image and size via SourceCache.control_map.
+
+Environment:
+    GENERATE_CONTROLNET_POOL_MB  resident ControlNet budget (default 3000; the requested nets always load)
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Optional, Sequence, Tuple
+
+import cv2
+import numpy as np
+import torch
+from diffusers import ControlNetModel
+from diffusers.pipelines.controlnet.multicontrolnet import MultiControlNetModel
+from PIL import Image
+
+from app.models import module_nbytes
+
+CONTROLNET_MODELS = {
+    "canny": "lllyasviel/sd-controlnet-canny",
+    "depth": "lllyasviel/sd-controlnet-depth",
+    "seg": "lllyasviel/sd-controlnet-seg",
+}
+DEFAULT_CONTROLNET = "canny"
+CONTROLNET_POOL_MB = float(os.getenv("GENERATE_CONTROLNET_POOL_MB", "3000"))
+
+# Estimators behind the depth/seg maps
+MIDAS_ANNOTATORS = "lllyasviel/Annotators"  # controlnet_aux MidasDetector weights
+DPT_DEPTH_MODEL = "Intel/dpt-hybrid-midas"  # transformers fallback
+UPERNET_SEG_MODEL = "openmmlab/upernet-convnext-small"
+
+# ADE20K class colors the seg ControlNet was trained on (index = class id)
+ADE20K_PALETTE = np.array([
+    (120, 120, 120), (180, 120, 120), (6, 230, 230), (80, 50, 50), (4, 200, 3), (120, 120, 80),
+    (140, 140, 140), (204, 5, 255), (230, 230, 230), (4, 250, 7), (224, 5, 255), (235, 255, 7),
+    (150, 5, 61), (120, 120, 70), (8, 255, 51), (255, 6, 82), (143, 255, 140), (204, 255, 4),
+    (255, 51, 7), (204, 70, 3), (0, 102, 200), (61, 230, 250), (255, 6, 51), (11, 102, 255),
+    (255, 7, 71), (255, 9, 224), (9, 7, 230), (220, 220, 220), (255, 9, 92), (112, 9, 255),
+    (8, 255, 214), (7, 255, 224), (255, 184, 6), (10, 255, 71), (255, 41, 10), (7, 255, 255),
+    (224, 255, 8), (102, 8, 255), (255, 61, 6), (255, 194, 7), (255, 122, 8), (0, 255, 20),
+    (255, 8, 41), (255, 5, 153), (6, 51, 255), (235, 12, 255), (160, 150, 20), (0, 163, 255),
+    (140, 140, 140), (250, 10, 15), (20, 255, 0), (31, 255, 0), (255, 31, 0), (255, 224, 0),
+    (153, 255, 0), (0, 0, 255), (255, 71, 0), (0, 235, 255), (0, 173, 255), (31, 0, 255),
+    (11, 200, 200), (255, 82, 0), (0, 255, 245), (0, 61, 255), (0, 255, 112), (0, 255, 133),
+    (255, 0, 0), (255, 163, 0), (255, 102, 0), (194, 255, 0), (0, 143, 255), (51, 255, 0),
+    (0, 82, 255), (0, 255, 41), (0, 255, 173), (10, 0, 255), (173, 255, 0), (0, 255, 153),
+    (255, 92, 0), (255, 0, 255), (255, 0, 245), (255, 0, 102), (255, 173, 0), (255, 0, 20),
+    (255, 184, 184), (0, 31, 255), (0, 255, 61), (0, 71, 255), (255, 0, 204), (0, 255, 194),
+    (0, 255, 82), (0, 10, 255), (0, 112, 255), (51, 0, 255), (0, 194, 255), (0, 122, 255),
+    (0, 255, 163), (255, 153, 0), (0, 255, 10), (255, 112, 0), (143, 255, 0), (82, 0, 255),
+    (163, 255, 0), (255, 235, 0), (8, 184, 170), (133, 0, 255), (0, 255, 92), (184, 0, 255),
+    (255, 0, 31), (0, 184, 255), (0, 214, 255), (255, 0, 112), (92, 255, 0), (0, 224, 255),
+    (112, 224, 255), (70, 184, 160), (163, 0, 255), (153, 0, 255), (71, 255, 0), (255, 0, 163),
+    (255, 204, 0), (255, 0, 143), (0, 255, 235), (133, 255, 0), (255, 0, 235), (245, 0, 255),
+    (255, 0, 122), (255, 245, 0), (10, 190, 212), (214, 255, 0), (0, 204, 255), (20, 0, 255),
+    (255, 255, 0), (0, 153, 255), (0, 41, 255), (0, 255, 204), (41, 0, 255), (41, 255, 0),
+    (173, 0, 255), (0, 245, 255), (71, 0, 255), (122, 0, 255), (0, 255, 184), (0, 92, 255),
+    (184, 255, 0), (0, 133, 255), (255, 214, 0), (25, 194, 194), (102, 255, 0), (92, 0, 255),
+], dtype=np.uint8)
+
+
+def parse_controlnets(names: Optional[str], scales: Optional[str],
+                      default_scale: float = 1.0) -> Tuple[Tuple[str, ...], Tuple[float, ...]]:
+    """
+    ("canny,depth", "1.0,0.5") -> (("canny", "depth"), (1.0, 0.5)); without
+    scales every net gets default_scale. Raises ValueError on bad input.
+    """
+    selected = tuple(n.strip().lower() for n in (names or DEFAULT_CONTROLNET).split(",") if n.strip())
+    unknown = [n for n in selected if n not in CONTROLNET_MODELS]
+    if not selected or unknown or len(set(selected)) != len(selected):
+        raise ValueError(f"controlnets must be distinct names from {list(CONTROLNET_MODELS)}")
+    if scales is None or not scales.strip():
+        return selected, tuple(float(default_scale) for _ in selected)
+    try:
+        values = tuple(float(s) for s in scales.split(","))
+    except ValueError:
+        raise ValueError("controlnet_scales must be comma-separated numbers")
+    if len(values) != len(selected):
+        raise ValueError(f"controlnet_scales needs one value per ControlNet ({len(selected)})")
+    return selected, values
+
+
+def _add(a, b):
+    """Sum of two residuals where None means "not computed" (zero-scale window, DeepCache shallow step)"""
+    if a is None:
+        return b
+    return a if b is None else a + b
+
+
+class MultiControlNet(MultiControlNetModel):
+    """MultiControlNetModel whose residual sum tolerates nets that skipped their forward pass"""
+
+    def forward(self, sample, timestep, encoder_hidden_states, controlnet_cond, conditioning_scale,
+                *args, **kwargs):
+        kwargs["return_dict"] = False
+        down_total = mid_total = None
+        for image, scale, controlnet in zip(controlnet_cond, conditioning_scale, self.nets):
+            down, mid = controlnet(sample, timestep, encoder_hidden_states, image, scale, *args, **kwargs)
+            if down is not None:
+                down_total = down if down_total is None else [_add(a, b) for a, b in zip(down_total, down)]
+            mid_total = _add(mid_total, mid)
+        return down_total, mid_total
+
+
+class ControlNetPool:
+    """ControlNets by name, loaded on first use, least recently used dropped past max_bytes"""
+
+    def __init__(self, device: str, dtype, models: Dict[str, str] = CONTROLNET_MODELS,
+                 max_bytes: int = int(CONTROLNET_POOL_MB * 2**20), default: str = DEFAULT_CONTROLNET,
+                 configure: Optional[Callable[[torch.nn.Module], None]] = None):
+        self.device = device
+        self.dtype = dtype
+        self.models = models
+        self.max_bytes = max_bytes
+        self.default = default
+        self.configure = configure  # configure(controlnet): attention processors, memory format, ...
+        self._loaded: "OrderedDict[str, torch.nn.Module]" = OrderedDict()
+        self._sizes: Dict[str, int] = {}
+        self._lock = threading.RLock()
+        self.errors: Dict[str, str] = {}
+        self.loads = 0
+        self.evictions = 0
+
+    def get(self, name: str, keep: Sequence[str] = ()) -> torch.nn.Module:
+        """ControlNet by name; `keep` are names the eviction must not drop (the rest of the request)"""
+        with self._lock:
+            model = self._loaded.get(name)
+            if model is not None:
+                self._loaded.move_to_end(name)
+                return model
+            if name not in self.models:
+                raise ValueError(f"Unknown ControlNet '{name}'")
+            # Make room first (ControlNets of one base model are all the same size)
+            self._evict(set(keep) | {name}, incoming=max(self._sizes.values(), default=0))
+            print(f"Loading ControlNet '{name}' ({self.models[name]})...")
+            start = time.time()
+            try:
+                model = ControlNetModel.from_pretrained(self.models[name], torch_dtype=self.dtype).to(self.device)
+                if self.configure is not None:
+                    self.configure(model)
+            except Exception as e:
+                self.errors[name] = str(e)
+                print(f"⚠ Failed to load ControlNet '{name}': {e}")
+                raise
+            self.errors.pop(name, None)
+            self._loaded[name] = model
+            self._sizes[name] = module_nbytes(model)
+            self.loads += 1
+            print(f"✓ ControlNet '{name}' loaded in {time.time() - start:.1f}s "
+                  f"({self._sizes[name] / 2**20:.1f} MB, pool {self.total_bytes / 2**20:.1f} MB)")
+            return model
+
+    def apply(self, pipeline, names: Sequence[str]):
+        """Point pipeline.controlnet at the named net(s) for the next call (generation worker thread)"""
+        models = [self.get(name, keep=names) for name in names]
+        for model in models:
+            for wrap in getattr(pipeline, "controlnet_wrappers", ()):
+                wrap(model)  # no-op after the first time
+        controlnet = models[0] if len(models) == 1 else MultiControlNet(models)
+        if pipeline.controlnet is not controlnet:
+            pipeline.controlnet = controlnet
+
+    @property
+    def total_bytes(self) -> int:
+        return sum(self._sizes.values())
+
+    def _evict(self, keep: set, incoming: int = 0):
+        """Drop least recently used nets outside `keep` until `incoming` more bytes fit (lock held)"""
+        for name in list(self._loaded):
+            if self.total_bytes + incoming <= self.max_bytes:
+                break
+            if name in keep:
+                continue
+            del self._loaded[name]
+            self._sizes.pop(name, None)
+            self.evictions += 1
+            print(f"ControlNet '{name}' evicted from the pool")
+        if self.device == "cuda":
+            torch.cuda.empty_cache()
+
+    def status(self) -> dict:
+        with self._lock:
+            return {
+                "available": list(self.models),
+                "loaded": list(self._loaded),
+                "memory_mb": {name: round(size / 2**20, 1) for name, size in self._sizes.items()},
+                "total_memory_mb": round(self.total_bytes / 2**20, 1),
+                "max_memory_mb": round(self.max_bytes / 2**20, 1),
+                "loads": self.loads,
+                "evictions": self.evictions,
+                "errors": dict(self.errors),
+            }
+
+
+class ControlAnnotators:
+    """Control-map builders per ControlNet name; the depth/seg estimators load on first use"""
+
+    def __init__(self, device: str = "cpu"):
+        self.device = device
+        self._depth = None
+        self._seg = None
+        self._lock = threading.Lock()
+
+    def build(self, name: str, image: Image.Image) -> Image.Image:
+        """RGB control map for `image`, same size as the image"""
+        builders = {"canny": canny_map, "depth": self.depth_map, "seg": self.seg_map}
+        return builders[name](image)
+
+    # ---- depth ----
+    def _depth_estimator(self):
+        with self._lock:
+            if self._depth is None:
+                try:
+                    from controlnet_aux import MidasDetector
+                    midas = MidasDetector.from_pretrained(MIDAS_ANNOTATORS).to(self.device)
+                    self._depth = lambda image: midas(
+                        image, detect_resolution=min(image.size), image_resolution=min(image.size)
+                    )
+                    print("✓ MiDaS depth estimator loaded")
+                except ImportError:
+                    # Same MiDaS family through transformers when controlnet_aux is missing
+                    from transformers import pipeline as hf_pipeline
+                    dpt = hf_pipeline("depth-estimation", model=DPT_DEPTH_MODEL,
+                                      device=0 if self.device == "cuda" else -1)
+                    self._depth = lambda image: dpt(image)["depth"]
+                    print("✓ DPT depth estimator loaded (controlnet_aux not installed)")
+            return self._depth
+
+    def depth_map(self, image: Image.Image) -> Image.Image:
+        """MiDaS relative depth (near = bright), as the depth ControlNet expects"""
+        depth = self._depth_estimator()(image.convert("RGB"))
+        depth = np.array(depth.convert("L").resize(image.size, Image.BICUBIC))
+        return Image.fromarray(cv2.cvtColor(depth, cv2.COLOR_GRAY2RGB))
+
+    # ---- segmentation ----
+    def _seg_model(self):
+        with self._lock:
+            if self._seg is None:
+                from transformers import AutoImageProcessor, UperNetForSemanticSegmentation
+                processor = AutoImageProcessor.from_pretrained(UPERNET_SEG_MODEL)
+                model = UperNetForSemanticSegmentation.from_pretrained(UPERNET_SEG_MODEL).to(self.device).eval()
+                self._seg = (processor, model)
+                print("✓ UperNet segmentation model loaded")
+            return self._seg
+
+    def seg_map(self, image: Image.Image) -> Image.Image:
+        """ADE20K semantic segmentation colored with the palette the seg ControlNet was trained on"""
+        processor, model = self._seg_model()
+        inputs = processor(image.convert("RGB"), return_tensors="pt").pixel_values.to(self.device)
+        with torch.no_grad():
+            outputs = model(inputs)
+        labels = processor.post_process_semantic_segmentation(outputs, target_sizes=[image.size[::-1]])[0]
+        return Image.fromarray(ADE20K_PALETTE[labels.cpu().numpy()])
+
+
+def canny_map(image: Image.Image, low_threshold: int = 100, high_threshold: int = 200) -> Image.Image:
+    """Canny edge control image (3-channel)"""
+    edges = cv2.Canny(np.array(image), low_threshold, high_threshold)
+    return Image.fromarray(cv2.cvtColor(edges, cv2.COLOR_GRAY2RGB))
@@ -0,0 +1,102 @@
+"""
+CPU Execution Profile
+Attention/VAE slicing save VRAM but only slow CPU inference down, so on CPU
+the pipelines instead get: no slicing, PyTorch SDPA attention, channels_last
+UNet/ControlNet/VAE, bfloat16 autocast where the CPU has native bf16
+(AVX512-BF16 / AMX), optional torch.compile of the UNet, and explicit
+intra/inter-op thread counts.
+
+Environment:
+    GENERATE_CPU_PROFILE           1 (default) / 0 = legacy slicing setup
+    GENERATE_CPU_BF16              auto (default) / 1 / 0
+    GENERATE_TORCH_COMPILE         0 (default) / 1
+    GENERATE_TORCH_THREADS         intra-op threads (0 = torch default)
+    GENERATE_TORCH_INTEROP_THREADS inter-op threads (0 = torch default)
+"""
+
+import contextlib
+import os
+
+import torch
+from diffusers.models.attention_processor import AttnProcessor2_0
+
+
+def cpu_supports_bf16() -> bool:
+    """Native bf16 matmul support (x86 AVX512-BF16 or AMX); emulated bf16 is slower than fp32"""
+    try:
+        with open("/proc/cpuinfo") as f:
+            flags = f.read()
+    except OSError:
+        return False
+    return "avx512_bf16" in flags or "amx_bf16" in flags
+
+
+def env_flag(name: str, default: str) -> str:
+    return os.getenv(name, default).strip().lower()
+
+
+class CpuProfile:
+    """Which CPU optimizations apply, and the hooks that apply them"""
+
+    def __init__(self, enabled: bool, bf16: bool = False, compile_unet: bool = False,
+                 threads: int = 0, interop_threads: int = 0):
+        self.enabled = enabled
+        self.bf16 = enabled and bf16
+        self.compile_unet = enabled and compile_unet
+        self.threads = threads
+        self.interop_threads = interop_threads
+
+    @classmethod
+    def from_env(cls, device: str) -> "CpuProfile":
+        enabled = device == "cpu" and env_flag("GENERATE_CPU_PROFILE", "1") in ("1", "true", "yes")
+        bf16 = env_flag("GENERATE_CPU_BF16", "auto")
+        return cls(
+            enabled=enabled,
+            bf16=cpu_supports_bf16() if bf16 == "auto" else bf16 in ("1", "true", "yes"),
+            compile_unet=env_flag("GENERATE_TORCH_COMPILE", "0") in ("1", "true", "yes"),
+            threads=int(os.getenv("GENERATE_TORCH_THREADS", "0")),
+            interop_threads=int(os.getenv("GENERATE_TORCH_INTEROP_THREADS", "0")),
+        )
+
+    def apply_threads(self):
+        """Call once at startup, before any torch work runs"""
+        if self.threads > 0:
+            torch.set_num_threads(self.threads)
+        if self.interop_threads > 0:
+            try:
+                torch.set_num_interop_threads(self.interop_threads)
+            except RuntimeError as e:  # only settable before the first parallel op
+                print(f"⚠ Could not set inter-op threads: {e}")
+
+    def configure(self, pipeline):
+        """SDPA + channels_last for one pipeline; replaces slicing on CPU"""
+        for name in ("unet", "controlnet", "vae"):
+            module = getattr(pipeline, name, None)
+            if module is not None:
+                self.configure_module(module)
+
+    def configure_module(self, module):
+        """SDPA + channels_last for one model (also used for ControlNets loaded after the pipeline)"""
+        if hasattr(module, "set_attn_processor"):
+            module.set_attn_processor(AttnProcessor2_0())
+        module.to(memory_format=torch.channels_last)
+
+    def compile(self, pipeline):
+        """torch.compile the UNet if enabled - last, after attention processors are final"""
+        if self.compile_unet:
+            pipeline.unet = torch.compile(pipeline.unet)
+
+    def autocast(self):
+        """Context for one pipeline call (autocast is thread-local: enter it on the worker thread)"""
+        if self.bf16:
+            return torch.autocast("cpu", dtype=torch.bfloat16)
+        return contextlib.nullcontext()
+
+    def describe(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "bf16_autocast": self.bf16,
+            "torch_compile": self.compile_unet,
+            "threads": torch.get_num_threads(),
+            "interop_threads": torch.get_num_interop_threads(),
+        }
@@ -0,0 +1,151 @@
+"""
+DeepCache
+Adjacent denoising steps produce nearly identical deep UNet features. With
+a cache interval N, every N-th step runs the full UNet and keeps the output
+of the second-to-last up block; the steps in between only run the shallow
+path (conv_in -> down_blocks[0] -> cached features -> up_blocks[-1] ->
+conv_out), which skips the down/mid/up blocks where most of the compute is.
+The ControlNet gets the same treatment: on shallow steps only the residuals
+the shallow path consumes are computed.
+
+Works for the SD 1.x img2img+ControlNet and inpainting UNets (same block
+layout; the inpainting UNet just takes 9 input channels). Installed below
+the GuidanceController so CFG truncation still halves the batch first;
+cached features are sliced to the conditional half when that happens.
+"""
+
+import weakref
+
+import torch
+from diffusers.models.unet_2d_condition import UNet2DConditionOutput
+
+
+def time_embedding(model, sample, timestep, timestep_cond=None):
+    """Timestep embedding exactly as UNet2DConditionModel / ControlNetModel compute it"""
+    timesteps = timestep
+    if not torch.is_tensor(timesteps):
+        timesteps = torch.tensor([timesteps], device=sample.device)
+    elif timesteps.dim() == 0:
+        timesteps = timesteps[None].to(sample.device)
+    timesteps = timesteps.expand(sample.shape[0])
+    t_emb = model.time_proj(timesteps).to(dtype=sample.dtype)
+    return model.time_embedding(t_emb, timestep_cond)
+
+
+def run_first_down_block(model, hidden, emb, encoder_hidden_states, cross_attention_kwargs):
+    block = model.down_blocks[0]
+    if getattr(block, "has_cross_attention", False):
+        return block(hidden_states=hidden, temb=emb, encoder_hidden_states=encoder_hidden_states,
+                     cross_attention_kwargs=cross_attention_kwargs)
+    return block(hidden_states=hidden, temb=emb)
+
+
+class DeepCacheController:
+    """Per-pipeline feature cache + forward wrappers; interval 0/1 = disabled (pass-through)"""
+
+    def __init__(self, pipeline):
+        self.interval = 0
+        self.step = 0
+        self.cached = None  # output of unet.up_blocks[-2] from the last full step
+        self._capturing = False
+        self._wrapped_controlnets = weakref.WeakSet()
+        unet = pipeline.unet
+        self._skip_count = len(unet.up_blocks[-1].resnets)  # residuals the last up block consumes
+        unet.up_blocks[-2].register_forward_hook(self._capture)
+        self._wrap_unet(unet)
+        if getattr(pipeline, "controlnet", None) is not None:
+            self.wrap_controlnet(pipeline.controlnet)
+
+    # ---- per call (worker thread) ----
+    def start(self, interval):
+        self.interval = int(interval or 0)
+        self.step = 0
+        self.cached = None
+
+    def finish(self):
+        self.interval = 0
+        self.cached = None
+
+    def shallow_step(self) -> bool:
+        return self.interval > 1 and self.cached is not None and self.step % self.interval != 0
+
+    def _capture(self, module, inputs, output):
+        if self._capturing:
+            self.cached = output
+
+    def _skip_residuals(self, conv_in_out, block_res):
+        """Skip connections of the last up block: conv_in output + down_blocks[0] resnet outputs"""
+        return ((conv_in_out,) + tuple(block_res))[:self._skip_count]
+
+    def _cached_for(self, batch: int):
+        # CFG truncation halves the batch after the cache was filled: keep the conditional half
+        return self.cached if self.cached.shape[0] == batch else self.cached[-batch:]
+
+    # ---- wrappers ----
+    def _wrap_unet(self, unet):
+        original = unet.forward
+
+        def forward(sample, timestep, encoder_hidden_states=None, *args, **kwargs):
+            if self.shallow_step():
+                output = self._shallow_unet(unet, sample, timestep, encoder_hidden_states, **kwargs)
+            else:
+                self._capturing = self.interval > 1
+                try:
+                    output = original(sample, timestep, encoder_hidden_states, *args, **kwargs)
+                finally:
+                    self._capturing = False
+            self.step += 1
+            return output
+
+        unet.forward = forward
+
+    def _shallow_unet(self, unet, sample, timestep, encoder_hidden_states, timestep_cond=None,
+                      cross_attention_kwargs=None, down_block_additional_residuals=None,
+                      return_dict=True, **_):
+        emb = time_embedding(unet, sample, timestep, timestep_cond)
+        hidden = unet.conv_in(sample)
+        _, block_res = run_first_down_block(unet, hidden, emb, encoder_hidden_states, cross_attention_kwargs)
+        skip = self._skip_residuals(hidden, block_res)
+        if down_block_additional_residuals is not None:
+            skip = tuple(s + r for s, r in zip(skip, down_block_additional_residuals[:len(skip)]))
+
+        up = unet.up_blocks[-1]
+        cached = self._cached_for(sample.shape[0])
+        if getattr(up, "has_cross_attention", False):
+            hidden = up(hidden_states=cached, temb=emb, res_hidden_states_tuple=skip,
+                        encoder_hidden_states=encoder_hidden_states, cross_attention_kwargs=cross_attention_kwargs)
+        else:
+            hidden = up(hidden_states=cached, temb=emb, res_hidden_states_tuple=skip)
+
+        if unet.conv_norm_out is not None:
+            hidden = unet.conv_act(unet.conv_norm_out(hidden))
+        hidden = unet.conv_out(hidden)
+        return UNet2DConditionOutput(sample=hidden) if return_dict else (hidden,)
+
+    def wrap_controlnet(self, controlnet):
+        """Install the wrapper on a ControlNet (once per model; pooled ControlNets arrive later)"""
+        if controlnet in self._wrapped_controlnets:
+            return
+        self._wrapped_controlnets.add(controlnet)
+        original = controlnet.forward
+
+        def forward(sample, timestep, encoder_hidden_states=None, controlnet_cond=None, conditioning_scale=1.0,
+                    *args, **kwargs):
+            if self.shallow_step():
+                return self._shallow_controlnet(controlnet, sample, timestep, encoder_hidden_states,
+                                                controlnet_cond, conditioning_scale, **kwargs)
+            return original(sample, timestep, encoder_hidden_states, controlnet_cond, conditioning_scale,
+                            *args, **kwargs)
+
+        controlnet.forward = forward
+
+    def _shallow_controlnet(self, controlnet, sample, timestep, encoder_hidden_states, controlnet_cond,
+                            conditioning_scale=1.0, timestep_cond=None, cross_attention_kwargs=None, **_):
+        """Only the residuals the shallow UNet path adds; the rest are None"""
+        emb = time_embedding(controlnet, sample, timestep, timestep_cond)
+        hidden = controlnet.conv_in(sample) + controlnet.controlnet_cond_embedding(controlnet_cond)
+        _, block_res = run_first_down_block(controlnet, hidden, emb, encoder_hidden_states, cross_attention_kwargs)
+        residuals = self._skip_residuals(hidden, block_res)
+        down = [zero_conv(r) * conditioning_scale for r, zero_conv in zip(residuals, controlnet.controlnet_down_blocks)]
+        down += [None] * (len(controlnet.controlnet_down_blocks) - len(down))
+        return down, None
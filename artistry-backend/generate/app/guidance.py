@@ -0,0 +1,113 @@
+"""
+Guidance Windows
+Late denoising steps mostly refine texture, where classifier-free guidance
+and ControlNet add little. Two cheap cuts:
+
+- CFG truncation: after `cfg_end` of the steps the UNet (and ControlNet)
+  only run the conditional half of the CFG batch; the output is duplicated
+  so the pipeline's guidance formula reduces to the conditional prediction.
+  Those steps cost about half.
+- ControlNet windows: diffusers' control_guidance_start/end zero the
+  ControlNet scale outside the window but still run the ControlNet; the
+  wrapper skips the forward pass entirely when the scale is 0.
+
+GuidanceController wraps the pipeline's unet/controlnet forward once at
+load time; the worker arms it per call and advances it from the step
+callback. Unarmed, the wrappers are pass-through.
+"""
+
+import weakref
+
+import torch
+
+
+def _is_zero_scale(scale) -> bool:
+    if isinstance(scale, (list, tuple)):
+        return all(float(s) == 0.0 for s in scale)
+    return float(scale) == 0.0
+
+
+class GuidanceController:
+    """Per-pipeline CFG truncation state + forward wrappers"""
+
+    def __init__(self, pipeline):
+        self.cfg_end = 1.0
+        self.total_steps = 0
+        self.cond_only = False  # True once CFG is truncated for the current call
+        self._wrapped_controlnets = weakref.WeakSet()
+        self._wrap_unet(pipeline.unet)
+        if getattr(pipeline, "controlnet", None) is not None:
+            self.wrap_controlnet(pipeline.controlnet)
+
+    # ---- per call (worker thread) ----
+    def start(self, cfg_end, total_steps: int):
+        self.cfg_end = 1.0 if cfg_end is None else max(0.0, min(1.0, float(cfg_end)))
+        self.total_steps = total_steps
+        self.cond_only = self.cfg_end <= 0.0
+
+    def after_step(self, step: int):
+        """Called with the number of finished steps; arms truncation for the following ones"""
+        if not self.cond_only and self.cfg_end < 1.0 and step >= self.cfg_end * self.total_steps:
+            self.cond_only = True
+
+    def finish(self):
+        self.cond_only = False
+
+    @property
+    def active(self) -> bool:
+        return self.cfg_end < 1.0
+
+    # ---- wrappers ----
+    @staticmethod
+    def _cond_half(value, batch: int):
+        """Second (conditional) half of a CFG-doubled tensor; anything else unchanged"""
+        if isinstance(value, torch.Tensor) and value.dim() > 0 and value.shape[0] == batch:
+            return value[batch // 2:]
+        return value
+
+    def _wrap_unet(self, unet):
+        original = unet.forward
+
+        def forward(sample, timestep, encoder_hidden_states=None, *args, **kwargs):
+            batch = sample.shape[0]
+            if not self.cond_only or batch % 2:
+                return original(sample, timestep, encoder_hidden_states, *args, **kwargs)
+            half = lambda value: self._cond_half(value, batch)  # noqa: E731
+            if kwargs.get("down_block_additional_residuals") is not None:
+                kwargs["down_block_additional_residuals"] = [half(r) for r in kwargs["down_block_additional_residuals"]]
+            if kwargs.get("mid_block_additional_residual") is not None:
+                kwargs["mid_block_additional_residual"] = half(kwargs["mid_block_additional_residual"])
+            output = original(half(sample), half(timestep), half(encoder_hidden_states), *args, **kwargs)
+            # Duplicate so uncond == cond and the CFG formula yields the conditional prediction
+            if isinstance(output, tuple):
+                return (torch.cat([output[0], output[0]]),) + output[1:]
+            output.sample = torch.cat([output.sample, output.sample])
+            return output
+
+        unet.forward = forward
+
+    def wrap_controlnet(self, controlnet):
+        """Install the wrapper on a ControlNet (once per model; pooled ControlNets arrive later)"""
+        if controlnet in self._wrapped_controlnets:
+            return
+        self._wrapped_controlnets.add(controlnet)
+        original = controlnet.forward
+
+        def forward(sample, timestep, encoder_hidden_states=None, controlnet_cond=None, conditioning_scale=1.0,
+                    *args, **kwargs):
+            if _is_zero_scale(conditioning_scale):
+                # Outside the guidance window: no residuals instead of zero-scaled ones
+                return None, None
+            batch = sample.shape[0]
+            if not self.cond_only or batch % 2:
+                return original(sample, timestep, encoder_hidden_states, controlnet_cond, conditioning_scale,
+                                *args, **kwargs)
+            half = lambda value: self._cond_half(value, batch)  # noqa: E731
+            cond = [half(c) for c in controlnet_cond] if isinstance(controlnet_cond, list) else half(controlnet_cond)
+            down, mid = original(half(sample), half(timestep), half(encoder_hidden_states), cond, conditioning_scale,
+                                 *args, **{**kwargs, "return_dict": False})
+            # DeepCache shallow steps return None for the residuals they don't compute
+            duplicate = lambda value: None if value is None else torch.cat([value, value])  # noqa: E731
+            return [duplicate(d) for d in down], duplicate(mid)
+
+        controlnet.forward = forward
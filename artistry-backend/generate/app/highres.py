@@ -0,0 +1,144 @@
+"""
+High-Resolution Output
+Diffusion at 1024+ px on CPU is slow and memory-hungry (attention cost grows
+with the square of the token count), so high-res mode never runs the UNet
+above its native tile size:
+
+1. generate at the base resolution bucket as usual,
+2. upscale (Lanczos) to the target size,
+3. refine with low-strength img2img + ControlNet on overlapping native-size
+   tiles - equal-sized tiles queue as separate tasks and get batched by the
+   generation worker - keeping each tile's result as latents,
+4. blend the tile latents with linear ramps across the overlaps,
+5. VAE-decode the full latent canvas in overlapping tiles, again blended
+   with ramps, so peak decode memory is one tile per worker thread. Tiles
+   decode one after another by default: each decode already uses torch's
+   full intra-op thread pool, so parallel tiles only oversubscribe the
+   cores (GENERATE_VAE_TILE_WORKERS opts in, e.g. with few torch threads).
+
+Environment:
+    GENERATE_HIGHRES_MAX_SIDE     cap for the upscaled long side (default 2048)
+    GENERATE_HIGHRES_TILE         refinement tile side in px (default 512)
+    GENERATE_HIGHRES_OVERLAP      refinement tile overlap in px (default 64)
+    GENERATE_HIGHRES_STRENGTH     refinement denoise strength (default 0.3)
+    GENERATE_VAE_TILE             VAE decode tile side in latent px (default 64 = 512 px)
+    GENERATE_VAE_TILE_OVERLAP     VAE decode overlap in latent px (default 8)
+    GENERATE_VAE_TILE_WORKERS     parallel tile decodes (default 1)
+"""
+
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Sequence, Tuple
+
+import torch
+
+Box = Tuple[int, int, int, int]  # x1, y1, x2, y2 (exclusive)
+
+HIGHRES_MAX_SIDE = int(os.getenv("GENERATE_HIGHRES_MAX_SIDE", "2048"))
+HIGHRES_TILE = int(os.getenv("GENERATE_HIGHRES_TILE", "512"))
+HIGHRES_OVERLAP = int(os.getenv("GENERATE_HIGHRES_OVERLAP", "64"))
+HIGHRES_STRENGTH = float(os.getenv("GENERATE_HIGHRES_STRENGTH", "0.3"))
+VAE_TILE = int(os.getenv("GENERATE_VAE_TILE", "64"))
+VAE_TILE_OVERLAP = int(os.getenv("GENERATE_VAE_TILE_OVERLAP", "8"))
+
+
+def default_decode_workers() -> int:
+    """Tile decode threads: 1 unless configured (torch already parallelizes each decode across cores)"""
+    return max(1, int(os.getenv("GENERATE_VAE_TILE_WORKERS", "1")))
+
+
+def highres_size(size: Tuple[int, int], scale: float, max_side: int = HIGHRES_MAX_SIDE,
+                 multiple: int = 64) -> Tuple[int, int]:
+    """Upscaled (width, height): `scale` times the base size, long side capped, multiples of 64"""
+    width, height = size
+    scale = min(scale, max_side / max(width, height))
+    return (
+        max(multiple, round(width * scale / multiple) * multiple),
+        max(multiple, round(height * scale / multiple) * multiple),
+    )
+
+
+def tile_starts(length: int, tile: int, overlap: int, align: int = 1) -> List[int]:
+    """Evenly spaced tile offsets (multiples of `align`) along one axis: same-size tiles, >= `overlap` shared"""
+    if length <= tile:
+        return [0]
+    count = max(2, math.ceil((length - overlap) / max(1, tile - overlap)))
+    return [min(length - tile, round(i * (length - tile) / (count - 1) / align) * align) for i in range(count)]
+
+
+def tile_boxes(size: Tuple[int, int], tile: int, overlap: int, align: int = 1) -> List[Box]:
+    """Equal-sized overlapping tiles covering a (width, height) area"""
+    width, height = size
+    tile_w, tile_h = min(tile, width), min(tile, height)
+    return [
+        (x, y, x + tile_w, y + tile_h)
+        for y in tile_starts(height, tile_h, overlap, align)
+        for x in tile_starts(width, tile_w, overlap, align)
+    ]
+
+
+def ramp_weights(box: Box, size: Tuple[int, int], overlap: int) -> torch.Tensor:
+    """
+    (h, w) blend weights for one tile: linear ramp over `overlap` px on every
+    side that borders another tile, flat 1 on sides at the image border.
+    """
+    x1, y1, x2, y2 = box
+    width, height = size
+
+    def axis(length, start, end, total):
+        position = torch.arange(length, dtype=torch.float32)
+        ramp = torch.ones(length)
+        if overlap > 0:
+            if start > 0:
+                ramp = torch.minimum(ramp, (position + 1) / (overlap + 1))
+            if end < total:
+                ramp = torch.minimum(ramp, (length - position) / (overlap + 1))
+        return ramp
+
+    return axis(y2 - y1, y1, y2, height)[:, None] * axis(x2 - x1, x1, x2, width)[None, :]
+
+
+def blend_tiles(tiles: Sequence[torch.Tensor], boxes: Sequence[Box], size: Tuple[int, int],
+                overlap: int) -> torch.Tensor:
+    """Weighted average of (1, C, h, w) tiles placed at `boxes` on a (1, C, H, W) canvas"""
+    width, height = size
+    first = tiles[0]
+    canvas = torch.zeros((1, first.shape[1], height, width), dtype=torch.float32, device=first.device)
+    total = torch.zeros((1, 1, height, width), dtype=torch.float32, device=first.device)
+    for tile, box in zip(tiles, boxes):
+        x1, y1, x2, y2 = box
+        weight = ramp_weights(box, size, overlap).to(first.device)[None, None]
+        canvas[:, :, y1:y2, x1:x2] += tile.float().reshape(1, -1, y2 - y1, x2 - x1) * weight
+        total[:, :, y1:y2, x1:x2] += weight
+    return (canvas / total.clamp(min=1e-6)).to(first.dtype)
+
+
+def latent_boxes(boxes: Sequence[Box], scale: int = 8) -> List[Box]:
+    return [tuple(v // scale for v in box) for box in boxes]
+
+
+def tiled_vae_decode(vae, latents: torch.Tensor, tile: int = VAE_TILE, overlap: int = VAE_TILE_OVERLAP,
+                     workers: int = 1) -> torch.Tensor:
+    """
+    Decode scaled (1, 4, h, w) latents in overlapping tiles; returns the
+    (1, 3, 8h, 8w) image tensor in [-1, 1] like vae.decode(...).sample.
+    """
+    _, _, height, width = latents.shape
+    boxes = tile_boxes((width, height), tile, overlap)
+    scaled = latents.to(vae.dtype) / vae.config.scaling_factor
+
+    def decode(box):
+        x1, y1, x2, y2 = box
+        with torch.no_grad():
+            return vae.decode(scaled[:, :, y1:y2, x1:x2], return_dict=False)[0]
+
+    if workers > 1 and len(boxes) > 1:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            decoded = list(pool.map(decode, boxes))
+    else:
+        decoded = [decode(box) for box in boxes]
+
+    factor = decoded[0].shape[-1] // (boxes[0][2] - boxes[0][0])
+    pixel_boxes = [tuple(v * factor for v in box) for box in boxes]
+    return blend_tiles(decoded, pixel_boxes, (width * factor, height * factor), overlap * factor)
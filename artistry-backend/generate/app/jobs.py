@@ -0,0 +1,143 @@
+"""
+Generation Jobs
+Submit/poll/cancel wrapper around the generation worker so long CPU runs do
+not have to hold an HTTP connection open. Cancellation is cooperative: the
+worker checks the job's cancel flag from the diffusion step callback and
+between passes. Finished results are kept for a TTL; jobs nobody polls any
+more are treated as abandoned and cancelled. While a client streams a job,
+every K-th step also produces a cheap latent preview.
+"""
+
+import threading
+import time
+import uuid
+from contextvars import ContextVar
+from typing import Any, Dict, Optional
+
+from app.worker import GenerationCancelled
+from app.previews import preview_data_url
+
+ACTIVE_STATUSES = {"queued", "running"}
+TERMINAL_STATUSES = {"completed", "failed", "cancelled"}
+
+# Job whose pipeline calls are being made in the current asyncio task
+current_job: ContextVar[Optional["Job"]] = ContextVar("current_job", default=None)
+
+
+class Job:
+    """One generation request and everything a poller needs to know about it"""
+
+    def __init__(self, kind: str):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.status = "queued"
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+        self.last_polled = self.created_at
+        self.result: Any = None
+        self.error: Optional[str] = None
+        self.cancel_event = threading.Event()
+        self.current_task = None  # worker task currently queued/running for this job
+        self.passes_started = 0
+        self.progress = {"step": 0, "total_steps": 0, "eta_seconds": None}
+        self.preview_every = 0  # set by a streaming client; 0 = no previews
+        self.preview: Optional[Dict] = None  # latest {"pass", "step", "total_steps", "image"}
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancel_event.is_set()
+
+    def check_cancelled(self):
+        """Raise between passes if the job was cancelled"""
+        if self.cancel_event.is_set():
+            raise GenerationCancelled(f"Job {self.id} cancelled")
+
+    def on_step(self, step: int, total_steps: int, latents=None):
+        """Progress hook called from the worker thread after each denoising step"""
+        self.status = "running"
+        # ETA for the current pass from its average step time so far
+        eta = None
+        task = self.current_task
+        if task is not None and task.started_at is not None:
+            eta = round((time.time() - task.started_at) / step * (total_steps - step), 1)
+        self.progress = {"step": step, "total_steps": total_steps, "eta_seconds": eta}
+
+        if self.preview_every > 0 and latents is not None and (step % self.preview_every == 0 or step == total_steps):
+            try:
+                self.preview = {"pass": self.passes_started, "step": step, "total_steps": total_steps,
+                                "image": preview_data_url(latents)}
+            except Exception as e:
+                print(f"⚠ Preview failed for job {self.id}: {e}")
+
+    def finish(self, status: str, result: Any = None, error: Optional[str] = None):
+        self.status = status
+        self.result = result
+        self.error = error
+        self.finished_at = time.time()
+        self.current_task = None
+
+    def to_dict(self, queue_position: Optional[int] = None) -> Dict:
+        return {
+            "job_id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "queue_position": queue_position,
+            "pass": self.passes_started,
+            "progress": self.progress,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+            "error": self.error,
+        }
+
+
+class JobStore:
+    """In-memory job registry with result TTL and abandoned-job reaping"""
+
+    def __init__(self, result_ttl: float = 3600.0, abandon_timeout: float = 120.0):
+        self.result_ttl = result_ttl
+        self.abandon_timeout = abandon_timeout  # 0 disables abandonment
+        self._jobs: Dict[str, Job] = {}
+        self._lock = threading.Lock()
+
+    def create(self, kind: str) -> Job:
+        job = Job(kind)
+        with self._lock:
+            self._jobs[job.id] = job
+        return job
+
+    def get(self, job_id: str, touch: bool = True) -> Optional[Job]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is not None and touch:
+            job.last_polled = time.time()
+        return job
+
+    def cancel(self, job_id: str) -> Optional[Job]:
+        job = self.get(job_id)
+        if job is not None and job.status in ACTIVE_STATUSES:
+            job.cancel_event.set()
+        return job
+
+    def prune(self) -> Dict[str, int]:
+        """Drop expired results and cancel jobs whose caller stopped polling"""
+        now = time.time()
+        expired, abandoned = 0, 0
+        with self._lock:
+            for job_id, job in list(self._jobs.items()):
+                if job.status in TERMINAL_STATUSES and now - job.finished_at > self.result_ttl:
+                    del self._jobs[job_id]
+                    expired += 1
+                elif (job.status in ACTIVE_STATUSES and self.abandon_timeout > 0
+                      and not job.cancelled and now - job.last_polled > self.abandon_timeout):
+                    job.cancel_event.set()
+                    abandoned += 1
+        if abandoned:
+            print(f"⚠ Cancelled {abandoned} abandoned generation job(s)")
+        return {"expired": expired, "abandoned": abandoned}
+
+    def counts(self) -> Dict[str, int]:
+        with self._lock:
+            counts: Dict[str, int] = {}
+            for job in self._jobs.values():
+                counts[job.status] = counts.get(job.status, 0) + 1
+            return counts
@@ -1,21 +1,41 @@
-from fastapi import FastAPI, File, UploadFile, Form
+from fastapi import FastAPI, File, UploadFile, Form, HTTPException, Request
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from diffusers import (
-    StableDiffusionControlNetImg2ImgPipeline, 
-    StableDiffusionInpaintPipeline,
-    ControlNetModel, 
-    EulerAncestralDiscreteScheduler
-)
+from fastapi.responses import Response, StreamingResponse
+from pydantic import BaseModel, ValidationError
+from diffusers import EulerAncestralDiscreteScheduler
 import torch, base64, io
-from PIL import Image
-import numpy as np
-import cv2  # for real Canny edge detection
+from PIL import Image, ImageChops
 from typing import Optional, List, Dict
-import httpx
 import os
+import time
 import gc
+import json
+import asyncio
 from functools import lru_cache
+from contextlib import asynccontextmanager
+from app.worker import GenerationWorker, GenerationCancelled
+from app.jobs import Job, JobStore, current_job, TERMINAL_STATUSES
+from app.prompt_cache import PromptEmbeddingCache
+from app.source_cache import SourceCache
+from app.roi_inpaint import fit_canvas, plan_roi, blend_roi
+from app.regional import RegionalPrompts, install_regional_attention
+from app.tiers import QUALITY_TIERS, SchedulerPool, tier_steps, tier_deepcache_interval, random_seed
+from app.models import PipelineRegistry
+from app.cpu_profile import CpuProfile
+from app.guidance import GuidanceController
+from app.deepcache import DeepCacheController
+from app.controlnets import CONTROLNET_MODELS, DEFAULT_CONTROLNET, ControlNetPool, ControlAnnotators, parse_controlnets
+from app.attributes import OutputAnalyzer, ZeroShotScorer
+from app.result_cache import ResultCache, content_hash, request_key
+from app.highres import (
+    HIGHRES_TILE, HIGHRES_OVERLAP, HIGHRES_STRENGTH, highres_size, tile_boxes, latent_boxes, blend_tiles,
+    default_decode_workers
+)
+from app.output import (
+    OutputStore, RESPONSE_FORMATS, normalize_format, encode_image, to_data_url, from_data_url
+)
+from app.buckets import BUCKET_MAX_PIXELS, BUCKET_MIN_SIDE, BUCKET_MAX_SIDE, to_bucket, to_original_aspect
 
 app = FastAPI(title="Stable Diffusion + ControlNet Service (Optimized)")
 
@@ -33,79 +53,282 @@ device = "cuda" if torch.cuda.is_available() else "cpu"
 
 # Model identifiers
 base_model = "runwayml/stable-diffusion-v1-5"
-controlnet_canny = "lllyasviel/sd-controlnet-canny"
-controlnet_depth = "lllyasviel/sd-controlnet-depth"
+inpaint_model = "runwayml/stable-diffusion-inpainting"
+controlnet_canny = CONTROLNET_MODELS["canny"]  # depth/seg ControlNets load into the pool on first use
 
 # Determine dtype based on device (CPU needs float32, GPU can use float16)
 dtype = torch.float16 if device == "cuda" else torch.float32
 
-# Initialize as None - will load on startup
-pipe = None
-inpaint_pipe = None  # Separate pipeline for inpainting
-controlnet_models = {}
+# CPU execution profile (no slicing, SDPA, channels_last, bf16 autocast, threads)
+cpu_profile = CpuProfile.from_env(device)
+cpu_profile.apply_threads()
+
+def configure_pipeline(mode: str, pipeline):
+    """Per-pipeline optimizations, applied once when a mode's pipeline is built"""
+    if mode == "img2img":
+        pipeline.scheduler = EulerAncestralDiscreteScheduler.from_config(pipeline.scheduler.config)
+    
+    if cpu_profile.enabled:
+        # Slicing only saves VRAM; on CPU it costs speed
+        cpu_profile.configure(pipeline)
+    else:
+        pipeline.enable_attention_slicing()  # Helps reduce memory usage
+        
+        # Enable VAE slicing for lower VRAM usage
+        pipeline.enable_vae_slicing()
+    
+    # Enable CUDA optimizations if available
+    if device == "cuda":
+        torch.backends.cudnn.benchmark = True
+        # Enable memory efficient attention (xformers alternative)
+        try:
+            pipeline.enable_xformers_memory_efficient_attention()
+            print("✓ xformers memory efficient attention enabled")
+        except:
+            print("⚠ xformers not available, using default attention")
+    
+    # DeepCache feature reuse - wrapped first so CFG truncation (below) halves the batch before it
+    pipeline.deepcache = DeepCacheController(pipeline)
+    
+    # CFG truncation / ControlNet window skipping (pass-through unless a call arms it)
+    pipeline.guidance_controller = GuidanceController(pipeline)
+    
+    if mode == "img2img":
+        # Same wrappers (same order) for every ControlNet the pool attaches later
+        pipeline.controlnet_wrappers = [pipeline.deepcache.wrap_controlnet, pipeline.guidance_controller.wrap_controlnet]
+    
+    if mode == "inpaint":
+        # Regional prompts for single-pass multi-item inpainting (wraps the processors set above)
+        install_regional_attention(pipeline.unet)
+    
+    cpu_profile.compile(pipeline)
+
+def configure_controlnet(controlnet):
+    """Attention/memory-format setup for a pooled ControlNet (the pipeline-level setup only saw the first one)"""
+    if cpu_profile.enabled:
+        cpu_profile.configure_module(controlnet)
+    elif device == "cuda":
+        try:
+            controlnet.enable_xformers_memory_efficient_attention()
+        except Exception:
+            pass
+
+# canny/depth/seg ControlNets, loaded on first use, LRU within GENERATE_CONTROLNET_POOL_MB
+controlnet_pool = ControlNetPool(device, dtype, configure=configure_controlnet)
+# Canny/MiDaS/UperNet control-map builders (estimators load on first use)
+control_annotators = ControlAnnotators(device)
+
+# Shared VAE/text encoder/tokenizer/safety checker; img2img and inpaint pipelines built on first use
+pipelines = PipelineRegistry(
+    device, dtype,
+    base_model=base_model,
+    inpaint_model=inpaint_model,
+    controlnet_model=controlnet_canny,
+    configure=configure_pipeline,
+    controlnet_pool=controlnet_pool
+)
+# Modes to build at startup instead of on first request, e.g. "img2img,inpaint"
+PRELOAD_MODES = [m.strip() for m in os.getenv("GENERATE_PRELOAD", "").split(",") if m.strip()]
+
+def get_pipeline(mode: str):
+    """Pipeline for a worker mode (only the generation worker thread calls this)"""
+    # "decode" uses the img2img pipeline's VAE to turn latents into images
+    return pipelines.get("img2img" if mode == "decode" else mode)
+
+# Text embeddings for repeated prompts (0 disables the cache)
+PROMPT_CACHE_SIZE = int(os.getenv("GENERATE_PROMPT_CACHE_SIZE", "128"))
+prompt_cache = PromptEmbeddingCache(PROMPT_CACHE_SIZE) if PROMPT_CACHE_SIZE > 0 else None
+
+# Source latents + control maps per (image hash, resize target); 0 disables the cache
+SOURCE_CACHE_MB = float(os.getenv("GENERATE_SOURCE_CACHE_MB", "256"))
+source_cache = SourceCache(int(SOURCE_CACHE_MB * 2**20)) if SOURCE_CACHE_MB > 0 else None
+
+# All diffusion runs go through one worker thread that owns the pipelines,
+# so endpoints never block the event loop and compatible requests get batched
+generation_worker = GenerationWorker(
+    get_pipeline,
+    max_batch_size=int(os.getenv("GENERATE_MAX_BATCH_SIZE", "2")),
+    batch_window=float(os.getenv("GENERATE_BATCH_WINDOW_MS", "50")) / 1000,
+    prompt_cache=prompt_cache,
+    source_cache=source_cache,
+    scheduler_pool=SchedulerPool(),
+    execution_context=cpu_profile.autocast,
+    vae_tile_workers=default_decode_workers(),
+    controlnet_pool=controlnet_pool
+)
+
+# Encoded responses of seeded requests on local disk, LRU by size (0 disables the cache)
+RESULT_CACHE_MB = float(os.getenv("GENERATE_RESULT_CACHE_MB", "512"))
+RESULT_CACHE_DIR = os.getenv("GENERATE_RESULT_CACHE_DIR", os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "result_cache"))
+result_cache = ResultCache(RESULT_CACHE_DIR, int(RESULT_CACHE_MB * 2**20)) if RESULT_CACHE_MB > 0 else None
+# Part of every result key; bump GENERATE_MODEL_VERSION when weights change under the same model ids
+MODEL_VERSION = "|".join([os.getenv("GENERATE_MODEL_VERSION", "1"), base_model, inpaint_model, *CONTROLNET_MODELS.values()])
+
+# Encoded results handed out as URLs (response_format=url), oldest dropped past the budget
+OUTPUT_STORE_MB = float(os.getenv("GENERATE_OUTPUT_STORE_MB", "256"))
+output_store = OutputStore(int(OUTPUT_STORE_MB * 2**20))
+
+# Upper bound for num_variations (all variants run in one batched call)
+MAX_VARIATIONS = int(os.getenv("GENERATE_MAX_VARIATIONS", "4"))
+
+# ROI inpainting: working canvas cap (long side, px) and seam feather radius
+ROI_CANVAS_MAX_SIDE = int(os.getenv("GENERATE_ROI_CANVAS_MAX_SIDE", "1024"))
+ROI_FEATHER_RADIUS = int(os.getenv("GENERATE_ROI_FEATHER_RADIUS", "8"))
+
+# Async job API: finished results kept for a TTL, unpolled jobs get cancelled
+job_store = JobStore(
+    result_ttl=float(os.getenv("GENERATE_JOB_TTL_SECONDS", "3600")),
+    abandon_timeout=float(os.getenv("GENERATE_JOB_ABANDON_SECONDS", "120"))
+)
+
+def submit_pipeline(mode: str, **params):
+    """Queue a pipeline call, wiring in the current job's cancel flag and progress"""
+    if mode != "decode":
+        params.setdefault("deepcache_interval", tier_deepcache_interval(params.get("tier", "final")))
+    job = current_job.get()
+    if job is None:
+        return generation_worker.submit(mode, **params)
+    job.check_cancelled()
+    job.passes_started += 1
+    task = generation_worker.submit(mode, cancel_event=job.cancel_event, on_step=job.on_step, **params)
+    job.current_task = task
+    return task
+
+def submit_pipeline_group(mode: str, variants: List[dict], **params):
+    """Queue variants of one call (shared params, e.g. one seed each) to run as a single batched call"""
+    params.setdefault("deepcache_interval", tier_deepcache_interval(params.get("tier", "final")))
+    job = current_job.get()
+    if job is None:
+        return generation_worker.submit_group(mode, variants, **params)
+    job.check_cancelled()
+    job.passes_started += 1
+    tasks = generation_worker.submit_group(mode, variants, cancel_event=job.cancel_event, on_step=job.on_step, **params)
+    job.current_task = tasks[0]
+    return tasks
+
+def result_key(endpoint: str, image, masks: Optional[Dict[str, str]], prompt, params: dict, seed: Optional[int]) -> Optional[str]:
+    """Result-cache key for a request; None (not cacheable) without a cache or an explicit seed"""
+    if result_cache is None or seed is None:
+        return None
+    # Tier settings (step cap, scheduler, DeepCache interval) change the output as much as the params
+    params = {
+        **params,
+        "tier_config": QUALITY_TIERS.get(params.get("tier", "final")),
+        "buckets": [BUCKET_MAX_PIXELS, BUCKET_MIN_SIDE, BUCKET_MAX_SIDE]
+    }
+    mask_hashes = {name: content_hash(mask) for name, mask in (masks or {}).items()}
+    return request_key(endpoint, content_hash(image), mask_hashes, prompt, params, int(seed), MODEL_VERSION)
+
+def cached_result_sync(key: Optional[str]) -> Optional[dict]:
+    return result_cache.get(key) if key is not None else None
+
+def store_result_sync(key: Optional[str], response: dict) -> dict:
+    if key is not None:
+        result_cache.put(key, response)
+    return response
+
+async def cached_result(key: Optional[str]) -> Optional[dict]:
+    """Result-cache lookup off the event loop (entries are multi-MB JSON on disk)"""
+    return await asyncio.to_thread(cached_result_sync, key) if key is not None else None
+
+async def store_result(key: Optional[str], response: dict) -> dict:
+    """Result-cache write off the event loop; returns the response"""
+    return await asyncio.to_thread(store_result_sync, key, response) if key is not None else response
+
+async def run_pipeline(mode: str, **params) -> Image.Image:
+    """Queue a pipeline call on the generation worker and await its image"""
+    task = submit_pipeline(mode, **params)
+    return await asyncio.wrap_future(task.future)
+
+async def run_pipeline_variations(mode: str, variants: List[dict], **params) -> List[Image.Image]:
+    """One batched pipeline call producing one image per variant (image prep and prompt encoding shared)"""
+    tasks = submit_pipeline_group(mode, variants, **params)
+    return list(await asyncio.gather(*[asyncio.wrap_future(task.future) for task in tasks]))
+
+def run_pipeline_sync(mode: str, **params) -> Image.Image:
+    """Blocking variant for sync endpoints (runs on a threadpool thread, not the loop)"""
+    return submit_pipeline(mode, **params).future.result()
+
+async def watch_disconnect(request: Request, job: Job, interval: float = 0.5):
+    """Set the job's cancel flag as soon as the HTTP client goes away"""
+    while not job.cancelled:
+        if await request.is_disconnected():
+            print(f"✗ Client disconnected, aborting {request.url.path}")
+            job.cancel_event.set()
+            return
+        await asyncio.sleep(interval)
+
+@asynccontextmanager
+async def cancel_on_disconnect(request: Request):
+    """
+    Run a synchronous endpoint body as an unregistered job that is cancelled
+    when the client disconnects, so the worker stops at the next step/pass.
+    """
+    if current_job.get() is not None:
+        # Already inside a job (job API) - its own cancel flag applies
+        yield current_job.get()
+        return
+    job = Job("request")
+    token = current_job.set(job)
+    watcher = asyncio.create_task(watch_disconnect(request, job))
+    try:
+        yield job
+    finally:
+        watcher.cancel()
+        current_job.reset(token)
 
 @app.on_event("startup")
 async def load_models():
-    """Load models during FastAPI startup to avoid blocking module import"""
-    global pipe, inpaint_pipe, controlnet_models
+    """Load shared models during FastAPI startup; pipelines load on first use unless preloaded"""
     try:
-        print("Loading ControlNet models...")
-        # Load Canny ControlNet (primary for edge preservation)
-        controlnet_models['canny'] = ControlNetModel.from_pretrained(controlnet_canny, torch_dtype=dtype)
-        print("✓ Canny ControlNet loaded")
-        
-        # Optionally load Depth ControlNet (uncomment if needed)
-        # controlnet_models['depth'] = ControlNetModel.from_pretrained(controlnet_depth, torch_dtype=dtype)
-        # print("✓ Depth ControlNet loaded")
-        
-        print("Loading Stable Diffusion Img2Img pipeline with ControlNet...")
-        pipe = StableDiffusionControlNetImg2ImgPipeline.from_pretrained(
-            base_model,
-            controlnet=controlnet_models['canny'],
-            torch_dtype=dtype
-        ).to(device)
-        
-        # Load Inpainting pipeline for per-object redesign
-        print("Loading Stable Diffusion Inpainting pipeline...")
-        inpaint_pipe = StableDiffusionInpaintPipeline.from_pretrained(
-            "runwayml/stable-diffusion-inpainting",
-            torch_dtype=dtype
-        ).to(device)
-        
-        # Optimize pipelines
-        pipe.scheduler = EulerAncestralDiscreteScheduler.from_config(pipe.scheduler.config)
-        pipe.enable_attention_slicing()  # Helps reduce memory usage
-        inpaint_pipe.enable_attention_slicing()
-        
-        # Enable VAE slicing for lower VRAM usage
-        pipe.enable_vae_slicing()
-        inpaint_pipe.enable_vae_slicing()
-        
-        # Enable CUDA optimizations if available
-        if device == "cuda":
-            torch.backends.cudnn.benchmark = True
-            # Enable memory efficient attention (xformers alternative)
-            try:
-                pipe.enable_xformers_memory_efficient_attention()
-                inpaint_pipe.enable_xformers_memory_efficient_attention()
-                print("✓ xformers memory efficient attention enabled")
-            except:
-                print("⚠ xformers not available, using default attention")
-        
-        print(f"✓ Generate service ready on {device} (img2img + inpainting modes)")
+        pipelines.shared()
+        pipelines.preload(PRELOAD_MODES)
+        lazy = [m for m in ("img2img", "inpaint") if not pipelines.loaded(m)]
+        print(f"✓ Generate service ready on {device} (img2img + inpainting modes"
+              + (f"; lazy: {', '.join(lazy)})" if lazy else ")"))
     except Exception as e:
         print(f"⚠ Warning: Failed to load models: {e}")
         print("Service will run but generation endpoints will fail")
+    
+    generation_worker.start()
+    asyncio.create_task(reap_jobs())
+    print("✓ Generation worker started")
+
+@app.on_event("shutdown")
+async def stop_worker():
+    generation_worker.stop()
 
 @app.get("/")
 def root():
     """Root endpoint"""
-    return {"status": "ok", "service": "Generate (Stable Diffusion)", "device": device, "model_loaded": pipe is not None}
+    return {"status": "ok", "service": "Generate (Stable Diffusion)", "device": device, "model_loaded": pipelines.ready(), "models": pipelines.status(), "cpu_profile": cpu_profile.describe()}
 
 @app.get("/health")
 def health():
     """Health check endpoint"""
-    return {"status": "ok", "service": "Generate (Stable Diffusion)", "device": device, "model_loaded": pipe is not None}
+    return {"status": "ok", "service": "Generate (Stable Diffusion)", "device": device, "model_loaded": pipelines.ready(), "models": pipelines.status(), "cpu_profile": cpu_profile.describe()}
+
+@app.get("/generate/queue")
+def queue_status():
+    """Generation queue: running batch, waiting tasks with positions, batching stats"""
+    return generation_worker.status()
+
+@app.get("/generate/metrics")
+def metrics():
+    """Worker counters (incl. aborted runs/steps), job counts and cache hit rates"""
+    return {
+        "worker": dict(generation_worker.stats),
+        "jobs": job_store.counts(),
+        "prompt_cache": prompt_cache.stats() if prompt_cache else None,
+        "source_cache": source_cache.stats() if source_cache else None,
+        "result_cache": result_cache.stats() if result_cache else None,
+        "output_store": output_store.stats()
+    }
+
+@app.get("/generate/queue/{task_id}")
+def queue_position(task_id: str):
+    """Position of one queued task (0 = running now)"""
+    return {"task_id": task_id, "position": generation_worker.queue_position(task_id)}
 
 class RenderReq(BaseModel):
     image_b64: str
@@ -119,73 +342,328 @@ def decode_image(b64_str: str) -> Image.Image:
     img_bytes = base64.b64decode(b64_str)
     return Image.open(io.BytesIO(img_bytes)).convert("RGB")
 
-def create_canny_map(image: Image.Image, low_threshold: int = 100, high_threshold: int = 200) -> Image.Image:
-    """Generate a Canny edge control image from input."""
-    np_img = np.array(image)
-    edges = cv2.Canny(np_img, low_threshold, high_threshold)
-    # Convert to 3-channel for consistency
-    edges_3ch = cv2.cvtColor(edges, cv2.COLOR_GRAY2RGB)
-    return Image.fromarray(edges_3ch)
-
-def create_depth_map(image: Image.Image) -> Image.Image:
-    """Generate a simple depth map (placeholder - use MiDaS for production)."""
-    # This is a placeholder - in production, use MiDaS depth estimation
-    np_img = np.array(image.convert('L'))
-    # Simple depth approximation using gradient
-    depth = cv2.GaussianBlur(np_img, (9, 9), 0)
-    depth_3ch = cv2.cvtColor(depth, cv2.COLOR_GRAY2RGB)
-    return Image.fromarray(depth_3ch)
+def get_control_map(name: str, image: Image.Image) -> Image.Image:
+    """Control image for one ControlNet ("canny", "depth", "seg"), reused across generations on the same (resized) image"""
+    build = lambda img: control_annotators.build(name, img)  # noqa: E731
+    if source_cache is None:
+        return build(image)
+    return source_cache.control_map(name, image, build)
+
+def get_control_maps(names, image: Image.Image) -> List[Image.Image]:
+    return [get_control_map(name, image) for name in names]
+
+def control_params(names, maps: List[Image.Image], scales) -> dict:
+    """Pipeline kwargs for the selected ControlNets: one map/scale, or per-net lists for several"""
+    if len(names) == 1:
+        return {"controlnets": tuple(names), "control_image": maps[0], "controlnet_conditioning_scale": float(scales[0])}
+    return {"controlnets": tuple(names), "control_image": list(maps), "controlnet_conditioning_scale": tuple(float(s) for s in scales)}
+
+# Per-mode guidance windows: CFG stops after cfg_end of the steps (those steps run
+# the UNet once instead of twice), ControlNet only runs inside its start/end window.
+# Subtle keeps structure guidance throughout; bold frees the late steps for restyling.
+GUIDANCE_PRESETS = {
+    "subtle": {"cfg_end": 0.6, "control_guidance_start": 0.0, "control_guidance_end": 1.0},
+    "balanced": {"cfg_end": 0.7, "control_guidance_start": 0.0, "control_guidance_end": 0.8},
+    "bold": {"cfg_end": 0.8, "control_guidance_start": 0.0, "control_guidance_end": 0.6},
+}
+
+def guidance_params(
+    mode: str,
+    cfg_end: Optional[float] = None,
+    control_guidance_start: Optional[float] = None,
+    control_guidance_end: Optional[float] = None,
+    controlnet: bool = True
+) -> dict:
+    """Pipeline kwargs for a mode's guidance preset, with explicit request values taking precedence"""
+    preset = GUIDANCE_PRESETS.get(mode, GUIDANCE_PRESETS["balanced"])
+    params = {"cfg_end": preset["cfg_end"] if cfg_end is None else cfg_end}
+    if controlnet:
+        params["control_guidance_start"] = preset["control_guidance_start"] if control_guidance_start is None else control_guidance_start
+        params["control_guidance_end"] = preset["control_guidance_end"] if control_guidance_end is None else control_guidance_end
+    return params
+
+async def refine_high_res(
+    image: Image.Image,
+    prompt: str,
+    scale: float,
+    seed: int,
+    guidance_scale: float = 7.5,
+    num_inference_steps: int = 30,
+    tier: str = "final"
+) -> Image.Image:
+    """
+    High-res mode (app.highres): upscale a base-resolution result, refine it
+    with low-strength img2img + ControlNet on equal native-size tiles (queued
+    together, so the worker batches them), blend the tile latents and decode
+    the canvas with the tiled VAE decode.
+    """
+    size = highres_size(image.size, scale)
+    if size[0] <= image.width and size[1] <= image.height:
+        return image
+    upscaled = image.resize(size, Image.LANCZOS)
+    control_image = get_control_map("canny", upscaled)
+    boxes = tile_boxes(size, HIGHRES_TILE, HIGHRES_OVERLAP, align=8)
+    print(f"High-res refinement: {size[0]}x{size[1]} in {len(boxes)} tiles...")
+    
+    tile_latents = await asyncio.gather(*[
+        run_pipeline(
+            "img2img",
+            prompt=prompt,
+            image=upscaled.crop(box),
+            control_image=control_image.crop(box),
+            strength=HIGHRES_STRENGTH,  # Low denoise: add detail, keep the composition
+            guidance_scale=guidance_scale,
+            num_inference_steps=num_inference_steps,
+            controlnet_conditioning_scale=0.8,
+            output_type="latent",
+            tier=tier,
+            seed=seed + index  # Distinct noise per tile, still reproducible
+        )
+        for index, box in enumerate(boxes)
+    ])
+    latents = blend_tiles(list(tile_latents), latent_boxes(boxes), (size[0] // 8, size[1] // 8), HIGHRES_OVERLAP // 8)
+    return await asyncio.wrap_future(submit_pipeline("decode", latents=latents).future)
 
 # ---- Main Endpoint ----
 @app.post("/render")
 def render(req: RenderReq):
-    if pipe is None:
+    if not pipelines.ready():
         return {"error": "Model not loaded. Service is still initializing."}
     
-    # Decode original image
+    # Decode original image, resized to its aspect-preserving resolution bucket
     image = decode_image(req.image_b64)
-    image = image.resize((512, 512))
-
-    # Generate ControlNet conditioning (Canny edges for structure preservation)
-    control_image = create_canny_map(image)
+    original_size = image.size
+    image = to_bucket(image)
 
     # Extract parameters
     strength = req.options.get("strength", 0.75) if req.options else 0.75
     guidance_scale = req.options.get("guidance_scale", 7.5) if req.options else 7.5
     num_steps = req.options.get("steps", 30) if req.options else 30
     controlnet_scale = req.options.get("controlnet_conditioning_scale", 1.0) if req.options else 1.0
+    tier = req.options.get("tier", "final") if req.options else "final"
+    seed = req.options.get("seed") if req.options else None
+    if tier not in QUALITY_TIERS:
+        return {"error": f"Unknown tier '{tier}'. Use one of {list(QUALITY_TIERS)}"}
+    options = req.options or {}
+    restore = bool(options.get("restore_aspect", False))  # Map the output back to the exact input aspect
+    # ControlNets by name with optional per-net scales, as lists or comma-separated strings
+    as_csv = lambda value: ",".join(str(v) for v in value) if isinstance(value, (list, tuple)) else value  # noqa: E731
+    try:
+        controlnets, controlnet_scales = parse_controlnets(
+            as_csv(options.get("controlnets")), as_csv(options.get("controlnet_scales")), controlnet_scale
+        )
+    except ValueError as e:
+        return {"error": str(e)}
+    guidance = guidance_params(
+        options.get("mode", "balanced"),
+        cfg_end=options.get("cfg_end"),
+        control_guidance_start=options.get("control_guidance_start"),
+        control_guidance_end=options.get("control_guidance_end")
+    )
+    
+    # Seeded requests are deterministic: replay the stored response if there is one
+    cache_key = result_key("render", req.image_b64, None, req.prompt, {
+        "strength": strength, "guidance_scale": guidance_scale, "steps": num_steps,
+        "controlnet_scale": controlnet_scale, "tier": tier, "restore_aspect": restore,
+        "controlnets": controlnets, "controlnet_scales": controlnet_scales, **guidance
+    }, seed)
+    cached = cached_result_sync(cache_key)
+    if cached is not None:
+        return cached
+    seed = random_seed() if seed is None else int(seed)
 
-    # Run img2img diffusion with ControlNet
-    result = pipe(
+    # ControlNet conditioning (Canny edges for structure by default; depth/seg on request)
+    control = control_params(controlnets, get_control_maps(controlnets, image), controlnet_scales)
+
+    # Run img2img diffusion with ControlNet (sync endpoint: block this threadpool thread, not the loop)
+    result = run_pipeline_sync(
+        "img2img",
         prompt=req.prompt,
         image=image,  # Original image for img2img
-        control_image=control_image,  # Canny edges for structure
         strength=strength,  # How much to transform (0.0 = original, 1.0 = complete redraw)
         guidance_scale=guidance_scale,
-        num_inference_steps=num_steps,
-        controlnet_conditioning_scale=controlnet_scale
-    ).images[0]
+        num_inference_steps=tier_steps(tier, num_steps),
+        **control,  # Control map(s), ControlNet choice and scale(s)
+        tier=tier,
+        seed=seed,
+        **guidance
+    )
+    if restore:
+        result = to_original_aspect(result, original_size)
 
     # Encode to base64
     buf = io.BytesIO()
     result.save(buf, format="PNG")
     b64_img = base64.b64encode(buf.getvalue()).decode()
 
-    return {"image_b64": b64_img}
+    return store_result_sync(cache_key, {"image_b64": b64_img, "tier": tier, "seed": seed})
 
 @app.post("/generate/")
 async def generate_file(
+    request: Request,
     file: UploadFile = File(...),
     prompt: str = Form("Modern minimalist bedroom redesign. Neutral warm palette with beige and soft grey tones. Replace patterned curtains with sheer linen curtains. Upholstered bed with soft fabric headboard. Warm indirect lighting. Matte wall finishes. Photorealistic interior design photography."),
     num_inference_steps: int = Form(30),
     guidance_scale: float = Form(7.5),
     mode: str = Form("balanced"),  # "subtle", "balanced", "bold"
     two_pass: bool = Form(False),  # Enable two-pass generation
-    controlnet_conditioning_scale: float = Form(1.0)
+    controlnet_conditioning_scale: float = Form(1.0),
+    controlnets: str = Form(DEFAULT_CONTROLNET),  # Comma-separated: "canny", "depth", "seg", e.g. "canny,depth"
+    controlnet_scales: Optional[str] = Form(None),  # One scale per ControlNet, e.g. "1.0,0.6" (default: controlnet_conditioning_scale)
+    return_pass_a: bool = Form(False),  # Decode and return the two-pass intermediate
+    tier: str = Form("final"),  # "preview" (few-step, fast) | "final"
+    seed: Optional[int] = Form(None),  # Reuse a preview's seed for its final render
+    auto_final: bool = Form(False),  # With tier=preview: queue the final render as a job
+    cfg_end: Optional[float] = Form(None),  # Stop CFG after this fraction of steps (default: mode preset)
+    control_guidance_start: Optional[float] = Form(None),  # ControlNet window (default: mode preset)
+    control_guidance_end: Optional[float] = Form(None),
+    restore_aspect: bool = Form(False),  # Map outputs back to the exact input aspect ratio
+    high_res: bool = Form(False),  # Upscale + tiled refinement for 1024+ px output
+    high_res_scale: float = Form(2.0),
+    num_variations: int = Form(1),  # Design options from one batched call (seeds seed, seed+1, ...)
+    debug: bool = Form(False),  # Also return the resized original, control maps and pass A
+    output_format: str = Form("png"),  # "png" | "webp" | "jpeg"
+    output_quality: int = Form(90),  # webp/jpeg quality
+    response_format: str = Form("data_url")  # "data_url" | "url" (GET /generate/outputs/{id}) | "bytes"
 ):
     """File upload endpoint using img2img with ControlNet and adaptive strength"""
-    if pipe is None:
+    if response_format not in RESPONSE_FORMATS:
+        return {"error": f"Unknown response_format '{response_format}'. Use one of {list(RESPONSE_FORMATS)}"}
+    file_bytes = await file.read()
+    try:
+        async with cancel_on_disconnect(request):
+            response = await generate_from_bytes(
+                file_bytes,
+                prompt=prompt,
+                num_inference_steps=num_inference_steps,
+                guidance_scale=guidance_scale,
+                mode=mode,
+                two_pass=two_pass,
+                controlnet_conditioning_scale=controlnet_conditioning_scale,
+                controlnets=controlnets,
+                controlnet_scales=controlnet_scales,
+                return_pass_a=return_pass_a,
+                tier=tier,
+                seed=seed,
+                auto_final=auto_final,
+                cfg_end=cfg_end,
+                control_guidance_start=control_guidance_start,
+                control_guidance_end=control_guidance_end,
+                restore_aspect=restore_aspect,
+                high_res=high_res,
+                high_res_scale=high_res_scale,
+                num_variations=num_variations,
+                debug=debug,
+                output_format=output_format,
+                output_quality=output_quality
+            )
+            return deliver_output(response, response_format, str(request.base_url))
+    except GenerationCancelled:
+        return {"error": "Generation aborted (client disconnected)"}
+
+def deliver_output(response, response_format: str, base_url: str):
+    """
+    Turn a /generate/ response (data URLs) into the requested response_format:
+    "url" swaps each result for a fetchable /generate/outputs/{id} URL,
+    "bytes" returns just the main result's encoded bytes (seed in a header)
+    """
+    if response_format == "data_url" or not isinstance(response, dict) or "error" in response:
+        return response
+    if response_format == "bytes":
+        data, mime = from_data_url(response["generated_image"])
+        headers = {"X-Seed": str(response["parameters"]["seed"])}
+        if response.get("final_job_id"):
+            headers["X-Final-Job-Id"] = response["final_job_id"]
+        return Response(content=data, media_type=mime, headers=headers)
+    
+    def to_url(data_url):
+        if data_url is None:
+            return None
+        output_id = output_store.put(*from_data_url(data_url))
+        return f"{base_url.rstrip('/')}/generate/outputs/{output_id}"
+    
+    response = dict(response)  # never mutate a (cached) data-URL response
+    for key in ("generated_image", "original_image", "canny_image", "pass_a_image"):
+        response[key] = to_url(response.get(key))
+    if response.get("variations"):
+        response["variations"] = [{**v, "image": to_url(v["image"])} for v in response["variations"]]
+    if response.get("control_maps"):
+        response["control_maps"] = {name: to_url(m) for name, m in response["control_maps"].items()}
+    return response
+
+@app.get("/generate/outputs/{output_id}")
+def get_output(output_id: str):
+    """Encoded result handed out with response_format=url"""
+    entry = output_store.get(output_id)
+    if entry is None:
+        raise HTTPException(status_code=404, detail="Output not found or expired")
+    data, mime = entry
+    return Response(content=data, media_type=mime)
+
+async def generate_from_bytes(
+    file_bytes: bytes,
+    prompt: str,
+    num_inference_steps: int = 30,
+    guidance_scale: float = 7.5,
+    mode: str = "balanced",
+    two_pass: bool = False,
+    controlnet_conditioning_scale: float = 1.0,
+    controlnets: str = DEFAULT_CONTROLNET,
+    controlnet_scales: Optional[str] = None,
+    return_pass_a: bool = False,
+    tier: str = "final",
+    seed: Optional[int] = None,
+    auto_final: bool = False,
+    cfg_end: Optional[float] = None,
+    control_guidance_start: Optional[float] = None,
+    control_guidance_end: Optional[float] = None,
+    restore_aspect: bool = False,
+    high_res: bool = False,
+    high_res_scale: float = 2.0,
+    num_variations: int = 1,
+    debug: bool = False,
+    output_format: str = "png",
+    output_quality: int = 90
+):
+    """Shared body of /generate/ and upload jobs"""
+    if not pipelines.ready():
         return {"error": "Model not loaded. Service is still initializing."}
+    if tier not in QUALITY_TIERS:
+        return {"error": f"Unknown tier '{tier}'. Use one of {list(QUALITY_TIERS)}"}
+    if not 1 <= num_variations <= MAX_VARIATIONS:
+        return {"error": f"num_variations must be between 1 and {MAX_VARIATIONS}"}
+    output_format = normalize_format(output_format)
+    if output_format is None:
+        return {"error": "Unknown output_format. Use one of png, webp, jpeg"}
+    try:
+        # Per-net scales; two-pass multiplies its own pass factors into explicit scales (else 1.0 each)
+        controlnet_names, net_scales = parse_controlnets(controlnets, controlnet_scales, controlnet_conditioning_scale)
+        _, pass_scales = parse_controlnets(controlnets, controlnet_scales, 1.0)
+    except ValueError as e:
+        return {"error": str(e)}
+    
+    # Seeded requests replay the stored response (not with auto_final: that starts a new job)
+    cache_key = None if tier == "preview" and auto_final else result_key("generate", file_bytes, None, prompt, {
+        "steps": num_inference_steps, "guidance_scale": guidance_scale, "mode": mode, "two_pass": two_pass,
+        "controlnet_scale": controlnet_conditioning_scale, "controlnets": controlnet_names,
+        "controlnet_scales": net_scales, "return_pass_a": return_pass_a, "tier": tier,
+        "cfg_end": cfg_end, "control_guidance_start": control_guidance_start, "control_guidance_end": control_guidance_end,
+        "restore_aspect": restore_aspect, "high_res": high_res, "high_res_scale": high_res_scale,
+        "num_variations": num_variations, "debug": debug, "output_format": output_format,
+        "output_quality": output_quality
+    }, seed)
+    cached = await cached_result(cache_key)
+    if cached is not None:
+        return cached
+    
+    # Same seed for every pass (and for the final render of a preview); variation i uses seed + i
+    seed = random_seed() if seed is None else seed
+    seeds = [seed + i for i in range(num_variations)]
+    variants = [{"seed": s} for s in seeds]
+    requested_steps = num_inference_steps
+    num_inference_steps = tier_steps(tier, num_inference_steps)
+    tier_params = {"tier": tier}
+    guidance = guidance_params(mode, cfg_end, control_guidance_start, control_guidance_end)
     
     # Map mode to strength values
     strength_map = {
@@ -195,86 +673,156 @@ async def generate_file(
     }
     strength = strength_map.get(mode, 0.55)
     
-    # Read and process original image
-    file_bytes = await file.read()
+    # Read and process original image (aspect-preserving resolution bucket, not a square)
     image = Image.open(io.BytesIO(file_bytes)).convert("RGB")
-    image = image.resize((512, 512))
+    original_size = image.size
+    image = to_bucket(image)
     
-    # Generate Canny edge control image for structure preservation
-    control_image = create_canny_map(image)
+    # Control maps for the selected ControlNets (Canny edges by default), cached per image;
+    # depth/seg estimators are real models, so build them off the event loop
+    control_maps = await asyncio.to_thread(get_control_maps, controlnet_names, image)
+    scaled_control = lambda factor: control_params(  # noqa: E731
+        controlnet_names, control_maps, [s * factor for s in pass_scales]
+    )
     
     if two_pass:
         # PASS A: Structure lock (low strength, high ControlNet)
+        # Stays in latent space - no VAE decode/re-encode or 8-bit rounding between passes
         print("Pass A: Structure lock...")
-        pass_a_result = pipe(
+        pass_a_latents = await run_pipeline_variations(
+            "img2img",
+            variants,
             prompt=prompt,
             image=image,
-            control_image=control_image,
             strength=0.3,  # Low denoise for structure preservation
             guidance_scale=guidance_scale,
             num_inference_steps=num_inference_steps,
-            controlnet_conditioning_scale=1.2  # Strong ControlNet influence
-        ).images[0]
+            **scaled_control(1.2),  # Strong ControlNet influence
+            output_type="latent",
+            **tier_params,
+            cfg_end=guidance["cfg_end"]  # ControlNet over the full schedule: this pass locks structure
+        )
         
         # PASS B: Style enhancement (higher strength, weak/no ControlNet)
         print("Pass B: Style enhancement...")
-        result = pipe(
+        results = await run_pipeline_variations(
+            "img2img",
+            # Pass A latents (img2img skips its VAE encode), one per variation
+            [{**variant, "image": latents} for variant, latents in zip(variants, pass_a_latents)],
             prompt=prompt,
-            image=pass_a_result,  # Use Pass A output as input
-            control_image=control_image,
             strength=0.5,  # Higher denoise for style changes
             guidance_scale=guidance_scale,
             num_inference_steps=num_inference_steps,
-            controlnet_conditioning_scale=0.3  # Weak ControlNet for creativity
-        ).images[0]
+            **scaled_control(0.3),  # Weak ControlNet for creativity
+            **tier_params,
+            **guidance
+        )
         
-        # Save Pass A for debugging
-        pass_a_buf = io.BytesIO()
-        pass_a_result.save(pass_a_buf, format="PNG")
-        pass_a_b64 = f"data:image/png;base64,{base64.b64encode(pass_a_buf.getvalue()).decode()}"
+        # Pass A preview for debugging, only decoded on request
+        pass_a_b64 = None
+        if return_pass_a or debug:
+            pass_a_result = await asyncio.wrap_future(
+                submit_pipeline("decode", latents=pass_a_latents[0]).future
+            )
+            if restore_aspect:
+                pass_a_result = to_original_aspect(pass_a_result, original_size)
+            pass_a_b64 = to_data_url(*encode_image(pass_a_result, output_format, output_quality))
     else:
-        # Single pass generation
-        result = pipe(
+        # Single pass generation (all variations in one batched call)
+        results = await run_pipeline_variations(
+            "img2img",
+            variants,
             prompt=prompt,
             image=image,
-            control_image=control_image,
             strength=strength,
             guidance_scale=guidance_scale,
             num_inference_steps=num_inference_steps,
-            controlnet_conditioning_scale=controlnet_conditioning_scale
-        ).images[0]
+            **control_params(controlnet_names, control_maps, net_scales),
+            **tier_params,
+            **guidance
+        )
         pass_a_b64 = None
     
-    # Convert result to base64
-    buf = io.BytesIO()
-    result.save(buf, format="PNG")
-    generated_b64 = f"data:image/png;base64,{base64.b64encode(buf.getvalue()).decode()}"
+    if high_res:
+        results = list(await asyncio.gather(*[
+            refine_high_res(r, prompt, high_res_scale, s, guidance_scale, num_inference_steps, tier)
+            for r, s in zip(results, seeds)
+        ]))
     
-    # Also return canny image for debugging
-    canny_buf = io.BytesIO()
-    control_image.save(canny_buf, format="PNG")
-    canny_b64 = f"data:image/png;base64,{base64.b64encode(canny_buf.getvalue()).decode()}"
+    if restore_aspect:
+        # Undo the bucket's small aspect error for the images the client displays side by side
+        results = [to_original_aspect(r, original_size) for r in results]
+        image = to_original_aspect(image, original_size)
+    result = results[0]
     
-    # Return original image for comparison
-    orig_buf = io.BytesIO()
-    image.save(orig_buf, format="PNG")
-    original_b64 = f"data:image/png;base64,{base64.b64encode(orig_buf.getvalue()).decode()}"
+    # Encode results in the requested format (webp/jpeg are much faster and smaller than png)
+    variation_b64 = [to_data_url(*encode_image(r, output_format, output_quality)) for r in results]
+    generated_b64 = variation_b64[0]
     
-    return {
+    # Debug artifacts only on request: control maps (flat images, png stays small) and the resized original
+    canny_b64 = original_b64 = control_maps_b64 = None
+    if debug:
+        control_maps_b64 = {
+            name: to_data_url(*encode_image(m, "png")) for name, m in zip(controlnet_names, control_maps)
+        }
+        canny_b64 = control_maps_b64.get("canny")
+        original_b64 = to_data_url(*encode_image(image, output_format, output_quality))
+    
+    # Preview tier: optionally queue the final render right away (same seed, cached latents/embeddings)
+    final_job_id = None
+    if tier == "preview" and auto_final:
+        final_job = start_job("generate", lambda: generate_from_bytes(
+            file_bytes,
+            prompt=prompt,
+            num_inference_steps=requested_steps,
+            guidance_scale=guidance_scale,
+            mode=mode,
+            two_pass=two_pass,
+            controlnet_conditioning_scale=controlnet_conditioning_scale,
+            controlnets=controlnets,
+            controlnet_scales=controlnet_scales,
+            tier="final",
+            seed=seed,
+            cfg_end=cfg_end,
+            control_guidance_start=control_guidance_start,
+            control_guidance_end=control_guidance_end,
+            restore_aspect=restore_aspect,
+            high_res=high_res,
+            high_res_scale=high_res_scale,
+            num_variations=num_variations,
+            debug=debug,
+            output_format=output_format,
+            output_quality=output_quality
+        ))
+        final_job_id = final_job.id
+    
+    return await store_result(cache_key, {
         "generated_image": generated_b64,
-        "original_image": original_b64,
-        "canny_image": canny_b64,
-        "pass_a_image": pass_a_b64,  # Only if two_pass=True
+        "original_image": original_b64,  # Only with debug=True
+        "canny_image": canny_b64,  # Only with debug=True (and canny selected)
+        "control_maps": control_maps_b64,  # Only with debug=True: {controlnet: map}
+        "pass_a_image": pass_a_b64,  # Only if two_pass=True and return_pass_a/debug (first variation)
+        "variations": [{"seed": s, "image": b64} for s, b64 in zip(seeds, variation_b64)] if num_variations > 1 else None,
         "prompt": prompt,
+        "final_job_id": final_job_id,  # Poll /generate/jobs/{id} for the final render
         "parameters": {
             "mode": mode,
             "strength": strength,
             "guidance_scale": guidance_scale,
             "steps": num_inference_steps,
             "controlnet_scale": controlnet_conditioning_scale,
-            "two_pass": two_pass
+            "controlnets": list(controlnet_names),
+            "controlnet_scales": list(net_scales),
+            "two_pass": two_pass,
+            "high_res": high_res,
+            "num_variations": num_variations,
+            "output_format": output_format,
+            "tier": tier,
+            "seed": seed,
+            "size": list(result.size),
+            **guidance
         }
-    }
+    })
 
 
 # ============================================
@@ -294,9 +842,72 @@ class MultiPassInpaintRequest(BaseModel):
     steps: List[InpaintingStep]  # Ordered steps
     guidance_scale: float = 7.5
     num_inference_steps: int = 30
+    roi: bool = False  # Inpaint a padded crop per object instead of the full frame
+    single_pass: bool = False  # All items in one run, each masked region with its own prompt
+    seed: Optional[int] = None  # Fixed seed: reproducible result, served from the result cache on repeats
+    restore_aspect: bool = False  # Map outputs back to the exact input aspect ratio
+
+# Prompt for areas outside every item mask in single-pass mode
+REGIONAL_BASE_PROMPT = "photorealistic interior design photography, consistent lighting"
+
+async def inpaint_object(
+    image: Image.Image,
+    mask: Image.Image,
+    prompt: str,
+    strength: float,
+    num_inference_steps: int = 30,
+    guidance_scale: float = 7.5,
+    roi: bool = False,
+    **options
+) -> Image.Image:
+    """
+    One inpainting pass. With roi=True only a padded crop around the mask is
+    inpainted (at up to the model's native 512px) and blended back with a
+    feathered mask; pixels outside the mask stay untouched. Extra options
+    (tier, seed, ...) go to the pipeline call as-is.
+    """
+    if not roi:
+        return await run_pipeline(
+            "inpaint",
+            prompt=prompt,
+            image=image,
+            mask_image=mask,
+            height=image.height,  # the inpaint pipeline would otherwise resize to 512x512
+            width=image.width,
+            num_inference_steps=num_inference_steps,
+            guidance_scale=guidance_scale,
+            strength=strength,
+            **options
+        )
+    
+    plan = plan_roi(image, mask)
+    if plan is None:
+        return image  # empty mask, nothing to inpaint
+    width, height = plan.run_size
+    generated = await run_pipeline(
+        "inpaint",
+        prompt=prompt,
+        image=plan.image,
+        mask_image=plan.mask,
+        height=height,
+        width=width,
+        num_inference_steps=num_inference_steps,
+        guidance_scale=guidance_scale,
+        strength=strength,
+        **options
+    )
+    return blend_roi(image, generated, mask, plan.box, ROI_FEATHER_RADIUS)
 
 @app.post("/generate/inpaint_multi")
-async def inpaint_multi_pass(req: MultiPassInpaintRequest):
+async def inpaint_multi_pass(req: MultiPassInpaintRequest, request: Request):
+    """Multi-pass inpainting; aborts remaining steps and passes if the client disconnects"""
+    try:
+        async with cancel_on_disconnect(request):
+            return await run_inpaint_multi(req)
+    except GenerationCancelled:
+        return {"error": "Inpainting aborted (client disconnected)"}
+
+async def run_inpaint_multi(req: MultiPassInpaintRequest):
     """
     MULTI-PASS INPAINTING: Sequential object redesign
     
@@ -309,20 +920,37 @@ async def inpaint_multi_pass(req: MultiPassInpaintRequest):
     Each pass uses the previous pass output as input.
     This creates intentional, controlled design changes.
     """
-    if inpaint_pipe is None:
+    if not pipelines.ready():
         return {"error": "Inpainting model not loaded"}
     
-    # Decode original image
+    cache_key = result_key("inpaint_multi", req.image_b64, req.masks, [step.prompt for step in req.steps], {
+        "steps": [step.dict() for step in req.steps], "guidance_scale": req.guidance_scale,
+        "num_inference_steps": req.num_inference_steps, "roi": req.roi, "single_pass": req.single_pass,
+        "restore_aspect": req.restore_aspect
+    }, req.seed)
+    cached = await cached_result(cache_key)
+    if cached is not None:
+        return cached
+    seed = random_seed() if req.seed is None else req.seed
+    
+    # Decode original image (ROI mode keeps more of the original resolution, else its resolution bucket)
     current_image = decode_image(req.image_b64)
-    current_image = current_image.resize((512, 512))
+    original_size = current_image.size
+    if req.roi:
+        current_image = fit_canvas(current_image, ROI_CANVAS_MAX_SIDE)
+    else:
+        current_image = to_bucket(current_image)
     
-    # Decode all masks
+    # Decode all masks (same size as the image, nearest-neighbour so they stay binary)
     masks = {}
     for obj_name, mask_b64 in req.masks.items():
         mask_img = decode_image(mask_b64).convert("L")
-        mask_img = mask_img.resize((512, 512))
+        mask_img = to_bucket(mask_img, current_image.size, mask=True)
         masks[obj_name] = mask_img
     
+    if req.single_pass:
+        return await store_result(cache_key, await run_inpaint_single_pass(req, current_image, masks, seed, original_size))
+    
     # Execute inpainting steps sequentially
     pass_results = []
     
@@ -340,24 +968,29 @@ async def inpaint_multi_pass(req: MultiPassInpaintRequest):
         print(f"Inpainting {obj_name} (denoise: {denoise})...")
         
         # Inpaint this object
-        result = inpaint_pipe(
+        result = await inpaint_object(
+            current_image,
+            mask,
             prompt=prompt,
-            image=current_image,
-            mask_image=mask,
+            strength=denoise,  # How much to change
             num_inference_steps=req.num_inference_steps,
             guidance_scale=req.guidance_scale,
-            strength=denoise  # How much to change
-        ).images[0]
+            roi=req.roi,
+            seed=seed
+        )
         
         # Save intermediate result
         pass_results.append({
             "object": obj_name,
-            "image": result
+            "image": to_original_aspect(result, original_size) if req.restore_aspect else result
         })
         
         # Use this result as input for next step
         current_image = result
     
+    if req.restore_aspect:
+        current_image = to_original_aspect(current_image, original_size)
+    
     # Convert final result to base64
     final_buf = io.BytesIO()
     current_image.save(final_buf, format="PNG")
@@ -373,12 +1006,76 @@ async def inpaint_multi_pass(req: MultiPassInpaintRequest):
             "image": f"data:image/png;base64,{base64.b64encode(buf.getvalue()).decode()}"
         })
     
-    return {
+    return await store_result(cache_key, {
         "final_image": final_b64,
         "intermediate_passes": intermediate_results,
-        "num_passes": len(pass_results)
+        "num_passes": len(pass_results),
+        "seed": seed
+    })
+
+
+async def run_inpaint_single_pass(req: MultiPassInpaintRequest, image: Image.Image, masks: Dict[str, Image.Image],
+                                  seed: int, original_size):
+    """
+    SINGLE-PASS MULTI-REGION INPAINTING
+    All item masks are merged into one inpainting run; regional cross-attention
+    gives each masked region its own prompt, so N items cost about one run.
+    The run uses the strongest requested denoise among the items.
+    """
+    def encode_output(output: Image.Image) -> str:
+        return encode_image_b64(to_original_aspect(output, original_size) if req.restore_aspect else output)
+    
+    steps = [step for step in req.steps if step.object_name in masks]
+    for step in req.steps:
+        if step.object_name not in masks:
+            print(f"⚠ Warning: No mask found for {step.object_name}, skipping...")
+    if not steps:
+        return {"final_image": encode_output(image), "intermediate_passes": [], "num_passes": 0, "seed": seed}
+    
+    item_masks = [masks[step.object_name] for step in steps]
+    union = item_masks[0]
+    for mask in item_masks[1:]:
+        union = ImageChops.lighter(union, mask)
+    
+    if req.roi:
+        plan = plan_roi(image, union)
+        if plan is None:
+            return {"final_image": encode_output(image), "intermediate_passes": [], "num_passes": 0, "seed": seed}
+        run_image, run_mask, (width, height) = plan.image, plan.mask, plan.run_size
+        region_masks = [mask.crop(plan.box).resize(plan.run_size, Image.NEAREST) for mask in item_masks]
+    else:
+        run_image, run_mask, (width, height) = image, union, image.size
+        region_masks = item_masks
+    
+    print(f"Inpainting {', '.join(step.object_name for step in steps)} in one regional pass...")
+    result = await run_pipeline(
+        "inpaint",
+        regions=RegionalPrompts(REGIONAL_BASE_PROMPT, [step.prompt for step in steps], region_masks),
+        image=run_image,
+        mask_image=run_mask,
+        height=height,
+        width=width,
+        num_inference_steps=req.num_inference_steps,
+        guidance_scale=req.guidance_scale,
+        strength=max(step.denoise_strength for step in steps),
+        seed=seed
+    )
+    if req.roi:
+        result = blend_roi(image, result, union, plan.box, ROI_FEATHER_RADIUS)
+    
+    return {
+        "final_image": encode_output(result),
+        "intermediate_passes": [],
+        "num_passes": 1,
+        "objects": [step.object_name for step in steps],
+        "seed": seed
     }
 
+def encode_image_b64(image: Image.Image) -> str:
+    buf = io.BytesIO()
+    image.save(buf, format="PNG")
+    return f"data:image/png;base64,{base64.b64encode(buf.getvalue()).decode()}"
+
 
 @app.post("/generate/inpaint_file")
 async def inpaint_file(
@@ -387,42 +1084,63 @@ async def inpaint_file(
     prompt: str = Form("Redesigned interior element, photorealistic"),
     denoise_strength: float = Form(0.8),
     num_inference_steps: int = Form(30),
-    guidance_scale: float = Form(7.5)
+    guidance_scale: float = Form(7.5),
+    seed: Optional[int] = Form(None),
+    restore_aspect: bool = Form(False)  # Map the output back to the exact input aspect ratio
 ):
     """
     Simple single-object inpainting endpoint
     For testing/debugging individual object redesigns
     """
-    if inpaint_pipe is None:
+    if not pipelines.ready():
         return {"error": "Inpainting model not loaded"}
     
     # Read image and mask
     image_bytes = await file.read()
     mask_bytes = await mask.read()
     
-    image = Image.open(io.BytesIO(image_bytes)).convert("RGB").resize((512, 512))
-    mask_img = Image.open(io.BytesIO(mask_bytes)).convert("L").resize((512, 512))
+    cache_key = result_key("inpaint_file", image_bytes, {"mask": mask_bytes}, prompt, {
+        "denoise_strength": denoise_strength, "steps": num_inference_steps, "guidance_scale": guidance_scale,
+        "restore_aspect": restore_aspect
+    }, seed)
+    cached = await cached_result(cache_key)
+    if cached is not None:
+        return cached
+    seed = random_seed() if seed is None else seed
+    
+    # Image and mask share the image's resolution bucket
+    image = Image.open(io.BytesIO(image_bytes)).convert("RGB")
+    original_size = image.size
+    image = to_bucket(image)
+    mask_img = to_bucket(Image.open(io.BytesIO(mask_bytes)).convert("L"), image.size, mask=True)
     
     # Run inpainting
-    result = inpaint_pipe(
+    result = await run_pipeline(
+        "inpaint",
         prompt=prompt,
         image=image,
         mask_image=mask_img,
+        height=image.height,
+        width=image.width,
         num_inference_steps=num_inference_steps,
         guidance_scale=guidance_scale,
-        strength=denoise_strength
-    ).images[0]
+        strength=denoise_strength,
+        seed=seed
+    )
+    if restore_aspect:
+        result = to_original_aspect(result, original_size)
     
     # Convert to base64
     buf = io.BytesIO()
     result.save(buf, format="PNG")
     result_b64 = f"data:image/png;base64,{base64.b64encode(buf.getvalue()).decode()}"
     
-    return {
+    return await store_result(cache_key, {
         "inpainted_image": result_b64,
         "prompt": prompt,
-        "denoise_strength": denoise_strength
-    }
+        "denoise_strength": denoise_strength,
+        "seed": seed
+    })
 
 
 # ============================================
@@ -437,6 +1155,13 @@ class BudgetAwareGenerationRequest(BaseModel):
     budget: str  # "low" | "medium" | "high"
     masks: Optional[Dict[str, str]] = None  # Optional masks for per-item inpainting
     mode: str = "balanced"  # "subtle" | "balanced" | "bold"
+    roi: bool = False  # Per-item inpainting on padded crops instead of the full frame
+    tier: str = "final"  # "preview" | "final"
+    seed: Optional[int] = None
+    cfg_end: Optional[float] = None  # Guidance windows; default: preset for `mode`
+    control_guidance_start: Optional[float] = None
+    control_guidance_end: Optional[float] = None
+    restore_aspect: bool = False  # Map the output back to the exact input aspect ratio
 
 @app.post("/generate/budget-aware")
 async def generate_budget_aware(req: BudgetAwareGenerationRequest):
@@ -444,8 +1169,21 @@ async def generate_budget_aware(req: BudgetAwareGenerationRequest):
     Budget-Aware Image Generation
     Generates images with budget-realistic material prompts
     """
-    if pipe is None or inpaint_pipe is None:
+    if not pipelines.ready():
         return {"error": "Models not loaded"}
+    if req.tier not in QUALITY_TIERS:
+        return {"error": f"Unknown tier '{req.tier}'. Use one of {list(QUALITY_TIERS)}"}
+    cache_key = result_key("budget_aware", req.image_b64, req.masks, req.base_prompt, {
+        "material_specs": req.material_specs, "replace_items": req.replace_items, "budget": req.budget,
+        "mode": req.mode, "roi": req.roi, "tier": req.tier, "cfg_end": req.cfg_end,
+        "control_guidance_start": req.control_guidance_start, "control_guidance_end": req.control_guidance_end,
+        "restore_aspect": req.restore_aspect
+    }, req.seed)
+    cached = await cached_result(cache_key)
+    if cached is not None:
+        return cached
+    seed = random_seed() if req.seed is None else req.seed
+    num_steps = tier_steps(req.tier, 30)
     
     # Build budget-realistic prompt
     budget_descriptors = {
@@ -471,13 +1209,13 @@ Materials: {', '.join(material_descriptions)}.
 Photorealistic, professional interior photography, high detail."""
     
     # Decode original image
-    image = decode_image(req.image_b64)
-    image = image.resize((512, 512))
+    source = decode_image(req.image_b64)
+    image = to_bucket(source)
     
     # Determine generation strategy
     if req.masks and len(req.masks) > 0:
         # Use per-item inpainting for precise control
-        current_image = image
+        current_image = fit_canvas(source, ROI_CANVAS_MAX_SIDE) if req.roi else image
         
         for item in req.replace_items:
             if item not in req.masks:
@@ -491,48 +1229,61 @@ Photorealistic, professional interior photography, high detail."""
                 item_prompt = f"redesigned {item}, {budget_desc}, photorealistic"
             
             # Decode mask
-            mask = decode_image(req.masks[item]).convert("L").resize((512, 512))
+            mask = to_bucket(decode_image(req.masks[item]).convert("L"), current_image.size, mask=True)
             
             # Inpaint this item
-            current_image = inpaint_pipe(
+            current_image = await inpaint_object(
+                current_image,
+                mask,
                 prompt=item_prompt,
-                image=current_image,
-                mask_image=mask,
-                num_inference_steps=30,
+                strength=0.8,
+                num_inference_steps=num_steps,
                 guidance_scale=7.5,
-                strength=0.8
-            ).images[0]
+                roi=req.roi,
+                tier=req.tier,
+                seed=seed,
+                **guidance_params(req.mode, req.cfg_end, controlnet=False)
+            )
         
         result = current_image
     else:
         # Use global img2img with ControlNet
-        control_image = create_canny_map(image)
+        control_image = get_control_map("canny", image)
         
         strength_map = {"subtle": 0.3, "balanced": 0.55, "bold": 0.7}
         strength = strength_map.get(req.mode, 0.55)
         
-        result = pipe(
+        result = await run_pipeline(
+            "img2img",
             prompt=detailed_prompt,
             image=image,
             control_image=control_image,
             strength=strength,
             guidance_scale=7.5,
-            num_inference_steps=30,
-            controlnet_conditioning_scale=1.0
-        ).images[0]
+            num_inference_steps=num_steps,
+            controlnet_conditioning_scale=1.0,
+            tier=req.tier,
+            seed=seed,
+            **guidance_params(req.mode, req.cfg_end, req.control_guidance_start, req.control_guidance_end)
+        )
+    
+    if req.restore_aspect:
+        result = to_original_aspect(result, source.size)
     
     # Convert result to base64
     buf = io.BytesIO()
     result.save(buf, format="PNG")
     result_b64 = base64.b64encode(buf.getvalue()).decode()
     
-    return {
+    return await store_result(cache_key, {
         "image_b64": result_b64,
         "prompt_used": detailed_prompt,
         "budget": req.budget,
         "materials_applied": req.material_specs,
-        "items_replaced": req.replace_items
-    }
+        "items_replaced": req.replace_items,
+        "tier": req.tier,
+        "seed": seed
+    })
 
 
 # ============================================
@@ -545,116 +1296,226 @@ class ShoppingMetadata(BaseModel):
     material: str
     color: str
     confidence: float
+    style_confidence: float = 0.0
+    material_confidence: float = 0.0
+    dominant_colors: List[dict] = []  # [{"name", "hex", "share"}], largest first
+    masked: bool = False  # False: no mask for this item, scored on the full image
 
 class AnalyzeOutputRequest(BaseModel):
     generated_image_b64: str
     replaced_items: List[str]
+    masks: Optional[Dict[str, str]] = None  # {"bed": "base64_mask", ...}; any size, resized to the image
 
-# URL for advise service (for LLaVA analysis)
-ADVISE_URL = os.getenv("ADVISE_URL", "http://localhost:8003")
+# Zero-shot style/material scoring for /generate/analyze-output (CLIP loads on first use)
+output_analyzer = OutputAnalyzer(ZeroShotScorer(device=device))
 
 @app.post("/generate/analyze-output")
 async def analyze_generated_output(req: AnalyzeOutputRequest):
     """
     Post-Generation Analysis
-    Uses LLaVA (via advise service) to extract shopping metadata from generated image
+    Shopping metadata per replaced item from its mask region: dominant colors
+    (k-means) plus CLIP zero-shot style and material, batched across items
     """
-    # Call LLaVA through advise service to analyze the generated image
-    analysis_prompt = f"""Analyze this interior design image and extract shopping information for these items: {', '.join(req.replaced_items)}
+    image = decode_image(req.generated_image_b64)
+    masks = {
+        item: to_bucket(decode_image(b64).convert("L"), image.size, mask=True)
+        for item, b64 in (req.masks or {}).items() if item in req.replaced_items
+    }
+    start = time.perf_counter()
+    analysis = await asyncio.to_thread(output_analyzer.analyze, image, req.replaced_items, masks)
+    return {
+        "items": [ShoppingMetadata(**item).dict() for item in analysis["items"]],
+        "overall_style": analysis["overall_style"],
+        "color_palette": analysis["color_palette"],
+        "analyzed_items": req.replaced_items,
+        "analysis_ms": round((time.perf_counter() - start) * 1000, 1)
+    }
 
-For each item, identify:
-1. Item type (bed, curtains, chair, etc.)
-2. Design style (modern, minimalist, traditional, etc.)
-3. Primary material (wood, fabric, metal, etc.)
-4. Primary color
 
-Provide structured information in this format:
-- bed: modern upholstered bed, engineered wood frame, beige color
-- curtains: sheer linen curtains, fabric material, off-white color
 
-Analysis:"""
-    
-    # Make request to advise service for analysis
+# ============================================
+# ASYNC JOB API (long-running generation)
+# ============================================
+
+class JobRequest(BaseModel):
+    kind: str  # "render" | "inpaint_multi" | "budget_aware"
+    payload: dict
+
+# Job kind -> (request model, coroutine factory taking the parsed request)
+JOB_KINDS = {
+    "render": (RenderReq, lambda req: asyncio.to_thread(render, req)),
+    "inpaint_multi": (MultiPassInpaintRequest, run_inpaint_multi),
+    "budget_aware": (BudgetAwareGenerationRequest, generate_budget_aware),
+}
+
+async def run_job(job, make_coro):
+    """Run an endpoint body as a job; pipeline calls inside pick the job up via current_job"""
+    current_job.set(job)
     try:
-        async with httpx.AsyncClient(timeout=60.0) as client:
-            response = await client.post(
-                f"{ADVISE_URL}/advise",
-                json={
-                    "image_b64": req.generated_image_b64,
-                    "prompt": analysis_prompt,
-                    "masks": []
-                }
-            )
-            
-            if response.status_code == 200:
-                analysis_result = response.json()
-                raw_analysis = analysis_result.get("advice", "")
-            else:
-                raw_analysis = "Analysis failed"
+        result = await make_coro()
+        if isinstance(result, dict) and set(result) == {"error"}:
+            job.finish("failed", error=result["error"])
+        else:
+            job.finish("completed", result=result)
+    except GenerationCancelled:
+        job.finish("cancelled")
     except Exception as e:
-        print(f"Error calling advise service: {e}")
-        raw_analysis = "Analysis service unavailable"
-    
-    # Parse the analysis into structured metadata
-    items_metadata = []
-    overall_style = "Modern Minimalist"
-    color_palette = []
+        print(f"Job {job.id} failed: {e}")
+        job.finish("failed", error=str(e))
+
+background_jobs = set()  # strong refs so running job tasks are not garbage collected
+
+def start_job(kind: str, make_coro):
+    job = job_store.create(kind)
+    task = asyncio.create_task(run_job(job, make_coro))
+    background_jobs.add(task)
+    task.add_done_callback(background_jobs.discard)
+    return job
+
+def job_status(job):
+    task = job.current_task
+    position = generation_worker.queue_position(task.id) if task is not None else None
+    return job.to_dict(queue_position=position)
+
+def get_job_or_404(job_id: str):
+    job = job_store.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found (unknown or expired)")
+    return job
+
+async def reap_jobs():
+    """Periodically expire old results and cancel abandoned jobs"""
+    while True:
+        await asyncio.sleep(15)
+        job_store.prune()
+
+@app.post("/generate/jobs")
+async def submit_job(req: JobRequest):
+    """Submit a generation job; returns immediately with a job id to poll"""
+    if req.kind not in JOB_KINDS:
+        raise HTTPException(status_code=400, detail=f"Unknown job kind '{req.kind}'. Use one of {list(JOB_KINDS)}")
+    model, handler = JOB_KINDS[req.kind]
+    try:
+        parsed = model(**req.payload)
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=jsonable_encoder(e.errors()))
+    job = start_job(req.kind, lambda: handler(parsed))
+    return job_status(job)
+
+@app.post("/generate/jobs/upload")
+async def submit_upload_job(
+    request: Request,
+    file: UploadFile = File(...),
+    prompt: str = Form("Modern minimalist bedroom redesign. Neutral warm palette with beige and soft grey tones. Replace patterned curtains with sheer linen curtains. Upholstered bed with soft fabric headboard. Warm indirect lighting. Matte wall finishes. Photorealistic interior design photography."),
+    num_inference_steps: int = Form(30),
+    guidance_scale: float = Form(7.5),
+    mode: str = Form("balanced"),
+    two_pass: bool = Form(False),
+    controlnet_conditioning_scale: float = Form(1.0),
+    controlnets: str = Form(DEFAULT_CONTROLNET),
+    controlnet_scales: Optional[str] = Form(None),
+    return_pass_a: bool = Form(False),
+    tier: str = Form("final"),
+    seed: Optional[int] = Form(None),
+    auto_final: bool = Form(False),
+    cfg_end: Optional[float] = Form(None),
+    control_guidance_start: Optional[float] = Form(None),
+    control_guidance_end: Optional[float] = Form(None),
+    restore_aspect: bool = Form(False),
+    high_res: bool = Form(False),
+    high_res_scale: float = Form(2.0),
+    num_variations: int = Form(1),
+    debug: bool = Form(False),
+    output_format: str = Form("png"),
+    output_quality: int = Form(90),
+    response_format: str = Form("data_url")  # "data_url" | "url" (job results are JSON: no "bytes")
+):
+    """Job version of /generate/ (same form fields)"""
+    if response_format not in ("data_url", "url"):
+        raise HTTPException(status_code=400, detail="Jobs support response_format 'data_url' or 'url'")
+    file_bytes = await file.read()
+    base_url = str(request.base_url)
     
-    for item in req.replaced_items:
-        # Simple parsing logic - in production use better NLP
-        item_lower = item.lower()
-        
-        # Extract style
-        style = "modern"
-        if "traditional" in raw_analysis.lower():
-            style = "traditional"
-        elif "contemporary" in raw_analysis.lower():
-            style = "contemporary"
-        elif "minimalist" in raw_analysis.lower():
-            style = "minimalist"
-        
-        # Extract material (heuristic)
-        material = "mixed materials"
-        if item_lower in ["bed", "chair", "wardrobe"]:
-            if "wood" in raw_analysis.lower():
-                material = "engineered wood" if "engineered" in raw_analysis.lower() else "wood"
-            elif "fabric" in raw_analysis.lower() or "upholstered" in raw_analysis.lower():
-                material = "upholstered fabric"
-        elif item_lower == "curtains":
-            if "linen" in raw_analysis.lower():
-                material = "linen"
-            elif "silk" in raw_analysis.lower():
-                material = "silk"
-            else:
-                material = "fabric"
-        
-        # Extract color (heuristic)
-        color = "neutral"
-        if "beige" in raw_analysis.lower():
-            color = "beige"
-        elif "white" in raw_analysis.lower() or "off-white" in raw_analysis.lower():
-            color = "white"
-        elif "grey" in raw_analysis.lower() or "gray" in raw_analysis.lower():
-            color = "grey"
-        elif "brown" in raw_analysis.lower():
-            color = "brown"
-        
-        if color not in color_palette:
-            color_palette.append(color)
-        
-        items_metadata.append(ShoppingMetadata(
-            item_type=item,
-            style=style,
-            material=material,
-            color=color,
-            confidence=0.75
-        ))
+    async def run():
+        response = await generate_from_bytes(
+            file_bytes,
+            prompt=prompt,
+            num_inference_steps=num_inference_steps,
+            guidance_scale=guidance_scale,
+            mode=mode,
+            two_pass=two_pass,
+            controlnet_conditioning_scale=controlnet_conditioning_scale,
+            controlnets=controlnets,
+            controlnet_scales=controlnet_scales,
+            return_pass_a=return_pass_a,
+            tier=tier,
+            seed=seed,
+            auto_final=auto_final,
+            cfg_end=cfg_end,
+            control_guidance_start=control_guidance_start,
+            control_guidance_end=control_guidance_end,
+            restore_aspect=restore_aspect,
+            high_res=high_res,
+            high_res_scale=high_res_scale,
+            num_variations=num_variations,
+            debug=debug,
+            output_format=output_format,
+            output_quality=output_quality
+        )
+        return deliver_output(response, response_format, base_url)
     
-    return {
-        "items": [item.dict() for item in items_metadata],
-        "overall_style": overall_style,
-        "color_palette": color_palette,
-        "raw_analysis": raw_analysis,
-        "analyzed_items": req.replaced_items
-    }
+    job = start_job("generate", run)
+    return job_status(job)
+
+@app.get("/generate/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Poll job status, queue position and step progress"""
+    return job_status(get_job_or_404(job_id))
 
+@app.get("/generate/jobs/{job_id}/result")
+async def get_job_result(job_id: str):
+    """Fetch a completed job's result (same shape as the synchronous endpoint)"""
+    job = get_job_or_404(job_id)
+    if job.status != "completed":
+        raise HTTPException(status_code=409, detail=f"Job is {job.status}" + (f": {job.error}" if job.error else ""))
+    return job.result
+
+@app.delete("/generate/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    """Cancel a job; a running diffusion stops at the next denoising step"""
+    job = job_store.cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found (unknown or expired)")
+    return job_status(job)
+
+@app.get("/generate/jobs/{job_id}/stream")
+async def stream_job(job_id: str, preview_every: int = 5):
+    """
+    Server-Sent Events until the job finishes:
+    - status events (queue position, pass, step progress, ETA) on every change
+    - `event: preview` with a cheap latent->RGB JPEG every `preview_every` steps (0 = off)
+    """
+    job = get_job_or_404(job_id)
+    if preview_every > 0:
+        job.preview_every = preview_every if job.preview_every <= 0 else min(job.preview_every, preview_every)
+    
+    async def events():
+        last, last_preview = None, None
+        while True:
+            job = job_store.get(job_id)  # also keeps the job from being reaped as abandoned
+            if job is None:
+                yield "event: error\ndata: {\"detail\": \"Job expired\"}\n\n"
+                return
+            preview = job.preview
+            if preview_every > 0 and preview is not None and preview is not last_preview:
+                yield f"event: preview\ndata: {json.dumps(preview)}\n\n"
+                last_preview = preview
+            status = job_status(job)
+            if status != last:
+                yield f"data: {json.dumps(status)}\n\n"
+                last = status
+            if job.status in TERMINAL_STATUSES:
+                return
+            await asyncio.sleep(0.5)
+    
+    return StreamingResponse(events(), media_type="text/event-stream")
@@ -0,0 +1,196 @@
+"""
+Pipeline Registry
+The img2img+ControlNet and inpainting pipelines share one VAE, CLIP text
+encoder, tokenizer and safety checker (the SD 1.5 inpainting checkpoint
+only retrains the UNet), so those are loaded once and both pipelines are
+built on top of them. Shared components load at startup; each pipeline's
+own UNet/ControlNet loads the first time its mode is used (or at startup
+if listed in GENERATE_PRELOAD). Every load logs, per component, the growth
+of the process's resident memory (RSS) while it loaded next to its
+parameter size. With a ControlNetPool the img2img pipeline starts with the
+pool's default ControlNet, and the pool accounts for ControlNet memory.
+"""
+
+import os
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+import torch
+from diffusers import (
+    AutoencoderKL,
+    ControlNetModel,
+    StableDiffusionControlNetImg2ImgPipeline,
+    StableDiffusionInpaintPipeline,
+)
+from diffusers.pipelines.stable_diffusion.safety_checker import StableDiffusionSafetyChecker
+from transformers import CLIPImageProcessor, CLIPTextModel, CLIPTokenizer
+
+def resident_bytes() -> Optional[int]:
+    """Current resident set size of this process (Linux /proc), None where unavailable"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def module_nbytes(module) -> int:
+    """Bytes held by a module's parameters and buffers (0 for tokenizers/processors)"""
+    if not isinstance(module, torch.nn.Module):
+        return 0
+    tensors = list(module.parameters()) + list(module.buffers())
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+
+class PipelineRegistry:
+    """Shared SD components + lazily built pipelines per mode"""
+
+    def __init__(self, device: str, dtype, base_model: str, inpaint_model: str, controlnet_model: str,
+                 configure: Optional[Callable[[str, object], None]] = None, controlnet_pool=None):
+        self.device = device
+        self.dtype = dtype
+        self.base_model = base_model
+        self.inpaint_model = inpaint_model
+        self.controlnet_model = controlnet_model
+        self.configure = configure  # configure(mode, pipeline): schedulers, attention, ...
+        self.controlnet_pool = controlnet_pool  # optional ControlNetPool (ControlNets swapped per call)
+        self._shared: Optional[Dict] = None
+        self._pipelines: Dict[str, object] = {}
+        self._lock = threading.RLock()
+        self.errors: Dict[str, str] = {}
+        self.memory_mb: Dict[str, float] = {}  # parameter + buffer size per component
+        self.rss_mb: Dict[str, float] = {}  # RSS growth while each component loaded
+
+    # ---- loading ----
+    def shared(self) -> Dict:
+        with self._lock:
+            if self._shared is None:
+                start = time.time()
+                print("Loading shared components (VAE, text encoder, tokenizer, safety checker)...")
+                kwargs = {"torch_dtype": self.dtype}
+                rss: Dict[str, int] = {}
+                try:
+                    self._shared = self._load_shared(kwargs, rss)
+                except Exception as e:
+                    self.errors["shared"] = str(e)
+                    raise
+                self.errors.pop("shared", None)
+                self._log_memory("shared", self._shared, rss, time.time() - start)
+            return self._shared
+
+    @staticmethod
+    def _measured(rss: Dict[str, int], name: str, load: Callable[[], object]):
+        """Run one component load, recording the process RSS growth under `name`"""
+        before = resident_bytes()
+        component = load()
+        after = resident_bytes()
+        if before is not None and after is not None:
+            rss[name] = max(0, after - before)
+        return component
+
+    def _load_shared(self, kwargs: Dict, rss: Dict[str, int]) -> Dict:
+        loaders = {
+            "vae": lambda: AutoencoderKL.from_pretrained(self.base_model, subfolder="vae", **kwargs).to(self.device),
+            "text_encoder": lambda: CLIPTextModel.from_pretrained(self.base_model, subfolder="text_encoder", **kwargs).to(self.device),
+            "tokenizer": lambda: CLIPTokenizer.from_pretrained(self.base_model, subfolder="tokenizer"),
+            "safety_checker": lambda: StableDiffusionSafetyChecker.from_pretrained(self.base_model, subfolder="safety_checker", **kwargs).to(self.device),
+            "feature_extractor": lambda: CLIPImageProcessor.from_pretrained(self.base_model, subfolder="feature_extractor"),
+        }
+        return {name: self._measured(rss, name, load) for name, load in loaders.items()}
+
+    def get(self, mode: str):
+        """Pipeline for a mode, built on first use (called from the generation worker thread)"""
+        pipeline = self._pipelines.get(mode)
+        if pipeline is not None:
+            return pipeline
+        with self._lock:
+            if mode in self._pipelines:
+                return self._pipelines[mode]
+            builders = {"img2img": self._build_img2img, "inpaint": self._build_inpaint}
+            if mode not in builders:
+                return None
+            start = time.time()
+            rss: Dict[str, int] = {}
+            try:
+                pipeline, own = builders[mode](self.shared(), rss)
+                if self.configure is not None:
+                    self.configure(mode, pipeline)
+            except Exception as e:
+                self.errors[mode] = str(e)
+                print(f"⚠ Failed to load {mode} pipeline: {e}")
+                raise
+            self.errors.pop(mode, None)
+            self._pipelines[mode] = pipeline
+            self._log_memory(mode, own, rss, time.time() - start)
+            return pipeline
+
+    def _build_img2img(self, shared: Dict, rss: Dict[str, int]):
+        print("Loading Stable Diffusion Img2Img pipeline with ControlNet...")
+        if self.controlnet_pool is not None:
+            controlnet = self.controlnet_pool.get(self.controlnet_pool.default)
+        else:
+            controlnet = self._measured(rss, "controlnet", lambda: ControlNetModel.from_pretrained(
+                self.controlnet_model, torch_dtype=self.dtype
+            ))
+        # With the shared components passed in, only the UNet (and scheduler config) loads here
+        pipeline = self._measured(rss, "unet", lambda: StableDiffusionControlNetImg2ImgPipeline.from_pretrained(
+            self.base_model, controlnet=controlnet, torch_dtype=self.dtype, **shared
+        ).to(self.device))
+        if self.controlnet_pool is not None:
+            return pipeline, {"unet": pipeline.unet}  # pooled ControlNets are listed under "controlnets"
+        return pipeline, {"unet": pipeline.unet, "controlnet": controlnet}
+
+    def _build_inpaint(self, shared: Dict, rss: Dict[str, int]):
+        print("Loading Stable Diffusion Inpainting pipeline...")
+        pipeline = self._measured(rss, "unet", lambda: StableDiffusionInpaintPipeline.from_pretrained(
+            self.inpaint_model, torch_dtype=self.dtype, **shared
+        ).to(self.device))
+        return pipeline, {"unet": pipeline.unet}
+
+    def preload(self, modes):
+        for mode in modes:
+            try:
+                self.get(mode)
+            except Exception:
+                pass  # recorded in self.errors, retried on first use
+
+    # ---- status ----
+    def ready(self) -> bool:
+        """Shared components loaded; pipelines can be built on demand"""
+        return self._shared is not None
+
+    def loaded(self, mode: str) -> bool:
+        return mode in self._pipelines
+
+    def _log_memory(self, group: str, components: Dict, rss: Dict[str, int], seconds: float):
+        """Per component: RSS growth while it loaded (n/a without /proc) and parameter size"""
+        total, total_rss = 0.0, 0.0
+        print(f"✓ {group} loaded in {seconds:.1f}s - resident memory (RSS growth / weights):")
+        for name, component in components.items():
+            mb = module_nbytes(component) / 2**20
+            rss_mb = rss[name] / 2**20 if name in rss else None
+            if mb <= 0 and not rss_mb:
+                continue
+            key = name if group == "shared" else f"{group}.{name}"
+            self.memory_mb[key] = round(mb, 1)
+            total += mb
+            rss_text = "n/a" if rss_mb is None else f"{rss_mb:.1f}"
+            if rss_mb is not None:
+                self.rss_mb[key] = round(rss_mb, 1)
+                total_rss += rss_mb
+            print(f"    {key:<24} {rss_text:>8} MB RSS {mb:>8.1f} MB weights")
+        rss_total_text = f"{total_rss:.1f}" if rss else "n/a"
+        print(f"    {'total':<24} {rss_total_text:>8} MB RSS {total:>8.1f} MB weights")
+
+    def status(self) -> Dict:
+        return {
+            "shared_loaded": self._shared is not None,
+            "pipelines": {mode: self.loaded(mode) for mode in ("img2img", "inpaint")},
+            "errors": dict(self.errors),
+            "memory_mb": dict(self.memory_mb),
+            "total_memory_mb": round(sum(self.memory_mb.values()), 1),
+            "rss_mb": dict(self.rss_mb),
+            "total_rss_mb": round(sum(self.rss_mb.values()), 1),
+            "controlnets": self.controlnet_pool.status() if self.controlnet_pool is not None else None,
+        }
@@ -0,0 +1,88 @@
+"""
+Output Encoding
+PNG is lossless but slow to encode and large for photographic renders;
+WebP/JPEG at quality ~90 encode several times faster and are a fraction of
+the size. Encoded results can be returned as a data URL (default), as raw
+bytes, or parked in a small in-memory store and returned as a URL the
+client fetches from GET /generate/outputs/{id}.
+"""
+
+import base64
+import io
+import threading
+import uuid
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from PIL import Image
+
+OUTPUT_FORMATS = {
+    # name: (PIL format, mime type)
+    "png": ("PNG", "image/png"),
+    "webp": ("WEBP", "image/webp"),
+    "jpeg": ("JPEG", "image/jpeg"),
+}
+RESPONSE_FORMATS = ("data_url", "url", "bytes")
+
+
+def normalize_format(name: str) -> Optional[str]:
+    name = (name or "").lower()
+    name = "jpeg" if name == "jpg" else name
+    return name if name in OUTPUT_FORMATS else None
+
+
+def encode_image(image: Image.Image, output_format: str = "png", quality: int = 90) -> Tuple[bytes, str]:
+    """(encoded bytes, mime type); quality applies to webp/jpeg"""
+    pil_format, mime = OUTPUT_FORMATS[output_format]
+    options = {}
+    if output_format in ("webp", "jpeg"):
+        options["quality"] = max(1, min(100, int(quality)))
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+    if output_format == "webp":
+        options["method"] = 4  # encoder effort: 4 is near-best size at a fraction of 6's time
+    elif output_format == "png":
+        options["compress_level"] = 1  # zlib effort: much faster, slightly larger
+    buf = io.BytesIO()
+    image.save(buf, format=pil_format, **options)
+    return buf.getvalue(), mime
+
+
+def to_data_url(data: bytes, mime: str) -> str:
+    return f"data:{mime};base64,{base64.b64encode(data).decode()}"
+
+
+def from_data_url(data_url: str) -> Tuple[bytes, str]:
+    header, payload = data_url.split(",", 1)
+    return base64.b64decode(payload), header[len("data:"):].split(";", 1)[0]
+
+
+class OutputStore:
+    """Recently encoded outputs served by id, bounded by total bytes (oldest dropped first)"""
+
+    def __init__(self, max_bytes: int = 256 * 2**20):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, Tuple[bytes, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.total_bytes = 0
+
+    def put(self, data: bytes, mime: str) -> str:
+        output_id = uuid.uuid4().hex
+        with self._lock:
+            self._entries[output_id] = (data, mime)
+            self.total_bytes += len(data)
+            while self.total_bytes > self.max_bytes and len(self._entries) > 1:
+                _, (old, _) = self._entries.popitem(last=False)
+                self.total_bytes -= len(old)
+        return output_id
+
+    def get(self, output_id: str) -> Optional[Tuple[bytes, str]]:
+        with self._lock:
+            entry = self._entries.get(output_id)
+            if entry is not None:
+                self._entries.move_to_end(output_id)
+            return entry
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self.total_bytes, "max_bytes": self.max_bytes}
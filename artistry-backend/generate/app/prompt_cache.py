@@ -0,0 +1,74 @@
+"""
+Prompt Embedding Cache
+LRU cache of CLIP text-encoder outputs (prompt + negative prompt) keyed by
+text and text-encoder, so repeated prompts (budget descriptors, the default
+/generate/ prompt, per-item inpaint prompts) skip text encoding entirely.
+Only the generation worker thread encodes; the lock just keeps stats/LRU
+consistent for readers.
+"""
+
+import threading
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+import torch
+
+
+class PromptEmbeddingCache:
+    """(text encoder, prompt, negative prompt) -> (prompt_embeds, negative_prompt_embeds)"""
+
+    def __init__(self, max_entries: int = 128):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[tuple, Tuple[torch.Tensor, torch.Tensor]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def model_key(pipeline) -> tuple:
+        """Identify the text encoder; pipelines sharing one encoder share entries"""
+        encoder = pipeline.text_encoder
+        return (getattr(encoder.config, "_name_or_path", ""), id(encoder))
+
+    def get(self, pipeline, prompt: str, negative_prompt: Optional[str] = None):
+        """Embeddings (1, 77, dim) for one prompt, encoding on a miss"""
+        key = (self.model_key(pipeline), prompt, negative_prompt or "")
+        with self._lock:
+            cached = self._entries.get(key)
+            if cached is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return cached
+            self.misses += 1
+
+        with torch.no_grad():
+            prompt_embeds, negative_embeds = pipeline.encode_prompt(
+                prompt,
+                pipeline._execution_device,
+                num_images_per_prompt=1,
+                do_classifier_free_guidance=True,
+                negative_prompt=negative_prompt,
+            )
+
+        with self._lock:
+            self._entries[key] = (prompt_embeds, negative_embeds)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return prompt_embeds, negative_embeds
+
+    def encode_batch(self, pipeline, prompts, negative_prompts=None):
+        """Concatenated embeddings for a batched pipeline call"""
+        negative_prompts = negative_prompts or [None] * len(prompts)
+        pairs = [self.get(pipeline, p, n) for p, n in zip(prompts, negative_prompts)]
+        return torch.cat([p for p, _ in pairs]), torch.cat([n for _, n in pairs])
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
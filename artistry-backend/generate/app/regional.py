@@ -0,0 +1,136 @@
+"""
+Regional Prompts
+Single-pass multi-region inpainting: every item gets its own prompt inside
+one diffusion run. The prompts are encoded separately and concatenated
+along the token axis; a cross-attention processor splits them again and
+lets each latent position attend only to its own region's prompt (weighted
+by the region masks, downsampled to each attention resolution). Areas
+outside every mask follow the base prompt. Self-attention and calls
+without regions go straight to the original processors, so installing it
+changes nothing for other requests.
+"""
+
+from typing import List, Optional
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from PIL import Image
+
+TOKENS_PER_PROMPT = 77  # CLIP context length (SD 1.x)
+
+
+class RegionalPrompts:
+    """Base prompt + (prompt, mask) per region for one regional pipeline call"""
+
+    def __init__(self, base_prompt: str, prompts: List[str], masks: List[Image.Image],
+                 negative_prompt: Optional[str] = None):
+        self.base_prompt = base_prompt
+        self.prompts = prompts
+        self.masks = masks
+        self.negative_prompt = negative_prompt
+        self._weights = {}  # seq_len -> (R + 1, 1, seq_len, 1)
+
+    def pipeline_kwargs(self, pipeline, prompt_cache=None) -> dict:
+        """Concatenated prompt embeddings + the attention kwargs the processor picks up (worker thread)"""
+        conds, unconds = [], []
+        for prompt in [self.base_prompt] + self.prompts:
+            if prompt_cache is not None:
+                cond, uncond = prompt_cache.get(pipeline, prompt, self.negative_prompt)
+            else:
+                with torch.no_grad():
+                    cond, uncond = pipeline.encode_prompt(
+                        prompt, pipeline._execution_device, num_images_per_prompt=1,
+                        do_classifier_free_guidance=True, negative_prompt=self.negative_prompt
+                    )
+            conds.append(cond)
+            unconds.append(uncond)
+
+        self.latent_masks = self._latent_masks(pipeline)
+        self._weights = {}
+        return {
+            "prompt_embeds": torch.cat(conds, dim=1),
+            "negative_prompt_embeds": torch.cat(unconds, dim=1),
+            "cross_attention_kwargs": {"regions": self},
+        }
+
+    def _latent_masks(self, pipeline) -> torch.Tensor:
+        """(R + 1, h, w) weights at latent resolution: base region first, normalized to sum to 1"""
+        width, height = self.masks[0].size
+        scale = getattr(pipeline, "vae_scale_factor", 8)
+        size = (width // scale, height // scale)
+        regions = np.stack([
+            np.asarray(mask.convert("L").resize(size, Image.BILINEAR), dtype=np.float32) / 255.0
+            for mask in self.masks
+        ])
+        base = np.clip(1.0 - regions.sum(axis=0), 0.0, 1.0)[None]
+        weights = np.concatenate([base, regions])
+        weights /= np.maximum(weights.sum(axis=0, keepdims=True), 1e-6)
+        return torch.from_numpy(weights)
+
+    def weights(self, seq_len: int, device, dtype) -> torch.Tensor:
+        """Region weights for an attention layer with seq_len = h * w query positions"""
+        cached = self._weights.get(seq_len)
+        if cached is None:
+            _, height, width = self.latent_masks.shape
+            factor = (height * width / seq_len) ** 0.5
+            size = (max(1, round(height / factor)), max(1, round(width / factor)))
+            resized = F.interpolate(self.latent_masks[None], size=size, mode="area")[0]
+            resized = resized / resized.sum(dim=0, keepdim=True).clamp(min=1e-6)
+            cached = resized.reshape(resized.shape[0], 1, -1, 1)
+            self._weights[seq_len] = cached
+        return cached.to(device=device, dtype=dtype)
+
+
+class RegionalAttnProcessor:
+    """Attention wrapper: per-region prompts in cross-attention when `regions` is passed, otherwise the original processor"""
+
+    def __init__(self, base_processor):
+        self.base_processor = base_processor
+
+    def __call__(self, attn, hidden_states, encoder_hidden_states=None, attention_mask=None,
+                 temb=None, regions: Optional[RegionalPrompts] = None, **kwargs):
+        if regions is None or encoder_hidden_states is None:
+            return self.base_processor(attn, hidden_states, encoder_hidden_states=encoder_hidden_states,
+                                       attention_mask=attention_mask)
+
+        residual = hidden_states
+        batch_size, seq_len, _ = hidden_states.shape
+        if attn.norm_cross:
+            encoder_hidden_states = attn.norm_encoder_hidden_states(encoder_hidden_states)
+
+        query = attn.to_q(hidden_states)
+        key = attn.to_k(encoder_hidden_states)
+        value = attn.to_v(encoder_hidden_states)
+        head_dim = key.shape[-1] // attn.heads
+
+        def heads(x):
+            return x.reshape(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+
+        query = heads(query)
+        weights = regions.weights(seq_len, hidden_states.device, hidden_states.dtype)
+        output = 0
+        # One attention per region prompt over its own 77 tokens, blended by region weight
+        for index, (k, v) in enumerate(zip(key.split(TOKENS_PER_PROMPT, dim=1), value.split(TOKENS_PER_PROMPT, dim=1))):
+            region_out = F.scaled_dot_product_attention(query, heads(k), heads(v))
+            region_out = region_out.transpose(1, 2).reshape(batch_size, seq_len, attn.heads * head_dim)
+            output = output + region_out * weights[index]
+
+        output = attn.to_out[0](output)
+        output = attn.to_out[1](output)
+        if attn.residual_connection:
+            output = output + residual
+        return output / attn.rescale_output_factor
+
+
+def install_regional_attention(unet):
+    """
+    Wrap every attention processor (self-attention ones just delegate, but
+    must accept the `regions` kwarg). Call after slicing/xformers are set up.
+    """
+    processors = {}
+    for name, processor in unet.attn_processors.items():
+        if not isinstance(processor, RegionalAttnProcessor):
+            processor = RegionalAttnProcessor(processor)
+        processors[name] = processor
+    unet.set_attn_processor(processors)
@@ -0,0 +1,135 @@
+"""
+Result Cache
+A seeded generation is deterministic for a given input, prompt, parameter
+set and model version, so its encoded response can be replayed instead of
+re-rendered (saved designs reopened from the gateway, share links). Entries
+are JSON files on local disk named by a hash of the full request identity;
+the directory is bounded by total size and evicted least-recently-used
+(file mtime is bumped on every hit). Requests without an explicit seed are
+random and never cached.
+"""
+
+import hashlib
+import json
+import os
+import threading
+from typing import Dict, Optional
+
+
+def content_hash(data) -> str:
+    """Hash of raw request content (upload bytes or a base64 string)"""
+    if isinstance(data, str):
+        data = data.encode()
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def request_key(endpoint: str, image_hash: str, mask_hashes: Optional[Dict[str, str]], prompt,
+                params: dict, seed: int, model_version: str) -> str:
+    """Cache key for one request; params must be JSON-serializable"""
+    identity = {
+        "endpoint": endpoint,
+        "image": image_hash,
+        "masks": mask_hashes or {},
+        "prompt": prompt,
+        "params": params,
+        "seed": seed,
+        "model": model_version,
+    }
+    blob = json.dumps(identity, sort_keys=True, default=str)
+    return hashlib.sha256(blob.encode()).hexdigest()
+
+
+class ResultCache:
+    """key -> encoded response dict, stored as <dir>/<key>.json, bounded by total bytes"""
+
+    def __init__(self, directory: str, max_bytes: int = 512 * 2**20):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._sizes: Dict[str, int] = {}
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+        for name in os.listdir(directory):
+            if name.endswith(".json"):
+                size = os.path.getsize(os.path.join(directory, name))
+                self._sizes[name[:-5]] = size
+                self.total_bytes += size
+        with self._lock:
+            self._evict()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key: Optional[str]) -> Optional[dict]:
+        if key is None:
+            return None
+        path = self._path(key)
+        with self._lock:
+            if key not in self._sizes:
+                self.misses += 1
+                return None
+            try:
+                with open(path) as f:
+                    value = json.load(f)
+                os.utime(path)  # LRU order = mtime
+            except (OSError, ValueError):
+                self._remove(key)
+                self.misses += 1
+                return None
+            self.hits += 1
+            return value
+
+    def put(self, key: Optional[str], value: dict):
+        if key is None:
+            return
+        blob = json.dumps(value).encode()
+        if len(blob) > self.max_bytes:
+            return
+        path = self._path(key)
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with self._lock:
+            try:
+                with open(tmp, "wb") as f:
+                    f.write(blob)
+                os.replace(tmp, path)  # readers never see a partial file
+            except OSError as e:
+                print(f"⚠ Result cache write failed: {e}")
+                return
+            self.total_bytes += len(blob) - self._sizes.get(key, 0)
+            self._sizes[key] = len(blob)
+            self._evict()
+
+    def _remove(self, key: str):
+        self.total_bytes -= self._sizes.pop(key, 0)
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def _evict(self):
+        """Drop least recently used files until under the byte budget (lock held)"""
+        if self.total_bytes <= self.max_bytes:
+            return
+        def mtime(key):
+            try:
+                return os.path.getmtime(self._path(key))
+            except OSError:
+                return 0.0
+        for key in sorted(self._sizes, key=mtime):
+            if self.total_bytes <= self.max_bytes:
+                break
+            self._remove(key)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._sizes),
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
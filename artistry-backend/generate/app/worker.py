@@ -0,0 +1,368 @@
+"""
+Generation Worker
+A single background thread owns the diffusers pipelines and drains a queue of
+generation tasks, so a long CPU diffusion run never blocks the event loop
+(or /health). Compatible queued tasks - same mode, image size and scalar
+parameters (steps, strength, guidance, ...) - are merged into one batched
+pipeline call; a group of variants (same call, one seed each) always runs
+as one call, even past max_batch_size. Each task may carry a cancel flag
+that is checked from the diffusion step callback, so cancelled runs stop
+between denoising steps.
+Tasks may name the ControlNets to condition on (`controlnets`, part of the
+batch key); the worker swaps them in from the ControlNet pool per call.
+Tasks with several ControlNets never share a call (variants included).
+The "decode" mode turns latents (from an output_type="latent" call) into
+PIL images with the VAE, so only the worker thread ever touches the models.
+"""
+
+import contextlib
+import threading
+import time
+import uuid
+from concurrent.futures import Future
+from typing import Callable, ContextManager, Dict, List, Optional
+
+import torch
+
+from app.highres import VAE_TILE, tiled_vae_decode
+
+# Per-image pipeline arguments; these become lists in a batched call.
+# Everything else must match for two tasks to share a batch.
+BATCHED_PARAMS = {"prompt", "negative_prompt", "image", "control_image", "mask_image", "latents", "seed"}
+
+
+class GenerationCancelled(Exception):
+    """Raised (from the step callback or between passes) to abort a generation"""
+
+    def __init__(self, message: str = "Generation cancelled", steps_skipped: int = 0):
+        super().__init__(message)
+        self.steps_skipped = steps_skipped
+
+
+def expected_steps(params: dict) -> int:
+    """Denoising steps a pipeline call will actually run (img2img/inpaint skip the first 1-strength)"""
+    steps = int(params.get("num_inference_steps", 50))
+    strength = float(params.get("strength", 1.0))
+    return max(1, min(int(steps * strength), steps))
+
+
+def make_generator(seed: Optional[int]) -> torch.Generator:
+    """CPU generator (reproducible across devices); seed=None draws a random one"""
+    generator = torch.Generator()
+    if seed is None:
+        generator.seed()
+    else:
+        generator.manual_seed(int(seed))
+    return generator
+
+
+def compute_batch_key(mode: str, params: dict, fallback: str):
+    """Tasks with equal keys can run in the same pipeline call"""
+    image = params.get("image", params.get("latents"))
+    # Latent tensors have .shape (their .size is a method)
+    size = tuple(image.shape) if hasattr(image, "shape") else getattr(image, "size", None)
+    if len(params.get("controlnets") or ()) > 1:
+        # diffusers takes a single conditioning set per call with several ControlNets: run these solo
+        return (mode, fallback)
+    scalars = tuple(sorted((k, v) for k, v in params.items() if k not in BATCHED_PARAMS))
+    key = (mode, size, scalars)
+    try:
+        hash(key)
+    except TypeError:
+        # Unhashable options (tensors, callables) -> never batch this task
+        key = (mode, fallback)
+    return key
+
+
+class GenerationTask:
+    """One queued pipeline call producing a single image"""
+
+    def __init__(self, mode: str, params: dict, cancel_event: Optional[threading.Event] = None,
+                 on_step: Optional[Callable[..., None]] = None):
+        self.id = uuid.uuid4().hex
+        self.mode = mode
+        self.params = params
+        self.future: Future = Future()
+        self.batch_key = compute_batch_key(mode, params, self.id)
+        self.submitted_at = time.time()
+        self.started_at: Optional[float] = None
+        self.batch_size = 1
+        self.queue_position_at_submit = 0
+        self.cancel_event = cancel_event
+        self.on_step = on_step  # called as on_step(step, total_steps, latents) from the worker thread
+        self.group_size = 1  # > 1: variant of a submit_group() call, batched with its siblings
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancel_event is not None and self.cancel_event.is_set()
+
+
+class GenerationWorker:
+    """Queue + dedicated worker thread that owns the pipelines"""
+
+    def __init__(self, get_pipeline: Callable[[str], object], max_batch_size: int = 4, batch_window: float = 0.05,
+                 prompt_cache=None, source_cache=None, scheduler_pool=None,
+                 execution_context: Callable[[], ContextManager] = contextlib.nullcontext,
+                 vae_tile_workers: int = 1, controlnet_pool=None):
+        self.get_pipeline = get_pipeline
+        self.prompt_cache = prompt_cache  # optional PromptEmbeddingCache
+        self.source_cache = source_cache  # optional SourceCache (img2img source latents)
+        self.scheduler_pool = scheduler_pool  # optional SchedulerPool (per quality tier)
+        self.execution_context = execution_context  # entered around each call on the worker thread (e.g. autocast)
+        self.vae_tile_workers = vae_tile_workers  # parallel tiles when decoding large latents
+        self.controlnet_pool = controlnet_pool  # optional ControlNetPool (img2img ControlNets by name)
+        self.max_batch_size = max(1, max_batch_size)
+        self.batch_window = batch_window  # seconds to wait for batch-mates when idle
+        self._pending: List[GenerationTask] = []
+        self._running: List[GenerationTask] = []
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = False
+        self.stats = {"tasks_completed": 0, "tasks_failed": 0, "tasks_cancelled": 0,
+                      "batches": 0, "batched_tasks": 0, "aborted_runs": 0, "aborted_steps": 0}
+
+    # ---- lifecycle ----
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="generation-worker", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+    # ---- queue API ----
+    def submit(self, mode: str, cancel_event: Optional[threading.Event] = None,
+               on_step: Optional[Callable[..., None]] = None, **params) -> GenerationTask:
+        """Queue a pipeline call; the result (PIL image) arrives on task.future"""
+        task = GenerationTask(mode, params, cancel_event=cancel_event, on_step=on_step)
+        with self._cond:
+            self._pending.append(task)
+            task.queue_position_at_submit = len(self._pending)
+            self._cond.notify_all()
+        return task
+
+    def submit_group(self, mode: str, variants: List[dict], cancel_event: Optional[threading.Event] = None,
+                     on_step: Optional[Callable[..., None]] = None, **params) -> List[GenerationTask]:
+        """
+        Queue one pipeline call per variant (shared params + per-variant
+        overrides such as seed) so they run as a single batched call
+        """
+        tasks = [GenerationTask(mode, {**params, **variant}, cancel_event=cancel_event, on_step=on_step)
+                 for variant in variants]
+        with self._cond:
+            for task in tasks:
+                task.group_size = len(tasks)
+                self._pending.append(task)
+                task.queue_position_at_submit = len(self._pending)
+            self._cond.notify_all()
+        return tasks
+
+    def queue_position(self, task_id: str) -> Optional[int]:
+        """0 = running now, n = n-th in line, None = unknown or finished"""
+        with self._cond:
+            if any(t.id == task_id for t in self._running):
+                return 0
+            for index, task in enumerate(self._pending):
+                if task.id == task_id:
+                    return index + 1
+        return None
+
+    def status(self) -> Dict:
+        with self._cond:
+            return {
+                "running": [t.id for t in self._running],
+                "waiting": [{"task_id": t.id, "mode": t.mode, "position": i + 1} for i, t in enumerate(self._pending)],
+                "queue_depth": len(self._pending),
+                "max_batch_size": self.max_batch_size,
+                **self.stats,
+            }
+
+    # ---- worker thread ----
+    def _take_batch(self) -> List[GenerationTask]:
+        """Block until work is available, then pop the oldest task and its batch-mates"""
+        with self._cond:
+            while not self._pending and not self._stopped:
+                self._cond.wait()
+            if self._stopped:
+                return []
+            if self.batch_window > 0 and len(self._pending) < self.max_batch_size:
+                # Idle worker: give concurrent callers a moment to join the batch
+                self._cond.wait(self.batch_window)
+            head = self._pending[0]
+            # Variant groups were queued contiguously with equal keys: take the whole group
+            limit = max(self.max_batch_size, head.group_size)
+            candidates = [t for t in self._pending if t.batch_key == head.batch_key][:limit]
+            batch = []
+            for task in candidates:
+                self._pending.remove(task)
+                if task.cancelled:
+                    # Cancelled while queued: never start it
+                    steps = expected_steps(task.params)
+                    task.future.set_exception(GenerationCancelled(f"Task {task.id} cancelled before start", steps))
+                    self.stats["tasks_cancelled"] += 1
+                    self.stats["aborted_steps"] += steps
+                # Skips tasks whose caller already cancelled the future
+                elif task.future.set_running_or_notify_cancel():
+                    task.started_at = time.time()
+                    batch.append(task)
+            for task in batch:
+                task.batch_size = len(batch)
+            self._running = batch
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            if self._stopped:
+                return
+            if not batch:
+                continue
+            try:
+                with self.execution_context():
+                    images = self._execute(batch)
+                for task, image in zip(batch, images):
+                    task.future.set_result(image)
+                self.stats["tasks_completed"] += len(batch)
+            except GenerationCancelled as e:
+                for task in batch:
+                    if not task.future.done():
+                        task.future.set_exception(e)
+                self.stats["tasks_cancelled"] += len(batch)
+                self.stats["aborted_runs"] += 1
+                self.stats["aborted_steps"] += e.steps_skipped
+                print(f"✗ Aborted {batch[0].mode} run: {e}")
+            except Exception as e:
+                for task in batch:
+                    if not task.future.done():
+                        task.future.set_exception(e)
+                self.stats["tasks_failed"] += len(batch)
+            finally:
+                self.stats["batches"] += 1
+                if len(batch) > 1:
+                    self.stats["batched_tasks"] += len(batch)
+                with self._cond:
+                    self._running = []
+
+    def _execute(self, batch: List[GenerationTask]):
+        """Run one (possibly batched) pipeline call and return one image per task"""
+        head = batch[0]
+        pipeline = self.get_pipeline(head.mode)
+        if pipeline is None:
+            raise RuntimeError(f"{head.mode} pipeline not loaded")
+        if head.mode == "decode":
+            return self._decode(pipeline, batch, self.vae_tile_workers)
+
+        kwargs = {k: v for k, v in head.params.items() if k not in BATCHED_PARAMS}
+        for name in BATCHED_PARAMS:
+            if name in head.params:
+                values = [t.params.get(name) for t in batch]
+                kwargs[name] = values if len(batch) > 1 else values[0]
+
+        # CFG truncation: the pipeline's GuidanceController (if any) is armed for this call
+        cfg_end = kwargs.pop("cfg_end", None)
+        guidance = getattr(pipeline, "guidance_controller", None)
+        total_steps = expected_steps(head.params)
+        if guidance is not None:
+            # Without CFG (guidance_scale <= 1) the batch is not doubled - nothing to truncate
+            uses_cfg = float(head.params.get("guidance_scale", 7.5)) > 1.0
+            guidance.start(cfg_end if uses_cfg else None, total_steps)
+
+        # Quality tier picks the pooled scheduler (tier is part of the batch key)
+        tier = kwargs.pop("tier", "final")
+        if self.scheduler_pool is not None:
+            self.scheduler_pool.apply(pipeline, tier)
+
+        # DeepCache: reuse deep UNet features between full steps (interval is part of the batch key)
+        deepcache_interval = kwargs.pop("deepcache_interval", 0)
+        deepcache = getattr(pipeline, "deepcache", None)
+        if deepcache is not None:
+            deepcache.start(deepcache_interval)
+
+        # ControlNet(s) for this call; tasks without a choice get the pool's default
+        controlnets = kwargs.pop("controlnets", None)
+        if self.controlnet_pool is not None and getattr(pipeline, "controlnet", None) is not None:
+            controlnets = tuple(controlnets or (self.controlnet_pool.default,))
+            self.controlnet_pool.apply(pipeline, controlnets)
+        if isinstance(kwargs.get("controlnet_conditioning_scale"), tuple):
+            kwargs["controlnet_conditioning_scale"] = list(kwargs["controlnet_conditioning_scale"])
+
+        # Per-task seeds -> one generator per image, so batched results match solo runs
+        if "seed" in kwargs:
+            kwargs.pop("seed")
+            generators = [make_generator(t.params.get("seed")) for t in batch]
+            kwargs["generator"] = generators if len(batch) > 1 else generators[0]
+
+        # Regional calls (one prompt per mask) bring their own embeddings + attention kwargs
+        regions = kwargs.pop("regions", None)
+        if regions is not None:
+            kwargs.update(regions.pipeline_kwargs(pipeline, self.prompt_cache))
+
+        # Cached text embeddings replace prompt strings (skips the CLIP text encoder on hits)
+        if self.prompt_cache is not None and "prompt" in kwargs and hasattr(pipeline, "encode_prompt"):
+            prompts = [t.params["prompt"] for t in batch]
+            negatives = [t.params.get("negative_prompt") for t in batch]
+            kwargs.pop("prompt")
+            kwargs.pop("negative_prompt", None)
+            kwargs["prompt_embeds"], kwargs["negative_prompt_embeds"] = self.prompt_cache.encode_batch(
+                pipeline, prompts, negatives
+            )
+
+        # Cached VAE posteriors replace img2img source images (pipeline skips its VAE encode);
+        # each task's latents are sampled with its own generator, as the pipeline would
+        if self.source_cache is not None and head.mode == "img2img" and "image" in kwargs:
+            generators = kwargs.get("generator")
+            generators = generators if isinstance(generators, list) else [generators] * len(batch)
+            latents = [self.source_cache.latents(pipeline, t.params["image"], generator)
+                       for t, generator in zip(batch, generators)]
+            kwargs["image"] = latents if len(batch) > 1 else latents[0]
+
+        if (any(t.cancel_event is not None or t.on_step is not None for t in batch)
+                or (guidance is not None and guidance.active)):
+            kwargs["callback_on_step_end"] = self._step_callback(batch, total_steps, guidance)
+
+        if len(batch) > 1:
+            print(f"Batched {head.mode} call: {len(batch)} requests")
+        try:
+            return pipeline(**kwargs).images
+        finally:
+            if guidance is not None:
+                guidance.finish()
+            if deepcache is not None:
+                deepcache.finish()
+
+    @staticmethod
+    def _decode(pipeline, batch: List[GenerationTask], tile_workers: int = 1):
+        """
+        VAE-decode scaled latents (4, h, w) or (1, 4, h, w) into one PIL image
+        per task; latents larger than one VAE tile decode in blended tiles
+        """
+        vae = pipeline.vae
+        latents = torch.cat([t.params["latents"].reshape(1, *t.params["latents"].shape[-3:]) for t in batch])
+        if max(latents.shape[-2:]) > VAE_TILE:
+            decoded = torch.cat([tiled_vae_decode(vae, item[None], workers=tile_workers) for item in latents])
+        else:
+            with torch.no_grad():
+                decoded = vae.decode(latents.to(vae.dtype) / vae.config.scaling_factor, return_dict=False)[0]
+        return pipeline.image_processor.postprocess(decoded, output_type="pil")
+
+    def _step_callback(self, batch: List[GenerationTask], total_steps: int, guidance=None):
+        """
+        Diffusers callback_on_step_end: report progress (with this task's
+        current latents, for previews), abort once every task in the batch
+        is cancelled
+        """
+        def on_step_end(pipeline, step_index, timestep, callback_kwargs):
+            latents = callback_kwargs.get("latents")
+            for index, task in enumerate(batch):
+                if task.on_step is not None:
+                    task_latents = latents[index] if latents is not None and len(latents) == len(batch) else None
+                    task.on_step(step_index + 1, total_steps, task_latents)
+            if all(task.cancelled for task in batch):
+                done = step_index + 1
+                raise GenerationCancelled(f"Cancelled at step {done}/{total_steps}", steps_skipped=max(0, total_steps - done))
+            if guidance is not None:
+                guidance.after_step(step_index + 1)
+            return callback_kwargs
+        return on_step_end
@@ -0,0 +1,184 @@
+"""
+Generate service CPU benchmark: seconds per denoising step, legacy setup vs
+the CPU execution profile.
+
+Builds the img2img + ControlNet pipeline once per profile and runs
+fixed-seed generations on a synthetic room. Reports median seconds per
+denoising step (from step-callback timestamps, so prompt encoding, VAE and
+model loading are excluded) and end-to-end seconds per image.
+
+Profiles:
+    legacy     attention + VAE slicing, fp32 (the previous CPU setup)
+    optimized  app.cpu_profile: SDPA, channels_last, bf16 autocast if the
+               CPU has native bf16, optional torch.compile
+
+Usage (from artistry-backend/generate):
+    python benchmark_cpu.py                              # legacy vs optimized, JSON to stdout
+    python benchmark_cpu.py --steps 20 --runs 3 --threads 8
+    python benchmark_cpu.py --profiles optimized --compile --output cpu_bench.json
+"""
+
+import argparse
+import contextlib
+import gc
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+import cv2
+import numpy as np
+import torch
+from PIL import Image
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+from diffusers import EulerAncestralDiscreteScheduler  # noqa: E402
+from app.cpu_profile import CpuProfile, cpu_supports_bf16  # noqa: E402
+from app.models import PipelineRegistry  # noqa: E402
+
+PROMPT = "Modern minimalist bedroom redesign, neutral warm palette, photorealistic interior design photography"
+
+
+def synthetic_room(size=512, seed=0):
+    """Gradient background with furniture-like blocks so Canny has real edges"""
+    rng = np.random.default_rng(seed)
+    ramp = np.linspace(60, 200, size, dtype=np.float32)
+    image = np.repeat(np.repeat(ramp[None, :, None], size, axis=0), 3, axis=2).astype(np.uint8)
+    for _ in range(12):
+        color = tuple(int(c) for c in rng.integers(0, 255, 3))
+        x1, y1 = (int(v) for v in rng.integers(0, size - 64, 2))
+        x2, y2 = x1 + int(rng.integers(48, size // 3)), y1 + int(rng.integers(48, size // 3))
+        cv2.rectangle(image, (x1, y1), (min(x2, size - 1), min(y2, size - 1)), color, -1)
+    edges = cv2.cvtColor(cv2.Canny(image, 100, 200), cv2.COLOR_GRAY2RGB)
+    return Image.fromarray(image), Image.fromarray(edges)
+
+
+def build_profile(name, args):
+    """(CpuProfile or None, configure callback) for a profile name"""
+    if name == "legacy":
+        def configure(mode, pipeline):
+            pipeline.scheduler = EulerAncestralDiscreteScheduler.from_config(pipeline.scheduler.config)
+            pipeline.enable_attention_slicing()
+            pipeline.enable_vae_slicing()
+        return None, configure
+
+    profile = CpuProfile(
+        enabled=True,
+        bf16=cpu_supports_bf16() if args.bf16 == "auto" else args.bf16 == "1",
+        compile_unet=args.compile,
+        threads=args.threads,
+    )
+
+    def configure(mode, pipeline):
+        pipeline.scheduler = EulerAncestralDiscreteScheduler.from_config(pipeline.scheduler.config)
+        profile.configure(pipeline)
+        profile.compile(pipeline)
+    return profile, configure
+
+
+def run_profile(name, args, image, control_image):
+    profile, configure = build_profile(name, args)
+    registry = PipelineRegistry("cpu", torch.float32, args.base_model, args.inpaint_model, args.controlnet_model,
+                                configure=configure)
+    pipeline = registry.get("img2img")
+    autocast = profile.autocast if profile is not None else contextlib.nullcontext
+
+    def generate(seed):
+        stamps = []
+
+        def on_step_end(pipe, step_index, timestep, callback_kwargs):
+            stamps.append(time.perf_counter())
+            return callback_kwargs
+
+        start = time.perf_counter()
+        with autocast():
+            pipeline(
+                prompt=PROMPT,
+                image=image,
+                control_image=control_image,
+                strength=args.strength,
+                num_inference_steps=args.steps,
+                guidance_scale=7.5,
+                generator=torch.Generator().manual_seed(seed),
+                callback_on_step_end=on_step_end,
+            )
+        total = time.perf_counter() - start
+        return [b - a for a, b in zip(stamps, stamps[1:])], total
+
+    # Warm-up (allocator, oneDNN primitive cache, torch.compile tracing)
+    generate(0)
+
+    step_times, totals = [], []
+    for run in range(args.runs):
+        steps, total = generate(run)
+        step_times.extend(steps)
+        totals.append(total)
+
+    result = {
+        "profile": name,
+        "settings": profile.describe() if profile is not None else {"threads": torch.get_num_threads()},
+        "sec_per_step": round(statistics.median(step_times), 4),
+        "sec_per_image": round(statistics.median(totals), 3),
+        "steps_per_image": len(step_times) // args.runs + 1,
+        "runs": args.runs,
+    }
+
+    del pipeline, registry
+    gc.collect()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate service CPU sec/step benchmark")
+    parser.add_argument("--profiles", nargs="*", default=["legacy", "optimized"], choices=["legacy", "optimized"])
+    parser.add_argument("--steps", type=int, default=20)
+    parser.add_argument("--strength", type=float, default=0.55)
+    parser.add_argument("--runs", type=int, default=2)
+    parser.add_argument("--threads", type=int, default=0, help="Intra-op threads (0 = torch default)")
+    parser.add_argument("--bf16", default="auto", choices=["auto", "1", "0"])
+    parser.add_argument("--compile", action="store_true", help="torch.compile the UNet (optimized profile)")
+    parser.add_argument("--base-model", default="runwayml/stable-diffusion-v1-5")
+    parser.add_argument("--inpaint-model", default="runwayml/stable-diffusion-inpainting")
+    parser.add_argument("--controlnet-model", default="lllyasviel/sd-controlnet-canny")
+    parser.add_argument("--output", help="Write results JSON here (default: stdout)")
+    args = parser.parse_args()
+
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+
+    image, control_image = synthetic_room()
+    results = {
+        "meta": {
+            "cpu_count": os.cpu_count(),
+            "native_bf16": cpu_supports_bf16(),
+            "torch": torch.__version__,
+            "platform": platform.platform(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "cases": [],
+    }
+
+    for name in args.profiles:
+        case = run_profile(name, args, image, control_image)
+        results["cases"].append(case)
+        print(f"{name:<10} {case['sec_per_step']:>8.3f} s/step {case['sec_per_image']:>8.2f} s/image", file=sys.stderr)
+
+    by_name = {case["profile"]: case for case in results["cases"]}
+    if "legacy" in by_name and "optimized" in by_name:
+        results["speedup"] = round(by_name["legacy"]["sec_per_step"] / by_name["optimized"]["sec_per_step"], 2)
+        print(f"speedup    {results['speedup']:.2f}x per step", file=sys.stderr)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
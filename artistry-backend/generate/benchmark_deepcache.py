@@ -0,0 +1,208 @@
+"""
+Generate service DeepCache benchmark: speed and quality of UNet feature
+caching against the uncached pipelines.
+
+For each mode (img2img + ControlNet, inpaint) and each cache interval, runs
+the same fixed-seed generations on a synthetic room and compares every
+image with the uncached (interval 0) image of the same seed. Reports median
+seconds per image, speedup, and the perceptual difference: LPIPS (AlexNet)
+when the `lpips` package is installed, plus SSIM and PSNR which need
+nothing extra.
+
+Usage (from artistry-backend/generate):
+    python benchmark_deepcache.py                          # intervals 0 2 3 5, both modes, JSON to stdout
+    python benchmark_deepcache.py --modes inpaint --intervals 0 3 --steps 30
+    python benchmark_deepcache.py --seeds 1 2 3 --output deepcache_bench.json --save-images out/
+"""
+
+import argparse
+import gc
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+import cv2
+import numpy as np
+import torch
+from PIL import Image
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+from diffusers import EulerAncestralDiscreteScheduler  # noqa: E402
+from app.deepcache import DeepCacheController  # noqa: E402
+from app.models import PipelineRegistry  # noqa: E402
+from benchmark_cpu import PROMPT, synthetic_room  # noqa: E402
+
+INPAINT_PROMPT = "a mid-century modern armchair, walnut legs, photorealistic"
+
+
+def center_mask(size=512):
+    mask = np.zeros((size, size), dtype=np.uint8)
+    mask[size // 4: 3 * size // 4, size // 4: 3 * size // 4] = 255
+    return Image.fromarray(mask)
+
+
+# ---- metrics ----
+def ssim(a: np.ndarray, b: np.ndarray) -> float:
+    """Mean SSIM on grayscale uint8 images (11x11 Gaussian window, sigma 1.5)"""
+    a = cv2.cvtColor(a, cv2.COLOR_RGB2GRAY).astype(np.float64)
+    b = cv2.cvtColor(b, cv2.COLOR_RGB2GRAY).astype(np.float64)
+    c1, c2 = (0.01 * 255) ** 2, (0.03 * 255) ** 2
+    blur = lambda x: cv2.GaussianBlur(x, (11, 11), 1.5)  # noqa: E731
+    mu_a, mu_b = blur(a), blur(b)
+    var_a = blur(a * a) - mu_a ** 2
+    var_b = blur(b * b) - mu_b ** 2
+    cov = blur(a * b) - mu_a * mu_b
+    score = ((2 * mu_a * mu_b + c1) * (2 * cov + c2)) / ((mu_a ** 2 + mu_b ** 2 + c1) * (var_a + var_b + c2))
+    return float(score.mean())
+
+
+def psnr(a: np.ndarray, b: np.ndarray) -> float:
+    mse = np.mean((a.astype(np.float64) - b.astype(np.float64)) ** 2)
+    return float("inf") if mse == 0 else float(10 * np.log10(255.0 ** 2 / mse))
+
+
+class Lpips:
+    """LPIPS distance if the lpips package is available, else None"""
+
+    def __init__(self):
+        try:
+            import lpips
+            self.model = lpips.LPIPS(net="alex", verbose=False)
+        except ImportError:
+            self.model = None
+            print("⚠ lpips not installed - reporting SSIM/PSNR only", file=sys.stderr)
+
+    def __call__(self, a: np.ndarray, b: np.ndarray):
+        if self.model is None:
+            return None
+        to_tensor = lambda x: torch.from_numpy(x).permute(2, 0, 1)[None].float() / 127.5 - 1  # noqa: E731
+        with torch.no_grad():
+            return float(self.model(to_tensor(a), to_tensor(b)).item())
+
+
+# ---- runs ----
+def configure(mode, pipeline):
+    if mode == "img2img":
+        pipeline.scheduler = EulerAncestralDiscreteScheduler.from_config(pipeline.scheduler.config)
+    pipeline.deepcache = DeepCacheController(pipeline)
+
+
+def run_mode(mode, registry, args, inputs):
+    pipeline = registry.get(mode)
+    image, control_image, mask = inputs
+
+    def generate(seed, interval):
+        kwargs = {
+            "num_inference_steps": args.steps,
+            "guidance_scale": 7.5,
+            "generator": torch.Generator().manual_seed(seed),
+        }
+        if mode == "img2img":
+            kwargs.update(prompt=PROMPT, image=image, control_image=control_image, strength=args.strength)
+        else:
+            kwargs.update(prompt=INPAINT_PROMPT, image=image, mask_image=mask)
+        pipeline.deepcache.start(interval)
+        start = time.perf_counter()
+        try:
+            result = pipeline(**kwargs).images[0]
+        finally:
+            pipeline.deepcache.finish()
+        return result, time.perf_counter() - start
+
+    generate(args.seeds[0], 0)  # warm-up
+
+    images, timings = {}, {}
+    for interval in args.intervals:
+        for seed in args.seeds:
+            images[(interval, seed)], seconds = generate(seed, interval)
+            timings.setdefault(interval, []).append(seconds)
+            if args.save_images:
+                os.makedirs(args.save_images, exist_ok=True)
+                images[(interval, seed)].save(os.path.join(args.save_images, f"{mode}_n{interval}_s{seed}.png"))
+    return images, timings
+
+
+def score_mode(mode, images, timings, args, lpips_metric):
+    baseline = statistics.median(timings[0])
+    cases = []
+    for interval in args.intervals:
+        ssims, psnrs, lpipses = [], [], []
+        for seed in args.seeds:
+            reference = np.array(images[(0, seed)].convert("RGB"))
+            candidate = np.array(images[(interval, seed)].convert("RGB"))
+            ssims.append(ssim(reference, candidate))
+            psnrs.append(psnr(reference, candidate))
+            lpipses.append(lpips_metric(reference, candidate))
+        seconds = statistics.median(timings[interval])
+        cases.append({
+            "mode": mode,
+            "interval": interval,
+            "sec_per_image": round(seconds, 3),
+            "speedup": round(baseline / seconds, 2),
+            "ssim": round(statistics.mean(ssims), 4),
+            "psnr": round(statistics.mean(p for p in psnrs if p != float("inf")), 2) if interval else None,
+            "lpips": round(statistics.mean(lpipses), 4) if lpipses[0] is not None else None,
+        })
+    return cases
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate service DeepCache speed/quality benchmark")
+    parser.add_argument("--modes", nargs="*", default=["img2img", "inpaint"], choices=["img2img", "inpaint"])
+    parser.add_argument("--intervals", nargs="*", type=int, default=[0, 2, 3, 5])
+    parser.add_argument("--seeds", nargs="*", type=int, default=[0, 1, 2])
+    parser.add_argument("--steps", type=int, default=25)
+    parser.add_argument("--strength", type=float, default=0.55)
+    parser.add_argument("--base-model", default="runwayml/stable-diffusion-v1-5")
+    parser.add_argument("--inpaint-model", default="runwayml/stable-diffusion-inpainting")
+    parser.add_argument("--controlnet-model", default="lllyasviel/sd-controlnet-canny")
+    parser.add_argument("--save-images", help="Directory for the generated images")
+    parser.add_argument("--output", help="Write results JSON here (default: stdout)")
+    args = parser.parse_args()
+    if 0 not in args.intervals:
+        args.intervals.insert(0, 0)  # the uncached reference
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    dtype = torch.float16 if device == "cuda" else torch.float32
+    registry = PipelineRegistry(device, dtype, args.base_model, args.inpaint_model, args.controlnet_model,
+                                configure=configure)
+    image, control_image = synthetic_room()
+    inputs = (image, control_image, center_mask())
+    lpips_metric = Lpips()
+
+    results = {
+        "meta": {
+            "device": device,
+            "steps": args.steps,
+            "seeds": args.seeds,
+            "torch": torch.__version__,
+            "platform": platform.platform(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "cases": [],
+    }
+
+    for mode in args.modes:
+        images, timings = run_mode(mode, registry, args, inputs)
+        for case in score_mode(mode, images, timings, args, lpips_metric):
+            results["cases"].append(case)
+            lpips_text = f" lpips {case['lpips']:.4f}" if case["lpips"] is not None else ""
+            print(f"{mode:<8} N={case['interval']:<2} {case['sec_per_image']:>7.2f} s/image "
+                  f"{case['speedup']:>5.2f}x ssim {case['ssim']:.4f}{lpips_text}", file=sys.stderr)
+        gc.collect()
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
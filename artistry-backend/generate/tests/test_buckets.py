@@ -0,0 +1,72 @@
+"""Resolution buckets: rounding to the 64 px grid, side/pixel limits and the aspect round-trip."""
+
+import math
+
+import pytest
+
+Image = pytest.importorskip("PIL.Image")
+
+from app.buckets import bucket_size, bucket_sizes, to_bucket, to_original_aspect  # noqa: E402
+
+LIMITS = {"max_pixels": 512 * 512, "min_side": 256, "max_side": 1024}
+
+
+def test_bucket_sizes_respect_grid_and_limits():
+    buckets = bucket_sizes(**LIMITS)
+    assert (512, 512) in buckets
+    for width, height in buckets:
+        assert width % 64 == 0 and height % 64 == 0
+        assert 256 <= width <= 1024 and 256 <= height <= 1024
+        assert width * height <= 512 * 512
+
+
+def test_square_and_common_aspects():
+    assert bucket_size((1024, 1024), **LIMITS) == (512, 512)
+    assert bucket_size((300, 300), **LIMITS) == (512, 512)  # small inputs scale up to the budget
+    assert bucket_size((1920, 1080), **LIMITS) == (576, 320)  # 16:9 stays wide
+    assert bucket_size((1080, 1920), **LIMITS) == (320, 576)
+
+
+def test_bucket_aspect_within_tolerance():
+    for size in [(1920, 1080), (1600, 1200), (1200, 1600), (3000, 2000), (2048, 1536)]:
+        width, height = bucket_size(size, **LIMITS)
+        assert abs(math.log(width / height) - math.log(size[0] / size[1])) <= 0.05
+
+
+def test_extreme_aspect_falls_back_to_closest_bucket():
+    # 10:1 is outside the side limits: the widest allowed bucket wins
+    assert bucket_size((5000, 500), **LIMITS) == (1024, 256)
+    assert bucket_size((500, 5000), **LIMITS) == (256, 1024)
+
+
+def test_pixel_budget_scales_bucket():
+    assert bucket_size((1024, 1024), max_pixels=768 * 768, min_side=256, max_side=1024) == (768, 768)
+
+
+def test_to_bucket_resizes_and_masks_stay_binary():
+    image = Image.new("RGB", (1920, 1080))
+    assert to_bucket(image).size == bucket_size((1920, 1080))
+
+    mask = Image.new("L", (1920, 1080))
+    mask.paste(255, (400, 200, 1200, 900))
+    resized = to_bucket(mask, (576, 320), mask=True)
+    assert {value for value, count in enumerate(resized.histogram()) if count} == {0, 255}
+
+
+def test_to_bucket_same_size_is_noop():
+    image = Image.new("RGB", (512, 512))
+    assert to_bucket(image, (512, 512)) is image
+
+
+@pytest.mark.parametrize("original", [(1920, 1080), (1600, 1200), (1000, 1500), (1234, 567)])
+def test_original_aspect_round_trip(original):
+    bucketed = to_bucket(Image.new("RGB", original))
+    restored = to_original_aspect(bucketed, original)
+    # Exact original aspect (to rounding), same pixel count as the bucket
+    assert abs(restored.width / restored.height - original[0] / original[1]) < 0.01
+    assert abs(restored.width * restored.height - bucketed.width * bucketed.height) <= bucketed.width + bucketed.height
+
+
+def test_original_aspect_noop_when_already_matching():
+    image = Image.new("RGB", (512, 512))
+    assert to_original_aspect(image, (1000, 1000)) is image
@@ -0,0 +1,91 @@
+"""GenerationWorker batching, run against a recording stand-in for the diffusers pipeline."""
+
+import threading
+
+import pytest
+
+pytest.importorskip("torch")
+Image = pytest.importorskip("PIL.Image")
+
+from app.worker import GenerationWorker, compute_batch_key  # noqa: E402
+
+
+class RecordingPipeline:
+    """Returns one image per prompt and records the kwargs of every call"""
+
+    def __init__(self):
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def __call__(self, **kwargs):
+        with self.lock:
+            self.calls.append(kwargs)
+        prompts = kwargs["prompt"] if isinstance(kwargs["prompt"], list) else [kwargs["prompt"]]
+
+        class Output:
+            images = [Image.new("RGB", (8, 8)) for _ in prompts]
+
+        return Output()
+
+
+def multi_net_params(prompt, seed):
+    return {
+        "prompt": prompt,
+        "image": Image.new("RGB", (64, 64)),
+        "control_image": [Image.new("RGB", (64, 64)), Image.new("RGB", (64, 64))],
+        "controlnets": ("canny", "depth"),
+        "controlnet_conditioning_scale": (1.0, 0.5),
+        "num_inference_steps": 2,
+        "seed": seed,
+    }
+
+
+def run_worker(pipeline, submit):
+    worker = GenerationWorker(lambda mode: pipeline, max_batch_size=4, batch_window=0.2)
+    tasks = submit(worker)  # queued before the worker starts: all candidates for one batch
+    worker.start()
+    try:
+        return [task.future.result(timeout=30) for task in tasks]
+    finally:
+        worker.stop()
+
+
+def test_multi_controlnet_tasks_get_distinct_batch_keys():
+    a = compute_batch_key("img2img", multi_net_params("a", 1), "task-a")
+    b = compute_batch_key("img2img", multi_net_params("b", 2), "task-b")
+    assert a != b
+
+
+def test_single_controlnet_tasks_still_batch():
+    params = {**multi_net_params("a", 1), "controlnets": ("canny",), "controlnet_conditioning_scale": 1.0}
+    assert compute_batch_key("img2img", params, "task-a") == compute_batch_key("img2img", dict(params), "task-b")
+
+
+def test_two_multi_controlnet_tasks_run_as_separate_calls():
+    pipeline = RecordingPipeline()
+    results = run_worker(pipeline, lambda worker: [
+        worker.submit("img2img", **multi_net_params("first", 1)),
+        worker.submit("img2img", **multi_net_params("second", 2)),
+    ])
+
+    assert len(results) == 2
+    assert len(pipeline.calls) == 2
+    for call in pipeline.calls:
+        # One conditioning set per call: a flat list with one map per ControlNet, one scale per net
+        assert isinstance(call["prompt"], str)
+        assert len(call["control_image"]) == 2
+        assert all(isinstance(m, Image.Image) for m in call["control_image"])
+        assert call["controlnet_conditioning_scale"] == [1.0, 0.5]
+
+
+def test_multi_controlnet_variants_run_one_at_a_time():
+    pipeline = RecordingPipeline()
+    params = multi_net_params("variants", 0)
+    params.pop("seed")
+    results = run_worker(pipeline, lambda worker: worker.submit_group(
+        "img2img", [{"seed": 1}, {"seed": 2}, {"seed": 3}], **params
+    ))
+
+    assert len(results) == 3
+    assert len(pipeline.calls) == 3
+    assert all(len(call["control_image"]) == 2 for call in pipeline.calls)
@@ -1,4 +1,4 @@
-from fastapi import FastAPI, File, UploadFile
+from fastapi import FastAPI, File, UploadFile, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 import torch, base64, io, numpy as np
@@ -8,7 +8,15 @@ import sys
 import cv2
 from mobile_sam import sam_model_registry, SamPredictor
 from functools import lru_cache
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 import gc
+import hashlib
+import threading
+import time
+from app.sam_onnx import OnnxSamPredictor
+from app.postprocess import PostprocessOptions, postprocess_masks
 
 
 app = FastAPI(title="MobileSAM Service (Optimized)")
@@ -25,14 +33,33 @@ app.add_middleware(
 device = "cuda" if torch.cuda.is_available() else "cpu"
 model_type = "vit_t"  # tiny variant for MobileSAM
 
+# Runtime switch: "pytorch" (eager vit_t) or "onnx" (exported graphs, see export_onnx.py)
+SAM_RUNTIME = os.getenv("SAM_RUNTIME", "pytorch").lower()
+SAM_ONNX_QUANTIZED = os.getenv("SAM_ONNX_QUANTIZED", "0") == "1"
+SAM_ONNX_THREADS = int(os.getenv("SAM_ONNX_THREADS", "0"))  # 0 = onnxruntime default
+
 # Lazy loading for optimization
 sam = None
 predictor = None
 
+def resolve_model_path(filename):
+    """Look next to this file first, then fall back to the current directory"""
+    path = os.path.join(os.path.dirname(__file__), filename)
+    return path if os.path.exists(path) else filename
+
+def load_onnx_predictor():
+    """Load the ONNX encoder/decoder pair (INT8 variants when SAM_ONNX_QUANTIZED=1)"""
+    suffix = ".quant.onnx" if SAM_ONNX_QUANTIZED else ".onnx"
+    encoder_path = os.getenv("SAM_ONNX_ENCODER", resolve_model_path(f"mobile_sam_encoder{suffix}"))
+    decoder_path = os.getenv("SAM_ONNX_DECODER", resolve_model_path(f"mobile_sam_decoder{suffix}"))
+    return OnnxSamPredictor(encoder_path, decoder_path, num_threads=SAM_ONNX_THREADS)
+
 def get_sam_predictor():
     """Lazy load SAM model with caching"""
     global sam, predictor
-    if predictor is None:
+    if predictor is None and SAM_RUNTIME == "onnx":
+        predictor = load_onnx_predictor()
+    elif predictor is None:
         # Use relative path from current directory
         sam_checkpoint = os.path.join(os.path.dirname(__file__), "mobile_sam.pt")
         if not os.path.exists(sam_checkpoint):
@@ -48,24 +75,26 @@ def get_sam_predictor():
 @app.on_event("startup")
 async def startup_event():
     """Preload SAM model during startup"""
-    print(f"Loading MobileSAM model on {device}...")
+    print(f"Loading MobileSAM model ({SAM_RUNTIME} runtime) on {device}...")
     get_sam_predictor()
     print("✓ MobileSAM model loaded and optimized")
 
 @app.get("/")
 def root():
     """Root endpoint"""
-    return {"status": "ok", "service": "Segment (MobileSAM)", "device": device}
+    return {"status": "ok", "service": "Segment (MobileSAM)", "device": device, "runtime": SAM_RUNTIME}
 
 @app.get("/health")
 def health():
     """Health check endpoint"""
-    return {"status": "ok", "service": "Segment (MobileSAM)", "device": device}
+    return {"status": "ok", "service": "Segment (MobileSAM)", "device": device, "runtime": SAM_RUNTIME}
 
 class SegmentReq(BaseModel):
-    image_b64: str
+    image_b64: str | None = None
+    image_hash: str | None = None  # Content hash from /segment/prepare (instead of image_b64)
     bboxes: list | None = []
     enable_edge_refinement: bool = True  # Toggle for edge refinement
+    postprocess: PostprocessOptions = PostprocessOptions()
 
 @lru_cache(maxsize=64)
 def decode_image_cached(b64: str):
@@ -76,6 +105,140 @@ def decode_image_cached(b64: str):
 def decode_image(b64):
     return decode_image_cached(b64)
 
+def content_hash(b64: str) -> str:
+    """SHA-256 of the raw image bytes (what clients hash on their side)"""
+    return hashlib.sha256(base64.b64decode(b64)).hexdigest()
+
+# ---- Image embedding cache ----
+# The encoder is the expensive half of SAM and does not need boxes, so
+# /segment/prepare can run it while the caller is still waiting on detect.
+EMBEDDING_CACHE_SIZE = int(os.getenv("SEGMENT_EMBEDDING_CACHE_SIZE", "16"))
+# How long a request waits on another request's encode before encoding itself
+ENCODE_WAIT_S = float(os.getenv("SEGMENT_ENCODE_WAIT_S", "30"))
+
+class EmbeddingEntry:
+    """Encoder output for one image plus what the decoder needs to restore it"""
+    def __init__(self, image, features, original_size, input_size):
+        self.image = image
+        self.features = features
+        self.original_size = original_size
+        self.input_size = input_size
+
+embedding_cache = OrderedDict()  # content hash -> EmbeddingEntry (LRU)
+pending_encodes = {}  # content hash -> threading.Event for in-flight encodes
+embedding_lock = threading.Lock()  # guards embedding_cache and pending_encodes
+predictor_lock = threading.Lock()  # the predictor holds per-image state
+# Encodes started by /segment/prepare; they serialize on predictor_lock anyway
+encode_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sam-encode")
+
+def get_cached_embedding(key):
+    with embedding_lock:
+        entry = embedding_cache.get(key)
+        if entry is not None:
+            embedding_cache.move_to_end(key)
+        return entry
+
+def wait_for_embedding(key):
+    """
+    Cached embedding for `key`, waiting for an in-flight encode (e.g. from
+    /segment/prepare) to finish first. None if there is neither, or the
+    encode failed or did not finish within ENCODE_WAIT_S.
+    """
+    with embedding_lock:
+        entry = embedding_cache.get(key)
+        if entry is not None:
+            embedding_cache.move_to_end(key)
+            return entry
+        event = pending_encodes.get(key)
+    if event is None:
+        return None
+    if not event.wait(ENCODE_WAIT_S):
+        print(f"⚠ Encode for {key[:12]} still running after {ENCODE_WAIT_S:g}s")
+    return get_cached_embedding(key)
+
+def claim_encode(key):
+    """
+    Register an in-flight encode for `key` and return its Event, or None if
+    the image is already cached or being encoded. The claimer must finish
+    with run_encode/release_encode so waiters wake up.
+    """
+    with embedding_lock:
+        if key in embedding_cache or key in pending_encodes:
+            return None
+        event = pending_encodes[key] = threading.Event()
+        return event
+
+def release_encode(key, event):
+    with embedding_lock:
+        pending_encodes.pop(key, None)
+    event.set()
+
+def store_embedding(key, image):
+    """Run the encoder on `image` and cache the result under `key`"""
+    predictor = get_sam_predictor()
+    with predictor_lock:
+        predictor.set_image(image)
+        entry = EmbeddingEntry(image, predictor.features, predictor.original_size, predictor.input_size)
+    with embedding_lock:
+        embedding_cache[key] = entry
+        while len(embedding_cache) > EMBEDDING_CACHE_SIZE:
+            embedding_cache.popitem(last=False)
+    return entry
+
+def run_encode(key, image, event):
+    """Run the encoder for a claimed key, cache the result and wake the waiters"""
+    try:
+        return store_embedding(key, image)
+    finally:
+        release_encode(key, event)
+
+def encode_embedding(key, image):
+    """
+    Return the embedding for `key`, running the encoder at most once per image.
+    Concurrent callers for the same image wait (bounded) for the in-flight
+    encode and encode the image themselves if it does not deliver.
+    """
+    entry = wait_for_embedding(key)
+    if entry is not None:
+        return entry
+    event = claim_encode(key)
+    if event is not None:
+        return run_encode(key, image, event)
+    # Another encode claimed it in between: give it one wait, then encode here rather than hang
+    entry = wait_for_embedding(key)
+    return entry if entry is not None else store_embedding(key, image)
+
+def restore_embedding(predictor, entry: EmbeddingEntry):
+    """Point the predictor at a cached embedding (call with predictor_lock held)"""
+    predictor.features = entry.features
+    predictor.original_size = entry.original_size
+    predictor.input_size = entry.input_size
+    predictor.is_image_set = True
+
+def prepare_embedding(key, b64, event):
+    """Executor job for /segment/prepare: decode and encode a claimed key"""
+    try:
+        image = decode_image(b64)
+    except Exception as e:
+        release_encode(key, event)
+        print(f"⚠ Background decode failed for {key[:12]}: {e}")
+        return
+    try:
+        run_encode(key, image, event)
+    except Exception as e:
+        print(f"⚠ Background encode failed for {key[:12]}: {e}")
+
+def start_encode(key, b64):
+    """Claim `key` and hand the encode to encode_executor in the same step, so a claim never outlives its work"""
+    event = claim_encode(key)
+    if event is None:
+        return
+    try:
+        encode_executor.submit(prepare_embedding, key, b64, event)
+    except RuntimeError:
+        release_encode(key, event)  # executor shut down
+        raise
+
 def generate_canny_edges(image, low_threshold=50, high_threshold=150):
     """
     Generate Canny edge map for edge refinement
@@ -110,54 +273,145 @@ def refine_mask_with_edges(mask, edge_map, dilation_kernel_size=3):
     
     return refined_mask.astype(bool)
 
+class StageTimer:
+    """Accumulates per-stage wall time (ms) for the response"""
+    def __init__(self):
+        self.timings = {}
+    
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = (time.perf_counter() - start) * 1000
+            self.timings[name] = round(self.timings.get(name, 0.0) + elapsed, 2)
+
+def predict_box_masks(predictor, boxes):
+    """
+    Decode one mask per box (xyxy in original image coordinates) in a single
+    batched decoder call. Works for both the PyTorch and ONNX runtimes.
+    """
+    if isinstance(predictor, OnnxSamPredictor):
+        return predictor.predict_boxes(boxes)
+    
+    boxes_torch = torch.as_tensor(boxes, dtype=torch.float, device=device)
+    # predict_torch expects boxes in the resized (1024) input frame
+    boxes_torch = predictor.transform.apply_boxes_torch(boxes_torch, predictor.original_size)
+    masks, _, _ = predictor.predict_torch(
+        point_coords=None,
+        point_labels=None,
+        boxes=boxes_torch,
+        multimask_output=False
+    )
+    return masks[:, 0].cpu().numpy()
+
+def embedding_key(req) -> str:
+    """Cache key for a request: the hash of image_b64 when sent (a client hash is only trusted alone)"""
+    if req.image_b64:
+        return content_hash(req.image_b64)
+    if req.image_hash:
+        return req.image_hash
+    raise HTTPException(status_code=400, detail="image_b64 or image_hash is required")
+
 @app.post("/segment")
 def segment(req: SegmentReq):
-    """Optimized segmentation with optional edge refinement"""
-    image = decode_image(req.image_b64)
+    """Optimized segmentation with optional edge refinement and mask post-processing"""
+    timer = StageTimer()
+    key = embedding_key(req)
+    
+    # Reuse the embedding from /segment/prepare (or wait for its in-flight encode)
+    with timer.stage("wait"):
+        entry = wait_for_embedding(key)
+    embedding_cached = entry is not None
+    if entry is None:
+        if not req.image_b64:
+            raise HTTPException(status_code=404, detail="Unknown image_hash; send image_b64 or call /segment/prepare")
+        with timer.stage("decode"):
+            image = decode_image(req.image_b64)
+        with timer.stage("encoder"):
+            entry = encode_embedding(key, image)
+    image = entry.image
+    
     predictor = get_sam_predictor()
-    predictor.set_image(image)
+    bboxes = req.bboxes or []
+    raw_masks = []
+    if bboxes:
+        with timer.stage("decoder"):
+            boxes_np = np.array([[box["x1"], box["y1"], box["x2"], box["y2"]] for box in bboxes])
+            with predictor_lock:
+                restore_embedding(predictor, entry)
+                raw_masks = predict_box_masks(predictor, boxes_np)
     
-    # Generate edge map for refinement if enabled
-    edge_map = generate_canny_edges(image) if req.enable_edge_refinement else None
+    # EDGE REFINEMENT: sharpen boundaries (if enabled)
+    with timer.stage("refinement"):
+        if req.enable_edge_refinement and bboxes:
+            edge_map = generate_canny_edges(image)
+            refined_masks = [refine_mask_with_edges(mask_raw, edge_map) for mask_raw in raw_masks]
+        else:
+            refined_masks = list(raw_masks)
     
-    masks = []
-    for box in req.bboxes or []:
-        box_np = np.array([[box["x1"], box["y1"], box["x2"], box["y2"]]])
-        mask, _, _ = predictor.predict_torch(
-            point_coords=None,
-            point_labels=None,
-            boxes=torch.tensor(box_np, device=device),
-            multimask_output=False
-        )
-        mask_raw = mask[0][0].cpu().numpy()
-        
-        # EDGE REFINEMENT: sharpen boundaries (if enabled)
-        if req.enable_edge_refinement and edge_map is not None:
-            mask_refined = refine_mask_with_edges(mask_raw, edge_map)
+    # POST-PROCESSING: speckle removal, hole fill, feathering (per ROI, in parallel)
+    with timer.stage("postprocess"):
+        if req.postprocess.enabled:
+            mask_imgs = postprocess_masks(refined_masks, bboxes, req.postprocess)
         else:
-            mask_refined = mask_raw
-        
-        mask_img = (mask_refined * 255).astype(np.uint8)
-        mask_b64 = base64.b64encode(Image.fromarray(mask_img).tobytes()).decode()
-        masks.append({"bbox": box, "mask_b64": mask_b64})
+            mask_imgs = [(mask * 255).astype(np.uint8) for mask in refined_masks]
+    
+    masks = []
+    with timer.stage("encoding"):
+        for box, mask_img in zip(bboxes, mask_imgs):
+            mask_b64 = base64.b64encode(Image.fromarray(mask_img).tobytes()).decode()
+            masks.append({"bbox": box, "mask_b64": mask_b64})
     
     # Clean up memory
     if device == "cuda":
         torch.cuda.empty_cache()
         
-    return {"masks": masks}
+    return {"masks": masks, "image_hash": key, "embedding_cached": embedding_cached, "timings": timer.timings}
+
+class PrepareReq(BaseModel):
+    image_b64: str | None = None
+    image_hash: str | None = None
+
+@app.post("/segment/prepare")
+def segment_prepare(req: PrepareReq):
+    """
+    Start encoding an image in the background so a later /segment call with
+    boxes only runs the decoder. Returns the content hash to reuse as image_hash.
+    """
+    key = embedding_key(req)
+    
+    if get_cached_embedding(key) is not None:
+        return {"image_hash": key, "status": "ready"}
+    if not req.image_b64:
+        with embedding_lock:
+            encoding = key in pending_encodes
+        if not encoding:
+            raise HTTPException(status_code=404, detail="Unknown image_hash; send image_b64 to encode it")
+        return {"image_hash": key, "status": "encoding"}
+    
+    # Claimed and queued before responding, so a /segment call right behind this one waits instead of 404-ing
+    start_encode(key, req.image_b64)
+    return {"image_hash": key, "status": "encoding"}
 
 @app.post("/segment/")
-async def segment_file(file: UploadFile = File(...), num_samples: int = 10):
+def segment_file(file: UploadFile = File(...), num_samples: int = 10, postprocess: bool = True):
     """File upload endpoint for frontend integration with edge refinement"""
-    file_bytes = await file.read()
-    img = Image.open(io.BytesIO(file_bytes)).convert("RGB")
-    image = np.array(img)
+    # Plain def like /segment: the encode (or waiting on another request's) blocks, so keep it off the event loop
+    timer = StageTimer()
+    file_bytes = file.file.read()
+    with timer.stage("decode"):
+        img = Image.open(io.BytesIO(file_bytes)).convert("RGB")
+        image = np.array(img)
     
-    predictor.set_image(image)
+    # Shares the embedding cache with /segment and /segment/prepare
+    with timer.stage("encoder"):
+        entry = encode_embedding(hashlib.sha256(file_bytes).hexdigest(), image)
     
     # Generate edge map for refinement
-    edge_map = generate_canny_edges(image)
+    with timer.stage("refinement"):
+        edge_map = generate_canny_edges(image)
     
     # Generate automatic grid of sample points
     h, w = image.shape[:2]
@@ -177,39 +431,51 @@ async def segment_file(file: UploadFile = File(...), num_samples: int = 10):
     labels_np = np.array(labels)
     
     # Predict masks
-    masks_list = []
-    segmented_img = image.copy()
-    
-    for point, label in zip(points_np, labels_np):
-        mask, _, _ = predictor.predict(
-            point_coords=point.reshape(1, 2),
-            point_labels=np.array([label]),
-            multimask_output=False
-        )
-        mask_raw = mask[0]
-        
-        # EDGE REFINEMENT: sharpen boundaries
-        mask_refined = refine_mask_with_edges(mask_raw, edge_map)
-        
-        masks_list.append(mask_refined)
-        
-        # Overlay mask with random color
-        color = np.random.randint(0, 255, 3)
-        segmented_img[mask_refined] = segmented_img[mask_refined] * 0.5 + color * 0.5
+    raw_masks = []
+    predictor = get_sam_predictor()
+    with timer.stage("decoder"), predictor_lock:
+        restore_embedding(predictor, entry)
+        for point, label in zip(points_np, labels_np):
+            mask, _, _ = predictor.predict(
+                point_coords=point.reshape(1, 2),
+                point_labels=np.array([label]),
+                multimask_output=False
+            )
+            raw_masks.append(mask[0])
     
-    # Convert segmented image to base64
-    segmented_pil = Image.fromarray(segmented_img.astype(np.uint8))
-    buffer = io.BytesIO()
-    segmented_pil.save(buffer, format="PNG")
-    segmented_b64 = f"data:image/png;base64,{base64.b64encode(buffer.getvalue()).decode()}"
+    # EDGE REFINEMENT: sharpen boundaries
+    with timer.stage("refinement"):
+        masks_list = [refine_mask_with_edges(mask_raw, edge_map) for mask_raw in raw_masks]
     
-    # Convert numpy masks to lists for JSON serialization
-    masks_serializable = [mask.tolist() for mask in masks_list]
+    # POST-PROCESSING: ROI = each mask's bounding rect (no boxes on this endpoint)
+    if postprocess:
+        with timer.stage("postprocess"):
+            opts = PostprocessOptions()
+            cleaned = postprocess_masks(masks_list, [None] * len(masks_list), opts)
+            masks_list = [mask > 0 for mask in cleaned]
+    
+    with timer.stage("encoding"):
+        # Overlay masks with random colors
+        segmented_img = image.copy()
+        for mask_refined in masks_list:
+            color = np.random.randint(0, 255, 3)
+            segmented_img[mask_refined] = segmented_img[mask_refined] * 0.5 + color * 0.5
+        
+        # Convert segmented image to base64
+        segmented_pil = Image.fromarray(segmented_img.astype(np.uint8))
+        buffer = io.BytesIO()
+        segmented_pil.save(buffer, format="PNG")
+        segmented_b64 = f"data:image/png;base64,{base64.b64encode(buffer.getvalue()).decode()}"
+        
+        # Convert numpy masks to lists for JSON serialization
+        masks_serializable = [mask.tolist() for mask in masks_list]
     
     return {
         "segmented_image": segmented_b64,
         "num_segments": len(masks_list),
         "masks": masks_serializable,
-        "edge_refinement": True  # Indicate edge refinement was applied
+        "edge_refinement": True,  # Indicate edge refinement was applied
+        "postprocess": postprocess,
+        "timings": timer.timings
     }
 
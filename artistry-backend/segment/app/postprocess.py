@@ -0,0 +1,88 @@
+"""
+Mask post-processing
+Per-ROI cleanup of decoded SAM masks before they are returned: small
+component (speckle) removal, enclosed hole filling and optional edge
+feathering. Pure OpenCV/numpy, run across masks on a thread pool.
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+from pydantic import BaseModel
+
+
+class PostprocessOptions(BaseModel):
+    """Server-side mask cleanup applied per ROI (bbox + padding)"""
+    enabled: bool = True
+    min_component_area: float = 0.01  # Drop blobs smaller than this fraction of the ROI
+    max_hole_area: float = 0.05  # Fill enclosed holes smaller than this fraction of the ROI
+    feather_radius: int = 0  # Gaussian feather in px (0 = hard 0/255 edges)
+    roi_padding: int = 8  # px added around the bbox
+
+# OpenCV releases the GIL, so a thread pool gives real parallelism across masks
+POSTPROCESS_WORKERS = int(os.getenv("SEGMENT_POSTPROCESS_WORKERS", str(min(4, os.cpu_count() or 1))))
+postprocess_executor = ThreadPoolExecutor(max_workers=POSTPROCESS_WORKERS, thread_name_prefix="mask-postprocess")
+
+def mask_roi(mask, box=None, padding=8):
+    """ROI (x1, y1, x2, y2) for a mask: its bbox if given, else the mask's bounding rect"""
+    h, w = mask.shape[:2]
+    if box is not None:
+        x1, y1, x2, y2 = box["x1"], box["y1"], box["x2"], box["y2"]
+    else:
+        x, y, bw, bh = cv2.boundingRect(mask.astype(np.uint8))
+        x1, y1, x2, y2 = x, y, x + bw, y + bh
+    return (
+        max(0, int(x1) - padding),
+        max(0, int(y1) - padding),
+        min(w, int(np.ceil(x2)) + padding),
+        min(h, int(np.ceil(y2)) + padding),
+    )
+
+def postprocess_mask(mask, roi, opts: PostprocessOptions):
+    """
+    Clean a binary mask inside its ROI: remove small components, fill small
+    enclosed holes and optionally feather the edge. Returns uint8 (0-255).
+    """
+    x1, y1, x2, y2 = roi
+    result = mask.astype(np.uint8)
+    crop = result[y1:y2, x1:x2]  # view: edits land in result
+    roi_area = crop.size
+    if roi_area == 0:
+        return result * 255
+    
+    # Small-component removal (speckles)
+    if opts.min_component_area > 0:
+        num, labels, stats, _ = cv2.connectedComponentsWithStats(crop, connectivity=8)
+        if num > 1:
+            areas = stats[:, cv2.CC_STAT_AREA]
+            keep = areas >= opts.min_component_area * roi_area
+            keep[0] = False  # label 0 is background
+            if not keep.any():
+                keep[1 + np.argmax(areas[1:])] = True  # never erase the whole object
+            crop[:] = keep[labels]
+    
+    # Hole fill: background components that do not touch the ROI border
+    if opts.max_hole_area > 0:
+        num, labels, stats, _ = cv2.connectedComponentsWithStats(1 - crop, connectivity=4)
+        if num > 1:
+            fill = stats[:, cv2.CC_STAT_AREA] < opts.max_hole_area * roi_area
+            fill[0] = False  # label 0 is the mask itself
+            border = np.concatenate([labels[0], labels[-1], labels[:, 0], labels[:, -1]])
+            fill[np.unique(border)] = False
+            crop[fill[labels]] = 1
+    
+    result *= 255
+    
+    # Optional feathering for softer inpainting seams
+    if opts.feather_radius > 0:
+        k = 2 * opts.feather_radius + 1
+        result[y1:y2, x1:x2] = cv2.GaussianBlur(result[y1:y2, x1:x2], (k, k), 0)
+    
+    return result
+
+def postprocess_masks(masks, boxes, opts: PostprocessOptions):
+    """Run postprocess_mask across all masks on the thread pool"""
+    rois = [mask_roi(m, b, opts.roi_padding) for m, b in zip(masks, boxes)]
+    return list(postprocess_executor.map(lambda args: postprocess_mask(*args, opts), zip(masks, rois)))
@@ -0,0 +1,121 @@
+"""
+ONNX Runtime backend for MobileSAM
+Runs the exported image encoder and mask decoder graphs (optionally INT8-quantized)
+with the same call surface as mobile_sam.SamPredictor, so the endpoints can switch
+runtimes through config. Export the graphs with `python export_onnx.py`.
+"""
+
+import numpy as np
+from mobile_sam.utils.transforms import ResizeLongestSide
+
+# SAM normalization constants (same values as Sam.pixel_mean / Sam.pixel_std)
+PIXEL_MEAN = np.array([123.675, 116.28, 103.53], dtype=np.float32)
+PIXEL_STD = np.array([58.395, 57.12, 57.375], dtype=np.float32)
+IMG_SIZE = 1024
+MASK_THRESHOLD = 0.0
+
+
+def create_session(model_path: str, num_threads: int = 0):
+    """Create a CPU inference session for an exported graph"""
+    import onnxruntime as ort
+
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    if num_threads > 0:
+        options.intra_op_num_threads = num_threads
+    return ort.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+
+
+class OnnxSamPredictor:
+    """
+    Drop-in replacement for SamPredictor backed by ONNX Runtime.
+    The decoder graph is exported with all mask tokens, so single-mask output
+    picks token 0 exactly like the PyTorch predictor does.
+    """
+
+    def __init__(self, encoder_path: str, decoder_path: str, num_threads: int = 0):
+        self.encoder = create_session(encoder_path, num_threads)
+        self.decoder = create_session(decoder_path, num_threads)
+        self.transform = ResizeLongestSide(IMG_SIZE)
+        self.reset_image()
+
+    def reset_image(self):
+        self.features = None
+        self.original_size = None
+        self.input_size = None
+        self.is_image_set = False
+
+    def preprocess(self, image: np.ndarray):
+        """Resize longest side to 1024, normalize and pad to 1x3x1024x1024; returns (tensor, input_size)"""
+        input_image = self.transform.apply_image(image)
+        x = (input_image.astype(np.float32) - PIXEL_MEAN) / PIXEL_STD
+        h, w = x.shape[:2]
+        padded = np.zeros((IMG_SIZE, IMG_SIZE, 3), dtype=np.float32)
+        padded[:h, :w] = x
+        return padded.transpose(2, 0, 1)[None], (h, w)
+
+    def set_image(self, image: np.ndarray, image_format: str = "RGB"):
+        """Run the image encoder and keep the embedding for subsequent predictions"""
+        if image_format != "RGB":
+            image = image[..., ::-1]
+        x, input_size = self.preprocess(image)
+        self.features = self.encoder.run(None, {"image": x})[0]
+        self.original_size = image.shape[:2]
+        self.input_size = input_size
+        self.is_image_set = True
+
+    def get_image_embedding(self) -> np.ndarray:
+        if not self.is_image_set:
+            raise RuntimeError("An image must be set with .set_image(...) before mask prediction.")
+        return self.features
+
+    def _decode(self, coords: np.ndarray, labels: np.ndarray, multimask_output: bool, return_logits: bool):
+        """Run the decoder on a (B, N, 2) batch of prompts already in input-frame coordinates"""
+        if not self.is_image_set:
+            raise RuntimeError("An image must be set with .set_image(...) before mask prediction.")
+        masks, iou_predictions, low_res_masks = self.decoder.run(None, {
+            "image_embeddings": self.features,
+            "point_coords": coords.astype(np.float32),
+            "point_labels": labels.astype(np.float32),
+            "mask_input": np.zeros((1, 1, 256, 256), dtype=np.float32),
+            "has_mask_input": np.zeros(1, dtype=np.float32),
+            "orig_im_size": np.array(self.original_size, dtype=np.float32),
+        })
+
+        # Token 0 is the single-mask output, tokens 1-3 the multimask outputs
+        token_slice = slice(1, None) if multimask_output else slice(0, 1)
+        masks = masks[:, token_slice]
+        iou_predictions = iou_predictions[:, token_slice]
+        low_res_masks = low_res_masks[:, token_slice]
+
+        if not return_logits:
+            masks = masks > MASK_THRESHOLD
+        return masks, iou_predictions, low_res_masks
+
+    def predict(self, point_coords=None, point_labels=None, box=None, mask_input=None,
+                multimask_output: bool = True, return_logits: bool = False):
+        """Same contract as SamPredictor.predict for a single prompt (numpy in, numpy out)"""
+        coords = np.zeros((0, 2), dtype=np.float32)
+        labels = np.zeros((0,), dtype=np.float32)
+        if point_coords is not None:
+            coords = self.transform.apply_coords(np.asarray(point_coords, dtype=np.float32), self.original_size)
+            labels = np.asarray(point_labels, dtype=np.float32)
+        if box is not None:
+            box_coords = self.transform.apply_boxes(np.asarray(box, dtype=np.float32).reshape(1, 4), self.original_size)
+            coords = np.concatenate([coords, box_coords.reshape(2, 2)], axis=0)
+            labels = np.concatenate([labels, np.array([2, 3], dtype=np.float32)])
+        else:
+            # Padding point required by the exported graph when there is no box prompt
+            coords = np.concatenate([coords, np.zeros((1, 2), dtype=np.float32)], axis=0)
+            labels = np.concatenate([labels, np.array([-1], dtype=np.float32)])
+
+        masks, iou_predictions, low_res_masks = self._decode(coords[None], labels[None], multimask_output, return_logits)
+        return masks[0], iou_predictions[0], low_res_masks[0]
+
+    def predict_boxes(self, boxes: np.ndarray, return_logits: bool = False) -> np.ndarray:
+        """Decode one mask per xyxy box in a single batched decoder call -> (B, H, W)"""
+        boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+        coords = self.transform.apply_boxes(boxes, self.original_size).reshape(-1, 2, 2)
+        labels = np.tile(np.array([[2, 3]], dtype=np.float32), (len(boxes), 1))
+        masks, _, _ = self._decode(coords, labels, multimask_output=False, return_logits=return_logits)
+        return masks[:, 0]
@@ -0,0 +1,262 @@
+"""
+Segment service benchmark and memory profile.
+
+Drives /segment (JSON + boxes) and /segment/ (file upload + point grid)
+in-process through FastAPI's TestClient with synthetic rooms, sweeping
+resolution, box count and the edge-refinement toggle. Each case reports
+median per-stage timings (from the endpoint's `timings` field), end-to-end
+latency, peak RSS and peak traced allocations.
+
+Usage (from artistry-backend/segment):
+    python benchmark.py                                  # full sweep, JSON to stdout
+    python benchmark.py --output bench.json              # save a baseline
+    python benchmark.py --baseline bench.json            # compare, exit 1 on regression
+    python benchmark.py --resolutions 1280x720 --boxes 1 10 --runs 5
+"""
+
+import argparse
+import base64
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+from PIL import Image
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+from fastapi.testclient import TestClient  # noqa: E402
+from app import main as segment_main  # noqa: E402
+
+try:
+    import psutil
+except ImportError:  # RSS sampling falls back to the process-wide high-water mark
+    psutil = None
+
+DEFAULT_RESOLUTIONS = ["640x480", "1280x720", "1920x1080", "3840x2160"]
+DEFAULT_BOX_COUNTS = [1, 5, 10, 25, 50]
+STAGES = ["decode", "encoder", "decoder", "refinement", "postprocess", "encoding"]
+
+
+def synthetic_room(width, height, seed=0):
+    """Gradient background with furniture-like shapes so Canny and SAM have real edges"""
+    rng = np.random.default_rng(seed)
+    ramp = np.linspace(60, 200, width, dtype=np.float32)
+    image = np.repeat(np.repeat(ramp[None, :, None], height, axis=0), 3, axis=2).astype(np.uint8)
+    for _ in range(30):
+        color = tuple(int(c) for c in rng.integers(0, 255, 3))
+        x1, y1 = int(rng.integers(0, width - 10)), int(rng.integers(0, height - 10))
+        x2 = min(width - 1, x1 + int(rng.integers(width // 20, width // 3)))
+        y2 = min(height - 1, y1 + int(rng.integers(height // 20, height // 3)))
+        if rng.random() < 0.5:
+            cv2.rectangle(image, (x1, y1), (x2, y2), color, -1)
+        else:
+            cv2.ellipse(image, ((x1 + x2) // 2, (y1 + y2) // 2), ((x2 - x1) // 2, (y2 - y1) // 2), 0, 0, 360, color, -1)
+    noise = rng.normal(0, 6, image.shape)
+    return np.clip(image + noise, 0, 255).astype(np.uint8)
+
+
+def synthetic_boxes(width, height, count, seed=0):
+    rng = np.random.default_rng(seed)
+    boxes = []
+    for _ in range(count):
+        bw = int(width * rng.uniform(0.1, 0.4))
+        bh = int(height * rng.uniform(0.1, 0.4))
+        x1 = int(rng.integers(0, width - bw))
+        y1 = int(rng.integers(0, height - bh))
+        boxes.append({"x1": x1, "y1": y1, "x2": x1 + bw, "y2": y1 + bh})
+    return boxes
+
+
+def encode_png(image):
+    buf = io.BytesIO()
+    Image.fromarray(image).save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def reset_caches():
+    """Every run starts cold so the encoder is always measured"""
+    segment_main.decode_image_cached.cache_clear()
+    with segment_main.embedding_lock:
+        segment_main.embedding_cache.clear()
+
+
+class PeakRss:
+    """Samples RSS on a background thread while a case runs"""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        if psutil is not None:
+            process = psutil.Process()
+            self.peak = process.memory_info().rss
+
+            def sample():
+                while not self._stop.is_set():
+                    self.peak = max(self.peak, process.memory_info().rss)
+                    self._stop.wait(self.interval)
+
+            self._thread = threading.Thread(target=sample, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        else:
+            import resource
+            # ru_maxrss is KB on Linux, bytes on macOS
+            scale = 1 if sys.platform == "darwin" else 1024
+            self.peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+def run_case(client, endpoint, image, boxes, edge_refinement, runs):
+    height, width = image.shape[:2]
+    png_bytes = encode_png(image)
+    image_b64 = base64.b64encode(png_bytes).decode()
+
+    def call():
+        if endpoint == "segment":
+            resp = client.post("/segment", json={
+                "image_b64": image_b64,
+                "bboxes": boxes,
+                "enable_edge_refinement": edge_refinement,
+            })
+        else:
+            resp = client.post(
+                "/segment/",
+                params={"num_samples": len(boxes)},
+                files={"file": ("room.png", png_bytes, "image/png")},
+            )
+        resp.raise_for_status()
+        return resp.json()
+
+    stage_samples = {stage: [] for stage in STAGES}
+    totals = []
+    with PeakRss() as rss:
+        for _ in range(runs):
+            reset_caches()
+            start = time.perf_counter()
+            result = call()
+            totals.append((time.perf_counter() - start) * 1000)
+            for stage in STAGES:
+                stage_samples[stage].append(result.get("timings", {}).get(stage, 0.0))
+
+    # Separate traced run: tracemalloc overhead would skew the timings above
+    reset_caches()
+    tracemalloc.start()
+    call()
+    _, peak_alloc = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "endpoint": endpoint,
+        "resolution": f"{width}x{height}",
+        "num_boxes": len(boxes),
+        "edge_refinement": edge_refinement,
+        "runs": runs,
+        "timings_ms": {stage: round(statistics.median(v), 2) for stage, v in stage_samples.items()},
+        "total_ms": round(statistics.median(totals), 2),
+        "peak_rss_mb": round(rss.peak / 2**20, 1),
+        "peak_alloc_mb": round(peak_alloc / 2**20, 1),
+    }
+
+
+def case_key(case):
+    return (case["endpoint"], case["resolution"], case["num_boxes"], case["edge_refinement"])
+
+
+def compare(results, baseline, tolerance):
+    """Return cases whose total or any stage time grew by more than `tolerance`"""
+    base_cases = {case_key(c): c for c in baseline["cases"]}
+    regressions = []
+    for case in results["cases"]:
+        base = base_cases.get(case_key(case))
+        if base is None:
+            continue
+        metrics = [("total_ms", case["total_ms"], base["total_ms"])]
+        metrics += [(stage, case["timings_ms"][stage], base["timings_ms"].get(stage, 0.0)) for stage in STAGES]
+        for name, now, before in metrics:
+            # Ignore sub-millisecond stages, they are all noise
+            if before >= 1.0 and now > before * (1 + tolerance):
+                regressions.append({"case": list(case_key(case)), "metric": name, "baseline": before, "current": now})
+    return regressions
+
+
+def parse_resolution(value):
+    width, height = value.lower().split("x")
+    return int(width), int(height)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Segment service benchmark and memory profile")
+    parser.add_argument("--resolutions", nargs="*", default=DEFAULT_RESOLUTIONS)
+    parser.add_argument("--boxes", nargs="*", type=int, default=DEFAULT_BOX_COUNTS)
+    parser.add_argument("--endpoints", nargs="*", default=["segment", "segment_file"], choices=["segment", "segment_file"])
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--output", help="Write results JSON here (default: stdout)")
+    parser.add_argument("--baseline", help="Previous results JSON to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="Allowed slowdown vs baseline (0.15 = 15%%)")
+    args = parser.parse_args()
+
+    results = {
+        "meta": {
+            "runtime": segment_main.SAM_RUNTIME,
+            "device": segment_main.device,
+            "cpu_count": os.cpu_count(),
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "cases": [],
+    }
+
+    with TestClient(segment_main.app) as client:
+        for resolution in args.resolutions:
+            width, height = parse_resolution(resolution)
+            image = synthetic_room(width, height)
+            for num_boxes in args.boxes:
+                boxes = synthetic_boxes(width, height, num_boxes)
+                for endpoint in args.endpoints:
+                    # /segment/ always refines; only /segment exposes the toggle
+                    toggles = [True, False] if endpoint == "segment" else [True]
+                    for edge_refinement in toggles:
+                        case = run_case(client, endpoint, image, boxes, edge_refinement, args.runs)
+                        results["cases"].append(case)
+                        print(f"{endpoint:<13} {case['resolution']:>9} boxes={num_boxes:<3} edges={str(edge_refinement):<5} "
+                              f"total={case['total_ms']:>9.1f}ms rss={case['peak_rss_mb']:>7.1f}MB "
+                              f"alloc={case['peak_alloc_mb']:>7.1f}MB", file=sys.stderr)
+
+    exit_code = 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        results["regressions"] = regressions
+        for r in regressions:
+            print(f"✗ REGRESSION {r['case']} {r['metric']}: {r['baseline']} -> {r['current']} ms", file=sys.stderr)
+        exit_code = 1 if regressions else 0
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+    sys.exit(exit_code)
+
+
+if __name__ == "__main__":
+    main()
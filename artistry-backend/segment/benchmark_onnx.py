@@ -0,0 +1,147 @@
+"""
+Parity check + benchmark: ONNX runtime vs PyTorch MobileSAM.
+
+Runs both runtimes on the same images and boxes, reports per-box mask IoU
+and encoder/decoder latency, and exits non-zero if mean IoU drops below
+--min-iou (so it can gate CI or a deployment).
+
+Usage (from artistry-backend/segment, after `python export_onnx.py [--quantize]`):
+    python benchmark_onnx.py
+    python benchmark_onnx.py --quantized --images room1.jpg room2.jpg --runs 5
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+from mobile_sam import sam_model_registry, SamPredictor
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from app.sam_onnx import OnnxSamPredictor  # noqa: E402
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.join(HERE, "app")
+DEFAULT_IMAGES = [os.path.join(HERE, "..", "detect", "image-asset.webp")]
+
+
+def load_image(path):
+    return np.array(Image.open(path).convert("RGB"))
+
+
+def grid_boxes(h, w, rows=3, cols=3):
+    """Overlapping boxes covering the frame, similar in scale to detected furniture"""
+    boxes = []
+    for i in range(rows):
+        for j in range(cols):
+            x1, y1 = j * w / (cols + 1), i * h / (rows + 1)
+            boxes.append([x1, y1, x1 + 2 * w / (cols + 1), y1 + 2 * h / (rows + 1)])
+    return np.array(boxes, dtype=np.float32)
+
+
+def mask_iou(a, b):
+    union = np.logical_or(a, b).sum()
+    return 1.0 if union == 0 else float(np.logical_and(a, b).sum() / union)
+
+
+def timed(fn, runs):
+    """Median wall time in ms over `runs` calls, plus the last result"""
+    times = []
+    result = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = fn()
+        times.append((time.perf_counter() - start) * 1000)
+    return float(np.median(times)), result
+
+
+def run_torch(predictor, image, boxes, runs):
+    encode_ms, _ = timed(lambda: predictor.set_image(image), runs)
+
+    def decode():
+        boxes_torch = predictor.transform.apply_boxes_torch(torch.as_tensor(boxes), image.shape[:2])
+        masks, _, _ = predictor.predict_torch(point_coords=None, point_labels=None, boxes=boxes_torch, multimask_output=False)
+        return masks[:, 0].cpu().numpy()
+
+    with torch.no_grad():
+        decode_ms, masks = timed(decode, runs)
+    return encode_ms, decode_ms, masks
+
+
+def run_onnx(predictor, image, boxes, runs):
+    encode_ms, _ = timed(lambda: predictor.set_image(image), runs)
+    decode_ms, masks = timed(lambda: predictor.predict_boxes(boxes), runs)
+    return encode_ms, decode_ms, masks
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MobileSAM ONNX parity check and benchmark")
+    parser.add_argument("--images", nargs="*", default=DEFAULT_IMAGES)
+    parser.add_argument("--checkpoint", default=os.path.join(APP_DIR, "mobile_sam.pt"))
+    parser.add_argument("--quantized", action="store_true", help="Benchmark the INT8 *.quant.onnx graphs")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--threads", type=int, default=0)
+    parser.add_argument("--min-iou", type=float, default=None,
+                        help="Fail below this mean IoU (default 0.95 FP32, 0.85 INT8)")
+    parser.add_argument("--output", help="Write the report as JSON")
+    args = parser.parse_args()
+
+    suffix = ".quant.onnx" if args.quantized else ".onnx"
+    min_iou = args.min_iou if args.min_iou is not None else (0.85 if args.quantized else 0.95)
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+
+    sam = sam_model_registry["vit_t"](checkpoint=args.checkpoint).to("cpu").eval()
+    torch_predictor = SamPredictor(sam)
+    onnx_predictor = OnnxSamPredictor(
+        os.path.join(APP_DIR, f"mobile_sam_encoder{suffix}"),
+        os.path.join(APP_DIR, f"mobile_sam_decoder{suffix}"),
+        num_threads=args.threads,
+    )
+
+    report = {"runtime": f"onnx{'-int8' if args.quantized else ''}", "images": []}
+    all_ious = []
+    for path in args.images:
+        image = load_image(path)
+        boxes = grid_boxes(*image.shape[:2])
+
+        t_enc, t_dec, torch_masks = run_torch(torch_predictor, image, boxes, args.runs)
+        o_enc, o_dec, onnx_masks = run_onnx(onnx_predictor, image, boxes, args.runs)
+
+        ious = [mask_iou(a, b) for a, b in zip(torch_masks, onnx_masks)]
+        all_ious.extend(ious)
+        entry = {
+            "image": os.path.basename(path),
+            "size": list(image.shape[:2]),
+            "num_boxes": len(boxes),
+            "mean_iou": float(np.mean(ious)),
+            "min_iou": float(np.min(ious)),
+            "pytorch_ms": {"encoder": t_enc, "decoder": t_dec},
+            "onnx_ms": {"encoder": o_enc, "decoder": o_dec},
+            "encoder_speedup": t_enc / o_enc,
+            "total_speedup": (t_enc + t_dec) / (o_enc + o_dec),
+        }
+        report["images"].append(entry)
+        print(f"{entry['image']} {entry['size']}: IoU mean={entry['mean_iou']:.4f} min={entry['min_iou']:.4f} | "
+              f"encoder {t_enc:.0f}ms -> {o_enc:.0f}ms ({entry['encoder_speedup']:.2f}x) | "
+              f"decoder({len(boxes)} boxes) {t_dec:.0f}ms -> {o_dec:.0f}ms | total {entry['total_speedup']:.2f}x")
+
+    report["mean_iou"] = float(np.mean(all_ious))
+    report["min_iou_threshold"] = min_iou
+    report["passed"] = report["mean_iou"] >= min_iou
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    status = "✓ PASS" if report["passed"] else "✗ FAIL"
+    print(f"{status}: mean IoU {report['mean_iou']:.4f} (threshold {min_iou})")
+    sys.exit(0 if report["passed"] else 1)
+
+
+if __name__ == "__main__":
+    main()
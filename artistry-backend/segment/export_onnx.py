@@ -0,0 +1,126 @@
+"""
+Export MobileSAM (vit_t) to ONNX for the segment service's ONNX runtime.
+
+Usage (from artistry-backend/segment):
+    python export_onnx.py                      # FP32 encoder + decoder into app/
+    python export_onnx.py --quantize           # also write INT8 (dynamic) variants
+
+Then start the service with SAM_RUNTIME=onnx (and SAM_ONNX_QUANTIZED=1 for INT8).
+"""
+
+import argparse
+import os
+import warnings
+
+import torch
+from mobile_sam import sam_model_registry
+from mobile_sam.utils.onnx import SamOnnxModel
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app")
+
+
+class ImageEncoderOnnxModel(torch.nn.Module):
+    """Image encoder on an already normalized and padded 1x3x1024x1024 input"""
+
+    def __init__(self, sam):
+        super().__init__()
+        self.image_encoder = sam.image_encoder
+
+    @torch.no_grad()
+    def forward(self, image: torch.Tensor):
+        return self.image_encoder(image)
+
+
+def export_encoder(sam, output_path: str, opset: int):
+    dummy_image = torch.randn(1, 3, sam.image_encoder.img_size, sam.image_encoder.img_size, dtype=torch.float)
+    torch.onnx.export(
+        ImageEncoderOnnxModel(sam),
+        (dummy_image,),
+        output_path,
+        export_params=True,
+        opset_version=opset,
+        do_constant_folding=True,
+        input_names=["image"],
+        output_names=["image_embeddings"],
+    )
+
+
+def export_decoder(sam, output_path: str, opset: int):
+    # Keep every mask token so the runtime can select token 0 for single-mask output,
+    # matching SamPredictor(multimask_output=False) exactly
+    onnx_model = SamOnnxModel(model=sam, return_single_mask=False)
+
+    embed_dim = sam.prompt_encoder.embed_dim
+    embed_size = sam.prompt_encoder.image_embedding_size
+    mask_input_size = [4 * x for x in embed_size]
+    dummy_inputs = {
+        "image_embeddings": torch.randn(1, embed_dim, *embed_size, dtype=torch.float),
+        "point_coords": torch.randint(low=0, high=1024, size=(1, 5, 2), dtype=torch.float),
+        "point_labels": torch.randint(low=0, high=4, size=(1, 5), dtype=torch.float),
+        "mask_input": torch.randn(1, 1, *mask_input_size, dtype=torch.float),
+        "has_mask_input": torch.tensor([1], dtype=torch.float),
+        "orig_im_size": torch.tensor([1500, 2250], dtype=torch.float),
+    }
+    # Prompts are batched on dim 0 so all boxes of a request decode in one call
+    dynamic_axes = {
+        "point_coords": {0: "num_prompts", 1: "num_points"},
+        "point_labels": {0: "num_prompts", 1: "num_points"},
+        "masks": {0: "num_prompts"},
+        "iou_predictions": {0: "num_prompts"},
+        "low_res_masks": {0: "num_prompts"},
+    }
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore", category=torch.jit.TracerWarning)
+        warnings.filterwarnings("ignore", category=UserWarning)
+        torch.onnx.export(
+            onnx_model,
+            tuple(dummy_inputs.values()),
+            output_path,
+            export_params=True,
+            opset_version=opset,
+            do_constant_folding=True,
+            input_names=list(dummy_inputs.keys()),
+            output_names=["masks", "iou_predictions", "low_res_masks"],
+            dynamic_axes=dynamic_axes,
+        )
+
+
+def quantize(input_path: str, output_path: str):
+    """Dynamic INT8 weight quantization (no calibration data needed)"""
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    quantize_dynamic(model_input=input_path, model_output=output_path, weight_type=QuantType.QUInt8)
+
+
+def quantized_path(path: str) -> str:
+    root, ext = os.path.splitext(path)
+    return f"{root}.quant{ext}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export MobileSAM encoder/decoder to ONNX")
+    parser.add_argument("--checkpoint", default=os.path.join(APP_DIR, "mobile_sam.pt"))
+    parser.add_argument("--encoder-output", default=os.path.join(APP_DIR, "mobile_sam_encoder.onnx"))
+    parser.add_argument("--decoder-output", default=os.path.join(APP_DIR, "mobile_sam_decoder.onnx"))
+    parser.add_argument("--opset", type=int, default=17)
+    parser.add_argument("--quantize", action="store_true", help="Also write INT8 *.quant.onnx variants")
+    args = parser.parse_args()
+
+    print(f"Loading MobileSAM checkpoint {args.checkpoint}...")
+    sam = sam_model_registry["vit_t"](checkpoint=args.checkpoint).eval()
+
+    print(f"Exporting image encoder -> {args.encoder_output}")
+    export_encoder(sam, args.encoder_output, args.opset)
+    print(f"Exporting mask decoder -> {args.decoder_output}")
+    export_decoder(sam, args.decoder_output, args.opset)
+
+    if args.quantize:
+        for path in (args.encoder_output, args.decoder_output):
+            print(f"Quantizing {path} -> {quantized_path(path)}")
+            quantize(path, quantized_path(path))
+
+    print("✓ Export complete")
+
+
+if __name__ == "__main__":
+    main()
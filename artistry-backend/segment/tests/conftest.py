@@ -0,0 +1,40 @@
+import os
+import sys
+
+import pytest
+
+SEGMENT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP_DIR = os.path.join(SEGMENT_DIR, "app")
+
+# Tests import the service package as `app`, like uvicorn does from artistry-backend/segment
+sys.path.insert(0, SEGMENT_DIR)
+
+
+@pytest.fixture(scope="session")
+def sam_onnx(tmp_path_factory):
+    """
+    (PyTorch vit_t model, encoder .onnx, decoder .onnx) exported from the same weights.
+
+    Uses app/mobile_sam.pt with the graphs next to it when both exist. Otherwise
+    a seeded, randomly initialized vit_t is exported into a temp dir, so parity
+    runs wherever torch, mobile_sam and onnxruntime are installed.
+    """
+    torch = pytest.importorskip("torch")
+    pytest.importorskip("onnxruntime")
+    pytest.importorskip("onnx")
+    mobile_sam = pytest.importorskip("mobile_sam")
+    import export_onnx
+
+    checkpoint = os.path.join(APP_DIR, "mobile_sam.pt")
+    encoder = os.getenv("SAM_ONNX_ENCODER", os.path.join(APP_DIR, "mobile_sam_encoder.onnx"))
+    decoder = os.getenv("SAM_ONNX_DECODER", os.path.join(APP_DIR, "mobile_sam_decoder.onnx"))
+    if os.path.exists(checkpoint) and os.path.exists(encoder) and os.path.exists(decoder):
+        return mobile_sam.sam_model_registry["vit_t"](checkpoint=checkpoint).eval(), encoder, decoder
+
+    torch.manual_seed(0)
+    sam = mobile_sam.sam_model_registry["vit_t"]().eval()
+    out_dir = tmp_path_factory.mktemp("sam_onnx")
+    encoder, decoder = str(out_dir / "encoder.onnx"), str(out_dir / "decoder.onnx")
+    export_onnx.export_encoder(sam, encoder, opset=17)
+    export_onnx.export_decoder(sam, decoder, opset=17)
+    return sam, encoder, decoder
@@ -0,0 +1,101 @@
+"""Mask cleanup: speckle removal, hole filling, feathering and ROIs on synthetic masks."""
+
+import numpy as np
+import pytest
+
+pytest.importorskip("cv2")
+
+from app.postprocess import PostprocessOptions, mask_roi, postprocess_mask, postprocess_masks  # noqa: E402
+
+BOX = {"x1": 20, "y1": 20, "x2": 80, "y2": 80}
+
+
+def square_mask():
+    """100x100 frame with a filled 60x60 square (the object) at 20..79"""
+    mask = np.zeros((100, 100), dtype=bool)
+    mask[20:80, 20:80] = True
+    return mask
+
+
+def test_mask_roi_pads_box_and_clamps_to_frame():
+    mask = square_mask()
+    assert mask_roi(mask, BOX, padding=8) == (12, 12, 88, 88)
+    assert mask_roi(mask, {"x1": 2, "y1": 3, "x2": 97.5, "y2": 99}, padding=8) == (0, 0, 100, 100)
+
+
+def test_mask_roi_without_box_uses_mask_bounds():
+    assert mask_roi(square_mask(), None, padding=0) == (20, 20, 80, 80)
+
+
+def test_small_hole_is_filled():
+    mask = square_mask()
+    mask[45:50, 45:50] = False  # 25 px hole, well under 5% of the ROI
+    roi = mask_roi(mask, BOX, padding=8)
+    result = postprocess_mask(mask, roi, PostprocessOptions())
+    assert result.dtype == np.uint8
+    assert (result[45:50, 45:50] == 255).all()
+    assert set(np.unique(result)) == {0, 255}
+
+
+def test_large_hole_is_kept():
+    mask = square_mask()
+    mask[30:70, 30:70] = False  # 1600 px, ~28% of the ROI: a real opening, not noise
+    roi = mask_roi(mask, BOX, padding=8)
+    result = postprocess_mask(mask, roi, PostprocessOptions())
+    assert (result[30:70, 30:70] == 0).all()
+
+
+def test_speckles_are_removed():
+    mask = square_mask()
+    mask[14:16, 14:16] = True  # 4 px blob inside the padded ROI
+    mask[84:86, 84:86] = True
+    roi = mask_roi(mask, BOX, padding=8)
+    result = postprocess_mask(mask, roi, PostprocessOptions())
+    assert (result[14:16, 14:16] == 0).all()
+    assert (result[84:86, 84:86] == 0).all()
+    assert (result[20:80, 20:80] == 255).all()
+
+
+def test_only_small_components_never_empty_the_mask():
+    mask = np.zeros((100, 100), dtype=bool)
+    mask[40:42, 40:42] = True
+    mask[60:63, 60:63] = True  # the larger of two specks survives
+    roi = (0, 0, 100, 100)
+    result = postprocess_mask(mask, roi, PostprocessOptions(min_component_area=0.5))
+    assert (result[60:63, 60:63] == 255).all()
+    assert (result[40:42, 40:42] == 0).all()
+
+
+def test_cleanup_stays_inside_roi():
+    mask = square_mask()
+    mask[2:4, 2:4] = True  # speck outside the padded ROI is left alone
+    roi = mask_roi(mask, BOX, padding=8)
+    result = postprocess_mask(mask, roi, PostprocessOptions())
+    assert (result[2:4, 2:4] == 255).all()
+
+
+def test_feathering_softens_the_edge():
+    roi = mask_roi(square_mask(), BOX, padding=8)
+    result = postprocess_mask(square_mask(), roi, PostprocessOptions(feather_radius=3))
+    assert 0 < result[50, 20] < 255
+    assert result[50, 50] == 255
+    assert result[50, 5] == 0
+
+
+def test_disabled_steps_leave_mask_unchanged():
+    mask = square_mask()
+    mask[45:50, 45:50] = False
+    mask[14:16, 14:16] = True
+    opts = PostprocessOptions(min_component_area=0, max_hole_area=0)
+    result = postprocess_mask(mask, mask_roi(mask, BOX, padding=8), opts)
+    np.testing.assert_array_equal(result, mask.astype(np.uint8) * 255)
+
+
+def test_postprocess_masks_keeps_order():
+    first = square_mask()
+    second = np.zeros((100, 100), dtype=bool)
+    second[5:15, 5:15] = True
+    results = postprocess_masks([first, second], [BOX, None], PostprocessOptions())
+    assert len(results) == 2
+    assert results[0][50, 50] == 255 and results[0][10, 10] == 0
+    assert results[1][10, 10] == 255 and results[1][50, 50] == 0
@@ -0,0 +1,124 @@
+"""OnnxSamPredictor output contract and mask parity with the PyTorch SamPredictor."""
+
+import numpy as np
+import pytest
+
+pytest.importorskip("onnxruntime")
+pytest.importorskip("mobile_sam")
+
+from app.sam_onnx import OnnxSamPredictor  # noqa: E402
+
+# FP32 graphs should reproduce the PyTorch masks almost exactly (benchmark_onnx.py uses the same bar)
+MIN_IOU = 0.95
+
+HEIGHT, WIDTH = 480, 640
+BOXES = np.array([[40, 60, 300, 400], [320, 100, 600, 380]], dtype=np.float32)
+
+
+@pytest.fixture(scope="module")
+def image():
+    # Two flat-colored blocks on a grey background, one per box
+    image = np.full((HEIGHT, WIDTH, 3), 128, dtype=np.uint8)
+    image[80:380, 60:280] = (200, 60, 40)
+    image[120:360, 340:580] = (40, 90, 200)
+    return image
+
+
+@pytest.fixture(scope="module")
+def predictor(sam_onnx, image):
+    _, encoder, decoder = sam_onnx
+    predictor = OnnxSamPredictor(encoder, decoder)
+    predictor.set_image(image)
+    return predictor
+
+
+def raw_decode(predictor, box):
+    """All four mask tokens for one box, straight from the decoder graph"""
+    coords = predictor.transform.apply_boxes(box.reshape(1, 4), predictor.original_size).reshape(1, 2, 2)
+    masks, iou_predictions, _ = predictor.decoder.run(None, {
+        "image_embeddings": predictor.features,
+        "point_coords": coords.astype(np.float32),
+        "point_labels": np.array([[2, 3]], dtype=np.float32),
+        "mask_input": np.zeros((1, 1, 256, 256), dtype=np.float32),
+        "has_mask_input": np.zeros(1, dtype=np.float32),
+        "orig_im_size": np.array(predictor.original_size, dtype=np.float32),
+    })
+    return masks[0], iou_predictions[0]
+
+
+def test_predict_multimask_shapes(predictor):
+    masks, iou_predictions, low_res = predictor.predict(box=BOXES[0], multimask_output=True)
+    assert masks.shape == (3, HEIGHT, WIDTH)
+    assert masks.dtype == bool
+    assert iou_predictions.shape == (3,)
+    assert low_res.shape == (3, 256, 256)
+
+
+def test_predict_single_mask_shapes(predictor):
+    masks, iou_predictions, low_res = predictor.predict(box=BOXES[0], multimask_output=False)
+    assert masks.shape == (1, HEIGHT, WIDTH)
+    assert iou_predictions.shape == (1,)
+    assert low_res.shape == (1, 256, 256)
+
+
+def test_mask_token_selection(predictor):
+    raw_masks, raw_iou = raw_decode(predictor, BOXES[0])
+    assert raw_masks.shape[0] == 4
+
+    single, single_iou, _ = predictor.predict(box=BOXES[0], multimask_output=False, return_logits=True)
+    np.testing.assert_allclose(single[0], raw_masks[0], atol=1e-5)
+    np.testing.assert_allclose(single_iou, raw_iou[:1], atol=1e-5)
+
+    multi, multi_iou, _ = predictor.predict(box=BOXES[0], multimask_output=True, return_logits=True)
+    np.testing.assert_allclose(multi, raw_masks[1:], atol=1e-5)
+    np.testing.assert_allclose(multi_iou, raw_iou[1:], atol=1e-5)
+
+
+def test_predict_boxes_matches_single_box_predict(predictor):
+    masks = predictor.predict_boxes(BOXES)
+    assert masks.shape == (len(BOXES), HEIGHT, WIDTH)
+    assert masks.dtype == bool
+
+    logits = predictor.predict_boxes(BOXES, return_logits=True)
+    for box, box_logits in zip(BOXES, logits):
+        single, _, _ = predictor.predict(box=box, multimask_output=False, return_logits=True)
+        np.testing.assert_allclose(box_logits, single[0], atol=1e-3)
+
+
+def mask_iou(a, b):
+    union = np.logical_or(a, b).sum()
+    return 1.0 if union == 0 else float(np.logical_and(a, b).sum() / union)
+
+
+def test_box_masks_match_pytorch(sam_onnx, image, predictor):
+    import torch
+    from mobile_sam import SamPredictor
+
+    sam, _, _ = sam_onnx
+    torch_predictor = SamPredictor(sam)
+    with torch.no_grad():
+        torch_predictor.set_image(image)
+        boxes = torch_predictor.transform.apply_boxes_torch(torch.as_tensor(BOXES), image.shape[:2])
+        torch_masks, _, _ = torch_predictor.predict_torch(
+            point_coords=None, point_labels=None, boxes=boxes, multimask_output=False
+        )
+    torch_masks = torch_masks[:, 0].cpu().numpy()
+
+    onnx_masks = predictor.predict_boxes(BOXES)
+    ious = [mask_iou(a, b) for a, b in zip(torch_masks, onnx_masks)]
+    assert min(ious) >= MIN_IOU, f"ONNX/PyTorch mask IoU {ious}"
+
+
+def test_point_masks_match_pytorch(sam_onnx, image, predictor):
+    from mobile_sam import SamPredictor
+
+    sam, _, _ = sam_onnx
+    torch_predictor = SamPredictor(sam)
+    torch_predictor.set_image(image)
+    point, label = np.array([[170, 230]]), np.array([1])
+    for multimask in (False, True):
+        torch_masks, _, _ = torch_predictor.predict(point_coords=point, point_labels=label, multimask_output=multimask)
+        onnx_masks, _, _ = predictor.predict(point_coords=point, point_labels=label, multimask_output=multimask)
+        assert onnx_masks.shape == torch_masks.shape
+        ious = [mask_iou(a, b) for a, b in zip(torch_masks, onnx_masks)]
+        assert min(ious) >= MIN_IOU, f"multimask={multimask}: ONNX/PyTorch mask IoU {ious}"
@@ -53,7 +53,8 @@ export default function Generate() {
         guidanceScale: guidanceScale,
         mode: mode,  // Use mode instead of strength
         twoPass: twoPass,
-        controlnetConditioningScale: controlnetScale
+        controlnetConditioningScale: controlnetScale,
+        debug: true  // This page shows the Canny map and pass A
       })
       setGeneratedImage(result.generatedImage)
       setCannyImage(result.cannyImage)
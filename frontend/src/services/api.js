@@ -234,7 +234,17 @@ export const generateDesign = async (
       guidanceScale = 7.5,
       mode = 'balanced',  // 'subtle', 'balanced', 'bold'
       twoPass = false,  // Enable two-pass generation
-      controlnetConditioningScale = 1.0
+      controlnetConditioningScale = 1.0,
+      controlnets = ['canny'],  // Any of 'canny', 'depth', 'seg'
+      controlnetScales = null,  // One scale per ControlNet, e.g. [1.0, 0.6]
+      returnPassA = false,  // Also return the two-pass intermediate (debug)
+      seed = null,  // Fixed seed: reproducible (and cached) result
+      restoreAspect = true,  // Output keeps the photo's exact aspect ratio
+      highRes = false,  // 2x upscale with tiled refinement (slower)
+      numVariations = 1,  // Design options from one batched call
+      debug = false,  // Also return control maps, resized original and pass A
+      outputFormat = 'webp',  // 'webp' | 'jpeg' | 'png'
+      outputQuality = 90
     } = options
 
     const formData = new FormData()
@@ -245,6 +255,20 @@ export const generateDesign = async (
     formData.append('mode', mode)
     formData.append('two_pass', twoPass.toString())
     formData.append('controlnet_conditioning_scale', controlnetConditioningScale.toString())
+    formData.append('controlnets', controlnets.join(','))
+    if (controlnetScales) {
+      formData.append('controlnet_scales', controlnetScales.join(','))
+    }
+    formData.append('return_pass_a', returnPassA.toString())
+    formData.append('restore_aspect', restoreAspect.toString())
+    formData.append('high_res', highRes.toString())
+    formData.append('num_variations', numVariations.toString())
+    formData.append('debug', debug.toString())
+    formData.append('output_format', outputFormat)
+    formData.append('output_quality', outputQuality.toString())
+    if (seed !== null && seed !== undefined) {
+      formData.append('seed', seed.toString())
+    }
 
     const response = await fetch(`${GENERATE_API}/generate/`, {
       method: 'POST',
@@ -259,7 +283,10 @@ export const generateDesign = async (
       originalImage: data.original_image || null,
       prompt: data.prompt || prompt,
       cannyImage: data.canny_image || null,
+      controlMaps: data.control_maps || {},  // { controlnet: map } with debug
       passAImage: data.pass_a_image || null,  // Two-pass intermediate result
+      seed: data.parameters?.seed ?? null,
+      variations: data.variations || [],  // [{ seed, image }] when numVariations > 1
       parameters: data.parameters || {}
     }
   } catch (error) {